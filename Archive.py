@@ -0,0 +1,195 @@
+import difflib
+import os
+import sqlite3
+import sys
+import xml.etree.ElementTree as ET
+import zlib
+from datetime import datetime, timezone
+import HistoryStore
+import Manifest
+
+# A read-optimized archive of the whole history tree: one SQLite database (historyRoot/archive.db) holding every version of every page,
+# indexed by page, version, date and user, so that questions about the history are single indexed lookups rather than walks of thousands of directories.
+#       PageAtDate(page, when)            -- what the page looked like at a date
+#       DiffBetweenVersions(page, v1, v2) -- a unified diff between two versions
+#       EditsByUser(user)                 -- every edit a user made
+# The archive is compiled from the tree (whatever its storage format) and brought up to date incrementally: Update() adds only the versions
+#   the manifest has and the archive doesn't.  The tree remains the truth; delete archive.db to recompile it from scratch.
+#
+# python Archive.py update <historyRoot>
+# python Archive.py at <historyRoot> <page> <date>
+# python Archive.py diff <historyRoot> <page> <version> <version>
+# python Archive.py user <historyRoot> <user>
+
+archiveFileName="archive.db"
+
+_schema='''
+CREATE TABLE IF NOT EXISTS versions (page TEXT NOT NULL, number INTEGER NOT NULL, revision_id TEXT, type TEXT, user TEXT, date TEXT, time REAL, comment TEXT, source BLOB,
+                                     PRIMARY KEY (page, number));
+CREATE INDEX IF NOT EXISTS versions_by_time ON versions (page, time);
+CREATE INDEX IF NOT EXISTS versions_by_user ON versions (user, time);
+'''
+
+
+#--------------------------------------------------------
+# Turn the date in a metadata.xml (normally "d Mon yyyy", sometimes with a time) into a Unix time (UTC), or None if it can't be read
+def ParseDate(text):
+    for format in ["%d %b %Y %H:%M:%S", "%d %b %Y %H:%M", "%d %b %Y", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%d"]:
+        try:
+            dt=datetime.strptime(text.strip(), format)
+        except ValueError:
+            continue
+        if dt.tzinfo is None:
+            dt=dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+    return None
+
+
+#--------------------------------------------------------
+# The Unix time of the end of a date (given as a date, a datetime or a string), for comparing with the archive's times
+# Since versions are dated only to the day, asking about a day means asking about the end of it
+def _EndOf(when):
+    if isinstance(when, str):
+        t=ParseDate(when)
+        if t is None:
+            raise ValueError("Can't make sense of the date "+when)
+        when=datetime.fromtimestamp(t, tz=timezone.utc)
+        if when.hour == 0 and when.minute == 0 and when.second == 0:
+            when=when.date()
+    if isinstance(when, datetime):
+        if when.tzinfo is None:
+            when=when.replace(tzinfo=timezone.utc)
+        return when.timestamp()
+    return datetime(when.year, when.month, when.day, tzinfo=timezone.utc).timestamp()+86400-0.001
+
+
+class Archive:
+
+    def __init__(self, historyRoot):
+        self.historyRoot=historyRoot
+        self.conn=sqlite3.connect(os.path.join(historyRoot, archiveFileName))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_schema)
+
+    #--------------------------------------------------------
+    def Close(self):
+        self.conn.close()
+
+    #--------------------------------------------------------
+    # Add the versions which are in the tree (according to its manifest) but not yet in the archive
+    # Returns the number of versions added
+    def Update(self, batchSize=500):
+        have=set(self.conn.execute("SELECT page, number FROM versions"))
+        missing=sorted(Manifest.ForRoot(self.historyRoot).AllVersions()-have)
+        if len(missing) == 0:
+            return 0
+        print("   Adding "+str(len(missing))+" versions to "+archiveFileName)
+        rows=[]
+        added=0
+        for pageName, number in missing:
+            try:
+                metadata, source=HistoryStore.ReadVersion(HistoryStore.PagePath(self.historyRoot, pageName), number)
+            except (OSError, KeyError) as exception:
+                print("***Can't read "+pageName+" V"+str(number)+": "+type(exception).__name__+": "+str(exception))
+                continue
+            rows.append(_Row(pageName, number, metadata, source))
+            if len(rows) >= batchSize:
+                added=added+self._Insert(rows)
+                rows=[]
+        added=added+self._Insert(rows)
+        return added
+
+    def _Insert(self, rows):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO versions (page, number, revision_id, type, user, date, time, comment, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    #--------------------------------------------------------
+    # Drop versions (a list of (page name, number)), say because they're bad and are to be fetched again
+    def RemoveVersions(self, versions):
+        with self.conn:
+            self.conn.executemany("DELETE FROM versions WHERE page=? AND number=?", [(p, int(n)) for p, n in versions])
+
+    #--------------------------------------------------------
+    # The version numbers of a page in the archive, oldest first
+    def Versions(self, pageName):
+        return [row[0] for row in self.conn.execute("SELECT number FROM versions WHERE page=? ORDER BY number", (pageName,))]
+
+    #--------------------------------------------------------
+    # The source of one version of a page, or None if the archive doesn't have it
+    def Source(self, pageName, number):
+        row=self.conn.execute("SELECT source FROM versions WHERE page=? AND number=?", (pageName, int(number))).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8") if row is not None else None
+
+    #--------------------------------------------------------
+    # What the page looked like at when (a date, a datetime or a string like "12 Mar 2015")
+    # Returns (version number, source) of the last version made by then, or None if the page didn't exist yet
+    def PageAtDate(self, pageName, when):
+        row=self.conn.execute("SELECT number, source FROM versions WHERE page=? AND time<=? ORDER BY time DESC, number DESC LIMIT 1", (pageName, _EndOf(when))).fetchone()
+        if row is None:
+            return None
+        return row[0], zlib.decompress(row[1]).decode("utf-8")
+
+    #--------------------------------------------------------
+    # A unified diff of the sources of two versions of a page, or None if the archive lacks either
+    def DiffBetweenVersions(self, pageName, number1, number2):
+        source1=self.Source(pageName, number1)
+        source2=self.Source(pageName, number2)
+        if source1 is None or source2 is None:
+            return None
+        return "".join(difflib.unified_diff(source1.splitlines(keepends=True), source2.splitlines(keepends=True),
+                                            fromfile=pageName+" "+HistoryStore.VersionDirName(number1), tofile=pageName+" "+HistoryStore.VersionDirName(number2)))
+
+    #--------------------------------------------------------
+    # Every edit by a user, oldest first, as a list of (page name, version number, date, type, comment)
+    def EditsByUser(self, user):
+        return list(self.conn.execute("SELECT page, number, date, type, comment FROM versions WHERE user=? ORDER BY time, page, number", (user,)))
+
+
+#--------------------------------------------------------
+# Make the archive row of one version from its metadata.xml and source
+def _Row(pageName, number, metadata, source):
+    fields={}
+    try:
+        for el in ET.fromstring(metadata):
+            fields[el.tag]=el.text or ""
+    except ET.ParseError:
+        pass    # An unreadable metadata.xml still leaves the source worth having
+    dateText=fields.get("date", "")
+    return (pageName, int(number), fields.get("ID"), fields.get("type", "").strip(), fields.get("name", "").strip(), dateText, ParseDate(dateText),
+            fields.get("comment", ""), zlib.compress(source.encode("utf-8")))
+
+
+#--------------------------------------------------------
+# Bring historyRoot's archive up to date
+def Update(historyRoot):
+    archive=Archive(historyRoot)
+    added=archive.Update()
+    archive.Close()
+    return added
+
+
+#--------------------------------------------------------
+if __name__ == "__main__":
+    args=sys.argv[1:]
+    if len(args) == 2 and args[0] == "update":
+        print(str(Update(args[1]))+" versions added")
+    elif len(args) == 4 and args[0] == "at":
+        result=Archive(args[1]).PageAtDate(args[2], args[3])
+        if result is None:
+            print("*** "+args[2]+" didn't exist on "+args[3])
+        else:
+            print("--- "+args[2]+" "+HistoryStore.VersionDirName(result[0]))
+            print(result[1])
+    elif len(args) == 5 and args[0] == "diff":
+        diff=Archive(args[1]).DiffBetweenVersions(args[2], int(args[3]), int(args[4]))
+        print(diff if diff is not None else "*** The archive doesn't have both versions")
+    elif len(args) == 3 and args[0] == "user":
+        for pageName, number, dateText, type, comment in Archive(args[1]).EditsByUser(args[2]):
+            print(dateText+"  "+pageName+" "+HistoryStore.VersionDirName(number)+" "+type+"  "+comment)
+    else:
+        print("Usage: python Archive.py update <historyRoot>")
+        print("       python Archive.py at <historyRoot> <page> <date>")
+        print("       python Archive.py diff <historyRoot> <page> <version> <version>")
+        print("       python Archive.py user <historyRoot> <user>")
+        sys.exit(1)
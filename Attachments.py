@@ -0,0 +1,168 @@
+import concurrent.futures
+import email.utils
+import html.parser
+import http.client
+import os
+import urllib.parse
+import HistoryStore
+import Waits
+
+# Download the files attached to a page, fetching only those which are new or have changed.
+# Each file is fetched with a conditional GET (If-Modified-Since the Last-Modified time we saw when we last downloaded it),
+# so an unchanged file costs one small request and no bandwidth.  Files are fetched in parallel by a pool of threads kept for the whole run,
+# each thread using its own kept-alive connection, so the connections serve page after page.
+# Each file is written to a temporary file and then renamed into place, so a crash never leaves a partial attachment.
+# A downloaded file's modification time is set to the server's Last-Modified time, and its size and that time are recorded in the manifest.
+
+maxDownloadThreads=4
+
+#--------------------------------------------------------
+# An HTML parser which picks the rows out of the table with class "page-files"
+# Each row's first cell holds a link to the file, whose text is the file's name
+class _FileTableParser(html.parser.HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.files=[]
+        self._tableDepth=0
+        self._href=None
+        self._text=""
+
+    def handle_starttag(self, tag, attrs):
+        attrs=dict(attrs)
+        if tag == "table":
+            if self._tableDepth > 0 or "page-files" in (attrs.get("class") or "").split():
+                self._tableDepth=self._tableDepth+1
+        elif tag == "a" and self._tableDepth > 0 and self._href is None and attrs.get("href"):
+            self._href=attrs["href"]
+            self._text=""
+
+    def handle_endtag(self, tag):
+        if tag == "table" and self._tableDepth > 0:
+            self._tableDepth=self._tableDepth-1
+        elif tag == "a" and self._href is not None:
+            if "/local--files/" in self._href:     # Skip any other links, such as the "info" and "delete" buttons
+                self.files.append((self._href, self._text.strip()))
+            self._href=None
+        elif tag == "tr":
+            self._href=None
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._text=self._text+data
+
+
+#--------------------------------------------------------
+# Parse the HTML of a page's file list
+# Return a list of (url, file name)
+def ParseFileTable(body):
+    parser=_FileTableParser()
+    parser.feed(body)
+    parser.close()
+    return parser.files
+
+
+#--------------------------------------------------------
+# The name to save an attached file under, or None if it isn't safe to save
+# The name comes from the site, so it mustn't be able to reach outside the page's directory or overwrite the page's own files (its versions and its pack)
+def _SafeFileName(name):
+    name=os.path.basename(name.replace("\\", "/"))
+    if name == "" or name.startswith(".") or HistoryStore.IsStoreFile(name) or HistoryStore.IsVersionDirName(name):
+        return None
+    return name
+
+
+# One pool of download threads per process
+# (A forked worker inherits its parent's pool, but not the pool's threads, so it's remembered along with the process it belongs to.)
+_pool=None
+_poolPid=None
+
+#--------------------------------------------------------
+def _Pool():
+    global _pool, _poolPid
+    if _pool is None or _poolPid != os.getpid():
+        _pool=concurrent.futures.ThreadPoolExecutor(max_workers=maxDownloadThreads)
+        _poolPid=os.getpid()
+    return _pool
+
+
+#--------------------------------------------------------
+# Download one file to pagePath/name unless it hasn't changed since we last did
+# known is the (size, mtime) recorded for it in the manifest, or None
+# Returns ("downloaded", size, mtime), ("unchanged", None, None) or ("failed", None, None)
+def _SyncFile(session, url, path, known):
+    headers={}
+    if known is not None and known[1] is not None and os.path.exists(path) and os.path.getsize(path) == known[0]:
+        headers["If-Modified-Since"]=email.utils.formatdate(known[1], usegmt=True)
+
+    # Network errors and server errors (5xx) are retried with backoff
+    def Get():
+        response=session.Get(url, headers=headers)
+        if response[0] >= 500 or response[0] == 429:
+            return None
+        return response
+    try:
+        response=Waits.WaitFor("attachment", Get, deadline=60, initialDelay=0.5, maxDelay=10, ignored=(OSError, http.client.HTTPException))
+    except Exception as exception:
+        print("***Could not download "+url+": "+type(exception).__name__+" "+str(exception))
+        return "failed", None, None
+    if response is None:
+        print("***Could not download "+url)
+        return "failed", None, None
+    status, responseHeaders, data=response
+    if status == 304:
+        return "unchanged", None, None
+    if status != 200:
+        print("***Could not download "+url+": HTTP status "+str(status))
+        return "failed", None, None
+
+    mtime=None
+    if responseHeaders.get("Last-Modified") is not None:
+        mtime=email.utils.parsedate_to_datetime(responseHeaders["Last-Modified"]).timestamp()
+    if known is not None and os.path.exists(path) and known == (len(data), mtime):
+        return "unchanged", None, None      # The server ignored If-Modified-Since, but it's the same file
+
+    # Write it to a temporary file and rename that into place
+    temp=path+".part"
+    with open(temp, "wb") as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(temp, (mtime, mtime))
+    os.replace(temp, path)
+    return "downloaded", len(data), mtime
+
+
+#--------------------------------------------------------
+# Bring the files attached to pageName up to date in pagePath
+# files is a list of (url, name) as returned by ParseFileTable; relative URLs are relative to baseUrl
+# Returns True if every file is now up to date (files whose names aren't safe to save are skipped, and don't count against it)
+def SyncAttachments(session, baseUrl, pagePath, pageName, files, manifest):
+    if len(files) == 0:
+        return True
+    os.makedirs(pagePath, exist_ok=True)
+    knownFiles=manifest.Files(pageName)
+
+    futures={}
+    for url, name in files:
+        safeName=_SafeFileName(name)
+        if safeName is None:
+            print("***Skipping a file attached to "+pageName+" whose name can't be saved: "+repr(name))
+            continue
+        url=urllib.parse.urljoin(baseUrl+"/", url)
+        futures[_Pool().submit(_SyncFile, session, url, os.path.join(pagePath, safeName), knownFiles.get(safeName))]=safeName
+
+    downloaded=0
+    unchanged=0
+    failed=0
+    for future in concurrent.futures.as_completed(futures):
+        result, size, mtime=future.result()
+        if result == "downloaded":
+            manifest.AddFile(pageName, futures[future], size, mtime)
+            downloaded=downloaded+1
+        elif result == "unchanged":
+            unchanged=unchanged+1
+        else:
+            failed=failed+1
+
+    print("      "+str(downloaded)+" files downloaded, "+str(unchanged)+" unchanged"+(", "+str(failed)+" failed" if failed > 0 else "")+".")
+    return failed == 0
@@ -0,0 +1,147 @@
+import argparse
+import functools
+import os
+import random
+import shutil
+import tempfile
+import time
+import ChangeFeed
+import HistoryStore
+import Journal
+import Manifest
+import MockWikidot
+import PageMetadata
+import RateLimiter
+import SearchIndex
+import Timing
+import Waits
+import WikidotAjax
+import WorkerPool
+
+# An end-to-end benchmark of the downloader, run offline against MockWikidot's synthetic wiki.
+# It does what a real run does -- list the pages over XML-RPC, fetch the metadata snapshot, work out which pages need work, download them -- twice:
+#   a full crawl into an empty history tree, then (after some pages have been edited) an incremental crawl of the same tree.
+# The incremental crawl works from the metadata snapshot, or with --feed from the recent-changes feed since the full crawl finished.
+# For each it reports pages per hour, revisions per second and requests per page, then summarizes the timing log.
+# The latency of the real site can be simulated with --latency, so the effect of more workers can be measured too.
+#
+# It uses the AJAX engine (WikidotAjax.py), since the Selenium engine needs a Firefox.
+#
+# python Benchmark.py --pages 500 --workers 4 --latency 0.05
+
+site="benchmark"
+
+
+#--------------------------------------------------------
+# Crawl the mock site into historyRoot the way HistoryDownloader does, using the change feed if useFeed (and there's a watermark) and a metadata snapshot otherwise
+# Returns (pages downloaded, revisions downloaded, seconds, requests made)
+def Crawl(mock, historyRoot, numWorkers, useFeed=False):
+    requestsBefore=mock.requests
+    start=time.monotonic()
+    readTime=time.time()
+
+    server=RateLimiter.ServerProxy(mock.xmlrpcUrl)
+    wikiPageNames=server.pages.select({"site": site, "order": "updated_at"})
+    pageNames=[HistoryStore.LocalPageName(name) for name in wikiPageNames]
+    manifest=Manifest.ForRoot(historyRoot)
+    versionsBefore=sum(len(manifest.Versions(p)) for p in pageNames)
+
+    journal=Journal.ForRoot(historyRoot)
+    pagesToDownload=None
+    if useFeed:
+        pagesToDownload=ChangeFeed.WorkListSince(WikidotAjax.AjaxSession(mock.baseUrl), historyRoot, pageNames)
+    if pagesToDownload is None:
+        snapshot=PageMetadata.GetMetadataSnapshot(server, site, historyRoot, wikiPageNames, 0)     # Always fetch a fresh snapshot
+        pagesToDownload=dict.fromkeys(PageMetadata.PagesNeedingWork(snapshot, manifest, pageNames))
+    print("   "+str(len(pagesToDownload))+" of "+str(len(pageNames))+" pages need work")
+    journal.StartRun(readTime, pagesToDownload)
+
+    completed=0
+    if numWorkers > 1:
+        completed=WorkerPool.DownloadPagesInParallel(pagesToDownload, historyRoot, WikidotAjax.DownloadPageHistory, Journal.MarkDone,
+                                                     functools.partial(WikidotAjax.AjaxSession, mock.baseUrl), numWorkers, numWorkers)
+    else:
+        session=WikidotAjax.AjaxSession(mock.baseUrl)
+        for pageName, wanted in pagesToDownload.items():
+            with Timing.Stage("page", pageName) as stage:
+                if WikidotAjax.DownloadPageHistory(session, historyRoot, pageName, False, wanted):
+                    Journal.MarkDone(historyRoot, pageName)
+                    completed=completed+1
+                else:
+                    stage.Fail()
+        session.quit()
+    if completed == len(pagesToDownload):
+        ChangeFeed.WriteWatermark(historyRoot, readTime)
+        journal.EndRun()
+    index=SearchIndex.ForRoot(historyRoot)
+    if index is not None:
+        index.Flush()
+        SearchIndex.Update(historyRoot)
+
+    seconds=time.monotonic()-start
+    revisions=sum(len(manifest.Versions(p)) for p in pageNames)-versionsBefore
+    return len(pagesToDownload), revisions, seconds, mock.requests-requestsBefore
+
+
+#--------------------------------------------------------
+def _Report(name, pages, revisions, seconds, requests):
+    print(name+": "+str(pages)+" pages and "+str(revisions)+" revisions in "+str(round(seconds, 1))+" seconds")
+    print("   "+str(round(pages/seconds*3600))+" pages per hour, "+str(round(revisions/seconds, 1))+" revisions per second, "+
+          str(round(requests/max(pages, 1), 1))+" requests per page")
+
+
+#--------------------------------------------------------
+def Run(numPages, meanRevisions, numWorkers, latency, errorRate, changedFraction, storage, seed, historyRoot=None, keep=False, useFeed=False, maxRate=1000.0):
+    temporary=historyRoot is None
+    if temporary:
+        historyRoot=tempfile.mkdtemp(prefix="HistoryBenchmark-")
+    wiki=MockWikidot.SyntheticWiki(numPages, meanRevisions, seed=seed)
+    mock=MockWikidot.MockWikidotServer(wiki, latency=latency, errorRate=errorRate).Start()
+    print("Benchmarking against "+str(numPages)+" synthetic pages at "+mock.baseUrl+", storing in "+historyRoot)
+    RateLimiter.Configure(maxRate, backoffSeconds=1)     # The mock's 503s are injected at random, not a sign of overload, so don't sit out the usual backoff
+
+    try:
+        HistoryStore.SetStorageFormat(historyRoot, storage)
+        HistoryStore.SetSiteUrl(historyRoot, mock.baseUrl)
+        SearchIndex.SetEnabled(historyRoot, True)
+        Timing.ForRoot(historyRoot)
+
+        _Report("Full crawl", *Crawl(mock, historyRoot, numWorkers))
+
+        # Edit some of the pages, then see how long it takes to catch up
+        rng=random.Random(seed)
+        changed=rng.sample(wiki.names, int(numPages*changedFraction))
+        for name in changed:
+            wiki.AddRevisions(name, rng.randint(1, 3))
+        print(str(len(changed))+" pages edited")
+        _Report("Incremental crawl", *Crawl(mock, historyRoot, numWorkers, useFeed))
+
+        print()
+        Waits.Report()
+        RateLimiter.Report()
+        print()
+        Timing.Summarize(os.path.join(historyRoot, Timing.logFileName))
+    finally:
+        mock.Stop()
+        if temporary and not keep:
+            Manifest.ForRoot(historyRoot).Close()
+            shutil.rmtree(historyRoot, ignore_errors=True)
+
+
+#--------------------------------------------------------
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description="Benchmark the history downloader against a synthetic wiki")
+    parser.add_argument("--pages", type=int, default=200, help="number of pages in the synthetic wiki")
+    parser.add_argument("--revisions", type=float, default=10, help="mean number of revisions per page")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds added to each request")
+    parser.add_argument("--errors", type=float, default=0.0, help="fraction of requests failed with a 503")
+    parser.add_argument("--changed", type=float, default=0.1, help="fraction of pages edited between the full and the incremental crawl")
+    parser.add_argument("--storage", choices=["directories", "pack"], default="directories")
+    parser.add_argument("--feed", action="store_true", help="do the incremental crawl from the recent-changes feed rather than a metadata snapshot")
+    parser.add_argument("--rate", type=float, default=1000.0, help="ceiling on requests per second (a real crawl's is far lower)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--root", help="history directory to use (default: a temporary one)")
+    parser.add_argument("--keep", action="store_true", help="don't delete the temporary history directory afterwards")
+    args=parser.parse_args()
+    Run(args.pages, args.revisions, args.workers, args.latency, args.errors, args.changed, args.storage, args.seed, args.root, args.keep, args.feed, args.rate)
@@ -0,0 +1,168 @@
+import functools
+import RateLimiter
+import Timing
+from selenium import webdriver
+from selenium.common import exceptions as SeEx
+try:
+    import psutil       # Optional: needed only to recycle the browser when its memory grows too large
+except ImportError:
+    psutil=None
+
+# The Firefox used to read the history pages, set up for a long unattended crawl.
+# It runs headless, and loads only what the history pages need: no images, stylesheets, web fonts, media or trackers.
+# (Javascript has to stay on, since the history lists and sources are put on the page by Wikidot's javascript.)
+# A Firefox left running for days grows steadily, so RecyclingBrowser quits it and starts a fresh one every so many pages,
+#   or sooner if its memory passes a threshold, and carries on with the page it was about to load.
+# Page loads go through the rate limit for their site (see RateLimiter.py).
+#
+# The factory made by Factory() can be sent to worker processes (see WorkerPool.py), each of which makes its own browser with it.
+
+# Firefox preferences which stop it loading what we don't need
+_leanPreferences={
+    "permissions.default.image": 2,                 # No images
+    "permissions.default.stylesheet": 2,            # No stylesheets
+    "browser.display.use_document_fonts": 0,        # No web fonts
+    "gfx.downloadable_fonts.enabled": False,
+    "media.autoplay.default": 5,                    # No audio or video
+    "media.autoplay.blocking_policy": 2,
+    "plugin.state.flash": 0,
+    "privacy.trackingprotection.enabled": True,     # No third-party trackers, ads or analytics scripts
+    "privacy.trackingprotection.socialtracking.enabled": True,
+    "browser.cache.disk.enable": False,             # Each page is loaded once, so caching it only costs memory and disk
+    "browser.cache.memory.capacity": 16384,
+    "browser.sessionhistory.max_entries": 2,        # Don't keep earlier pages around for the Back button
+    "browser.sessionhistory.max_total_viewers": 0,
+    "dom.ipc.processCount": 1,                      # One content process rather than one per site
+    "app.update.enabled": False,
+    "datareporting.healthreport.uploadEnabled": False,
+    "toolkit.telemetry.enabled": False,
+}
+
+
+#--------------------------------------------------------
+# Start a Firefox
+def MakeFirefox(headless=True, lean=True):
+    options=webdriver.FirefoxOptions()
+    if headless:
+        options.add_argument("-headless")
+    if lean:
+        for name, value in _leanPreferences.items():
+            options.set_preference(name, value)
+    return webdriver.Firefox(options=options)
+
+
+#--------------------------------------------------------
+# The resident memory (in MB) of a Firefox and all its content processes, or None if it can't be found out
+def MemoryMB(browser):
+    if psutil is None:
+        return None
+    pid=browser.capabilities.get("moz:processID")
+    if pid is None:
+        return None
+    try:
+        process=psutil.Process(pid)
+        return sum(p.memory_info().rss for p in [process]+process.children(recursive=True))/(1024*1024)
+    except psutil.Error:
+        return None
+
+
+class RecyclingBrowser:
+
+    # A browser which is replaced by a fresh one after recyclePages page loads or, if psutil is installed, once it uses more than maxMemoryMB
+    # (Zero for either turns that check off.)
+    # Anything but get(), close() and quit() is passed straight through to the current Firefox
+    def __init__(self, headless=True, lean=True, recyclePages=200, maxMemoryMB=1500):
+        self.headless=headless
+        self.lean=lean
+        self.recyclePages=recyclePages
+        self.maxMemoryMB=maxMemoryMB
+        self.browser=None
+        self.pages=0
+        self._Start()
+        if maxMemoryMB > 0 and psutil is None:
+            print("   psutil isn't installed, so the browser will be recycled by page count only")
+
+    def __getattr__(self, name):
+        return getattr(self.browser, name)
+
+    #--------------------------------------------------------
+    def _Start(self):
+        self.browser=MakeFirefox(self.headless, self.lean)
+        self.pages=0
+
+    #--------------------------------------------------------
+    # Replace the browser with a fresh one.  If resume, go back to the page the old one was showing.
+    def Recycle(self, reason, resume=True):
+        url=None
+        if resume:
+            try:
+                url=self.browser.current_url
+            except SeEx.WebDriverException:
+                pass    # It's probably crashed, which may be why we're here
+        print("   Recycling the browser ("+reason+")")
+        with Timing.Stage("browser recycle"):
+            self._Quit()
+            self._Start()
+        if url is not None and url.startswith("http"):
+            with RateLimiter.ForUrl(url).Request():
+                self.browser.get(url)
+
+    #--------------------------------------------------------
+    # Is it time for a fresh browser?  Returns the reason, or None.
+    def _RecycleReason(self):
+        if self.recyclePages > 0 and self.pages >= self.recyclePages:
+            return "after "+str(self.pages)+" pages"
+        if self.maxMemoryMB > 0:
+            mb=MemoryMB(self.browser)
+            if mb is not None and mb > self.maxMemoryMB:
+                return "using "+str(round(mb))+" MB"
+        return None
+
+    #--------------------------------------------------------
+    # Load a page, first recycling the browser if it's due
+    # If the browser has died, a fresh one is started and the page tried once more
+    def get(self, url):
+        reason=self._RecycleReason()
+        if reason is not None:
+            self.Recycle(reason, resume=False)     # We're about to leave the current page anyway
+        self.pages=self.pages+1
+        try:
+            with RateLimiter.ForUrl(url).Request():
+                self.browser.get(url)
+        except SeEx.WebDriverException as exception:
+            if self._Alive():
+                raise
+            print("***The browser died ("+type(exception).__name__+")")
+            self.Recycle("it died", resume=False)
+            with RateLimiter.ForUrl(url).Request():
+                self.browser.get(url)
+
+    #--------------------------------------------------------
+    def _Alive(self):
+        try:
+            self.browser.current_url
+            return True
+        except SeEx.WebDriverException:
+            return False
+
+    #--------------------------------------------------------
+    def _Quit(self):
+        if self.browser is not None:
+            try:
+                self.browser.quit()
+            except SeEx.WebDriverException:
+                pass
+            self.browser=None
+
+    def quit(self):
+        self._Quit()
+
+    # Closing the only window would leave Firefox running, so close() quits it too
+    def close(self):
+        self._Quit()
+
+
+#--------------------------------------------------------
+# Return a function which makes a browser with these settings.  It can be pickled, and so passed to a worker process.
+def Factory(headless=True, lean=True, recyclePages=200, maxMemoryMB=1500):
+    return functools.partial(RecyclingBrowser, headless, lean, recyclePages, maxMemoryMB)
@@ -0,0 +1,175 @@
+import collections
+import html.parser
+import os
+import re as Regex
+import urllib.parse
+from datetime import datetime, timezone
+import dateutil.parser
+import HistoryStore
+import Manifest
+import Timing
+
+# Incremental updates driven by the site's recent-changes feed.
+# Wikidot's changes/SiteChangesListModule lists every revision made anywhere on the site, newest first, a pager page at a time.
+# Reading it back as far as the time of the last complete update gives the exact work list: each changed page and the numbers of its new revisions.
+# That time -- the watermark -- is kept in historyRoot/dateLastCompleteUpdate.txt.  It's moved forward only when a run has completed every page in its work list.
+#
+# Each item of the feed looks like
+#       <div class="changes-list-item">
+#           <table><tr>
+#               <td class="title"><a href="http://site/page-name">Page Title</a></td>
+#               <td class="flags">(the flags)</td>
+#               <td class="mod-date"><span class="odate time_nnnnnnnnnn ...">date</span></td>
+#               <td class="revision-no">(rev. n)</td>
+#               <td class="mod-by">(the user)</td>
+#           </tr></table>
+#           <div class="comments">(the comment)</div>
+#       </div>
+
+watermarkFileName="dateLastCompleteUpdate.txt"
+overlapSeconds=600      # Read the feed from a little before the watermark, in case our clock and the site's disagree.  (Revisions we already have are skipped anyway.)
+
+# One item of the feed: the page's name as Wikidot knows it, the revision number, and the Unix time of the revision
+Change=collections.namedtuple("Change", ["wikiName", "number", "time"])
+
+
+#--------------------------------------------------------
+# An HTML parser which picks the changes out of the body of the recent-changes list
+class _ChangesParser(html.parser.HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.changes=[]
+        self.pageCount=1
+        self._item=None
+        self._cell=None
+        self._text=""
+
+    def handle_starttag(self, tag, attrs):
+        attrs=dict(attrs)
+        classes=(attrs.get("class") or "").split()
+        if tag == "div" and "changes-list-item" in classes:
+            self._item={}
+        elif tag == "td" and self._item is not None:
+            self._cell=classes[0] if len(classes) > 0 else None
+            self._text=""
+        elif tag == "a" and self._item is not None and self._cell == "title" and "href" in attrs:
+            self._item["wikiName"]=urllib.parse.unquote(urllib.parse.urlsplit(attrs["href"]).path.strip("/").split("/")[0])
+        elif tag == "span" and self._item is not None and self._cell == "mod-date":
+            m=Regex.search(r"\btime_(\d+)", attrs.get("class") or "")
+            if m is not None:
+                self._item["time"]=int(m.group(1))
+        elif tag == "span" and "pager-no" in classes:
+            self._cell="pager-no"
+            self._text=""
+
+    def handle_endtag(self, tag):
+        if tag == "td" and self._item is not None:
+            if self._cell == "revision-no":
+                m=Regex.search(r"(\d+)", self._text)
+                if m is not None:
+                    self._item["number"]=int(m.group(1))
+            self._cell=None
+        elif tag == "table" and self._item is not None:
+            # The item's table is done.  (Its comment follows, but we've no use for it.)
+            if "wikiName" in self._item and "number" in self._item and "time" in self._item:
+                self.changes.append(Change(self._item["wikiName"], self._item["number"], self._item["time"]))
+            self._item=None
+        elif tag == "span" and self._cell == "pager-no":
+            m=Regex.search(r"of\s+(\d+)", self._text)
+            if m is not None:
+                self.pageCount=int(m.group(1))
+            self._cell=None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._text=self._text+data
+
+
+#--------------------------------------------------------
+# Parse the HTML of one pager page of the recent-changes list
+# Return a list of Changes (newest first) and the number of pages in the list's pager
+def ParseChanges(body):
+    parser=_ChangesParser()
+    parser.feed(body)
+    parser.close()
+    return parser.changes, parser.pageCount
+
+
+#--------------------------------------------------------
+# Read the feed back to the Unix time since using session, a WikidotAjax.AjaxSession
+# Returns a dictionary of local page name: set of revision numbers made since then, or None if the feed couldn't be read
+def FetchChanges(session, since, perPage=100):
+    changes={}
+    pagerPage=1
+    while True:
+        with Timing.Stage("change feed") as stage:
+            body=session.GetSiteChanges(pagerPage, perPage)
+            if body is None:
+                stage.Fail()
+                print("***Could not get page "+str(pagerPage)+" of the recent changes")
+                return None
+        items, pageCount=ParseChanges(body)
+        for item in items:
+            if item.time < since:
+                return changes
+            changes.setdefault(HistoryStore.LocalPageName(item.wikiName), set()).add(item.number)
+        if len(items) == 0 or pagerPage >= pageCount:
+            return changes
+        pagerPage=pagerPage+1
+
+
+#--------------------------------------------------------
+# Return the watermark (as a Unix time), or None if there isn't one
+# The file holds a date such as "18 Oct 2026 14:05:00", in UTC.  (Older copies hold just a day, like "1 Jan 1900".)
+def ReadWatermark(historyRoot):
+    path=os.path.join(historyRoot, watermarkFileName)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        text=f.readline().strip()
+    try:
+        return dateutil.parser.parse(text).replace(tzinfo=timezone.utc).timestamp()
+    except (ValueError, OverflowError):
+        print("***Can't make sense of "+watermarkFileName+": "+text)
+        return None
+
+
+#--------------------------------------------------------
+# Move the watermark to the Unix time t
+# It's written to a temporary file which is fsynced and renamed into place, so a crash leaves either the old watermark or the new one
+def WriteWatermark(historyRoot, t):
+    path=os.path.join(historyRoot, watermarkFileName)
+    with open(path+".tmp", "w") as f:
+        f.write(datetime.fromtimestamp(t, tz=timezone.utc).strftime("%d %b %Y %H:%M:%S")+"\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path+".tmp", path)
+    HistoryStore.FsyncDirectory(historyRoot)
+    print("   "+watermarkFileName+" is now "+datetime.fromtimestamp(t, tz=timezone.utc).strftime("%d %b %Y %H:%M:%S"))
+
+
+#--------------------------------------------------------
+# Build the work list for an incremental update from the feed
+# Only pages in pageNames (the pages which exist and aren't being ignored) are included, in the order of pageNames
+# The feed gives only a page's newest revisions, so a page whose history we don't have whole gets None (every version missing) instead:
+#   one never completed (it has no watermark), or with gaps in its versions (such as a page created by renaming another).  A page with gaps is included even if it hasn't changed.
+# Returns a dictionary of page name: set of revision numbers (or None), or None if there's no watermark or the feed couldn't be read
+def WorkListSince(session, historyRoot, pageNames):
+    watermark=ReadWatermark(historyRoot)
+    if watermark is None:
+        return None
+    print("   Reading recent changes since "+datetime.fromtimestamp(watermark, tz=timezone.utc).strftime("%d %b %Y %H:%M:%S"))
+    changes=FetchChanges(session, watermark-overlapSeconds)
+    if changes is None:
+        return None
+    manifest=Manifest.ForRoot(historyRoot)
+    workList={}
+    for p in pageNames:
+        versions=manifest.Versions(p)
+        hasGaps=HistoryStore.LowestVersionNeeded(versions) < len(versions)
+        if hasGaps or (p in changes and manifest.Watermark(p) is None):
+            workList[p]=None
+        elif p in changes:
+            workList[p]=changes[p]
+    return workList
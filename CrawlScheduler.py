@@ -0,0 +1,53 @@
+import collections
+import HistoryStore
+import RateLimiter
+
+# Hands out the pages of several sites' work lists, one at a time, to whoever is downloading them (a worker process, or the main process itself).
+# Each site has its own rate limit (see RateLimiter.py), so rather than finishing one site before starting the next,
+#   the scheduler picks each page from the site whose limit will let a request through soonest, taking the sites in turn when there's nothing to choose between them.
+# So while one site's limit holds its pages back, the browsers get on with another site's.
+#
+# A site is identified by its history tree: each tree records the site it holds (HistoryStore.SiteUrl), and the engines fetch from there.
+
+class CrawlScheduler:
+
+    def __init__(self):
+        self.queues=collections.OrderedDict()      # historyRoot: deque of (page name, revisions wanted), in the order the sites were last served
+        self.limiters={}                            # historyRoot: the site's RateLimiter
+        self.totals={}                              # historyRoot: number of pages added
+
+    #--------------------------------------------------------
+    # Add a site's work list: a dictionary of page name: set of revision numbers wanted (None for all those missing)
+    def Add(self, historyRoot, workList):
+        queue=self.queues.setdefault(historyRoot, collections.deque())
+        queue.extend(workList.items())
+        self.limiters[historyRoot]=RateLimiter.ForUrl(HistoryStore.SiteUrl(historyRoot))
+        self.totals[historyRoot]=self.totals.get(historyRoot, 0)+len(workList)
+
+    #--------------------------------------------------------
+    # The number of pages still to be handed out
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    #--------------------------------------------------------
+    # The number of pages added for a site
+    def Total(self, historyRoot):
+        return self.totals.get(historyRoot, 0)
+
+    #--------------------------------------------------------
+    # Return the next page to download as (historyRoot, page name, revisions wanted), or None if there are none left
+    def Next(self):
+        best=None
+        bestDelay=None
+        for historyRoot, queue in self.queues.items():      # The least recently served site comes first, so wins a tie
+            if len(queue) == 0:
+                continue
+            delay=self.limiters[historyRoot].Delay()
+            if best is None or delay < bestDelay:
+                best=historyRoot
+                bestDelay=delay
+        if best is None:
+            return None
+        self.queues.move_to_end(best)
+        pageName, wanted=self.queues[best].popleft()
+        return best, pageName, wanted
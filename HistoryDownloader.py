@@ -1,20 +1,31 @@
-import re as Regex
-import xml.etree.ElementTree as ET
+import functools
 import os
-import pathlib
-import Helpers
-import urllib.request
-import unidecode
+import sys
 import time
+import Archive
+import Attachments
+import Browser
+import ChangeFeed
+import CrawlScheduler
+import HistoryStore
+import IntegrityScanner
+import Journal
+import Manifest
+import PageMetadata
+import RateLimiter
+import RevisionList
+import SearchIndex
+import Sites
+import Timing
+import VersionWriter
+import Waits
+import WikidotAjax
+import WorkerPool
 from datetime import datetime
 import dateutil
 import dateutil.parser
-from xmlrpc import client
-from selenium import webdriver
+from HttpSession import HttpSession
 from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.common import exceptions as SeEx
 
 # Program to download the complete history of a Wikidot wiki and maintain a local copy.
@@ -59,280 +70,269 @@ from selenium.common import exceptions as SeEx
 #   (The history pages are the result of javascript running and not html, so we can't use Beautiful Soup. We will try to use Selenium, which essentially contains its
 #     own internal web browser.)
 
+# The connections used to download attached files
+_attachmentSession=HttpSession()
+
+# The session used to fetch, by their IDs, the revisions an interrupted run left pending
+_resumeSession=WikidotAjax.AjaxSession()
+
 # Read and save the history of one page.
 # HistoryRoot is root of all history files
-def DownloadPageHistory(browser, historyRoot, pageName, justUpdate):
+# wanted, if given, is the set of revision numbers to fetch (e.g., from the change feed); otherwise every version not yet downloaded is fetched
+# Returns True if the page's history is now complete and the page can be added to the donelist
+def DownloadPageHistory(browser, historyRoot, pageName, justUpdate, wanted=None):
 
-    # Open the Fancy 3 page in the browser
-    browser.get("http://fancyclopedia.org/"+pageName+"/noredirect/t")
+    Timing.ForRoot(historyRoot)
 
-    # Get the first two letters in the page's name
-    # These are used to disperse the page directories among many directotoes so as to avoid having so many subdirectores that Windows Explorer breaks when viewing it
-    d1=pageName[0]
-    d2=d1
-    if len(pageName) > 1:
-        d2=pageName[1]
+    # Open the page in the browser.  (The site is whichever one the tree holds the history of.)
+    siteUrl=HistoryStore.SiteUrl(historyRoot)
+    limiter=RateLimiter.ForUrl(siteUrl)
+    with Timing.Stage("navigate", pageName):
+        browser.get(siteUrl+"/"+pageName+"/noredirect/t")
 
     # Check to see what we have already downloaded.
-    # Any history already downloaded will be in historyRoot/d1/d2/pageName+nnnn, where nnnn is the version number
-    # Read historyRoot/d1/d2 and make a list of the version number of all directories found
-    # The version directories are named Vnnnn
-    pagePath=os.path.join(historyRoot, d1, d2, pageName)
-    existingVersions=[]
-    lowestVersionNeeded=0
-    if os.path.exists(pagePath):
-        existingVersions=[entry for entry in os.scandir(pagePath) if entry.is_dir()] # All the subdirectory objects
-        existingVersions=[entry.name for entry in existingVersions] # Make into a list of subdirectory names
-        existingVersions=[entry[1:] for entry in existingVersions if entry[0]=='V' and len(entry) == 5 and entry[1].isdigit() and entry[2].isdigit() and entry[3].isdigit() and entry[4].isdigit()]
-        existingVersions=[int(entry) for entry in existingVersions] # Convert to number
-        # Now figure out what the lowest version still needed is. (Knowing this may allow us to optimize page loads.)
-        if len(existingVersions) > 0:
-            lowestVersionNeeded=max(existingVersions)+1
-            i=0
-            while i < max(existingVersions)+1:
-                if i not in existingVersions:
-                    lowestVersionNeeded=i   # Mote that this will be max+1 if there are no gaps in the list
-                    break
-                i=i+1
+    # Any history already downloaded will be in historyRoot/d1/d2/pageName/Vnnnn, where nnnn is the version number, and is recorded in the manifest
+    pagePath=HistoryStore.PagePath(historyRoot, pageName)
+    manifest=Manifest.ForRoot(historyRoot)
+    journal=Journal.ForRoot(historyRoot)
+    index=SearchIndex.ForRoot(historyRoot)
+    existingVersions=manifest.Versions(pageName)
+    storage=HistoryStore.StorageFormat(historyRoot)
+    writer=VersionWriter.Shared()
+    lowestVersionNeeded=HistoryStore.LowestVersionNeeded(existingVersions)
 
     print("   First version needed: "+str(lowestVersionNeeded))
     # Page found?
     errortext="The page <em>"+pageName.replace("_", "-")+"</em> you want to access does not exist."
     if errortext in browser.page_source:
         print("*** Page does not exist: "+pageName)
-        return
+        return False
+
+    # Fetch any revisions an interrupted run left pending, by their IDs.  If they're all that was wanted, there's no need to open the history at all.
+    resumed=WikidotAjax.ResumePendingRevisions(_resumeSession.OnSite(siteUrl), historyRoot, pageName, existingVersions, wanted, writer, storage, manifest, journal, index)
+    if resumed is None:
+        return False
+    existingVersions=existingVersions | resumed
+
+    if wanted is None or not wanted <= existingVersions:
+        # Find the history button and press it, and wait until the history list has loaded
+        with Timing.Stage("history button", pageName) as stage, limiter.Request() as request:
+            browser.find_element_by_id('history-button').send_keys(Keys.RETURN)
+            if Waits.WaitFor("history list", lambda: browser.find_element_by_id('revision-list')) is None:
+                stage.Fail()
+                request.Failed()
+                print("***Oops. The history list of "+pageName+" never loaded")
+                return False
+
+        # The history list is shown a page at a time, newest first, with a "pager" -- a series of buttons to show successive pages of history
+        # The first page is showing now.  It tells us the newest revision number and how many revisions there are to a page,
+        # from which we can work out which pages hold the versions we're missing and go straight to them.
+        revisions=ExtractHistoryList(browser, pageName)
+        if revisions is None:
+            print("***Could not get the history list of "+pageName)
+            return False
+        currentPagerPage=1
+        pagerPages=[]
+        if len(revisions) > 0:
+            pagerPages=RevisionList.PagerPagesNeeded(revisions[0].number, len(revisions), existingVersions, wanted)
+
+        for pagerPage in pagerPages:
+            if pagerPage != currentPagerPage:
+                if not GoToPagerPage(browser, pagerPage, limiter):
+                    print("***Oops. Could not get to page "+str(pagerPage)+" of the history of "+pageName)
+                    return False
+                currentPagerPage=pagerPage
+                revisions=ExtractHistoryList(browser, pageName)
+                if revisions is None:
+                    print("***Could not get the history list of "+pageName)
+                    return False
+
+            # Skip those in the list of existing revisions (or which we weren't asked for), and note the rest in the journal before fetching them
+            revisions=[rev for rev in revisions if rev.number not in existingVersions and (wanted is None or rev.number in wanted)]
+            journal.RevisionsPending(pageName, revisions)
+            for rev in revisions:
+                # If the page has been renamed, we may have the revision already under its old name
+                source=manifest.SourceElsewhere(rev.id, pageName)
+
+                # Otherwise click on the view source button for this row and wait for the source to appear
+                # The source area is emptied first, so that we can't mistake the previous revision's source for this one's
+                if source is None:
+                    with Timing.Stage("source", pageName) as stage, limiter.Request() as request:
+                        browser.execute_script(_clickViewSourceScript, rev.id)
+                        source=Waits.WaitFor("source", lambda: browser.execute_script(_sourceTextScript))
+                        if source is None:
+                            stage.Fail()
+                            request.Failed()
+                            print("***Could not get source of "+pageName+" V"+str(rev.number))
+                            return False
+
+                # Hand the version to the writer thread, which records it in the manifest and the journal (and indexes it, if the tree is indexed) once it is safely on disk
+                onCommit=functools.partial(journal.Committed, manifest, pageName, rev.number, rev.id)
+                if index is not None:
+                    onCommit=functools.partial(index.Committed, onCommit, pageName, rev.number, source)
+                writer.Submit(pagePath, rev.number, rev.id, rev.type, rev.user, rev.date, rev.comment, source, storage, onCommit)
+
+    # Download the files currently attached to this page (or at least those which are new or changed)
+    # Find the files button and press it, and wait for the file list to appear in the (emptied) action area
+    with Timing.Stage("attachments", pageName) as stage:
+        browser.execute_script(_clearActionAreaScript)
+        with limiter.Request() as request:
+            browser.find_element_by_id('files-button').send_keys(Keys.RETURN)
+            table=Waits.WaitFor("file list", lambda: browser.execute_script(_fileTableScript))
+            if table is None:
+                request.Failed()
+        if table is None:
+            stage.Fail()
+            print("***Oops. The file list of "+pageName+" never loaded")
+            return False
+        if not Attachments.SyncAttachments(_attachmentSession, siteUrl, pagePath, pageName, Attachments.ParseFileTable(table), manifest):
+            stage.Fail()
+            print("***Could not download all the files attached to "+pageName)
+            return False
+
+    # The page isn't complete until all its versions are on disk
+    with Timing.Stage("flush", pageName):
+        writer.Flush()
+
+    # The caller is responsible for adding the page to the donelist, since when running several browsers at once only one process may write it
+    return True
 
-    # Find the history button and press it
-    browser.find_element_by_id('history-button').send_keys(Keys.RETURN)
-    time.sleep(0.5)     # Just-in-case
 
-    # Wait until the history list has loaded
-    try:
-        WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.ID, 'revision-list')))
-    except:
-        print("***Oops. Exception while waiting for the history list to load in "+pageName+":  Retrying")
-        WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.ID, 'revision-list')))
-
-    # Step over the pages of history lines (if any)
-    # The pages are a series of spans creating a series of boxes, each with a number in it.  There is a box labeled "current" and we want to click on the *next* box.
-    firstTime=True
-    terminate=False
-    while not terminate:
-
-        # There may be a "pager" -- a series of buttons to show successive pages of history
-        try:
-            pagerDiv=browser.find_element_by_xpath('//*[@id="revision-list"]/div')
-        except SeEx.NoSuchElementException:
-            pagerDiv=None
-        except:
-            print("***Oops. Exception while looking for pager div in "+pageName)
-            return
-
-        if pagerDiv == None and not firstTime:
-            break
-
-        # If there are multiple pages of history, then before starting the second and subsequent loops, we need to go to the next page
-        if pagerDiv != None and not firstTime:
-            # Find the current page indicator
-            els=pagerDiv.find_elements_by_tag_name("span")
-            # And click the *next*, if any, to go to the next page
-            for i in range(0, len(els)):
-                if els[i].get_attribute("class") == "current":
-                    if i+1 < len(els):
-                        els[i+1].find_element_by_tag_name("a").send_keys(Keys.RETURN)
-                    else:
-                        terminate=True
-                    break
-            if terminate:
-                break
+#--------------------------------------------------------
+# Add a page to a work list, wanting the revisions in wanted (None for all those missing) as well as any it wants already
+def AddToWorkList(workList, pageName, wanted):
+    if pageName not in workList:
+        workList[pageName]=wanted
+    elif workList[pageName] is not None:
+        workList[pageName]=None if wanted is None else workList[pageName] | wanted
 
-        firstTime=False
-
-        # Get the history list
-        historyElements, id=ExtractHistoryList(browser)
-
-        # Note that the history list is from newest to oldest, but we don't care since we traverse them all
-        # The structure of a line is
-        #       The revision number followed by a "."
-        #       A series of single letters (these letters label buttons)
-        #       The name of the person who updated it
-        #       The date
-        #       An optional comment
-        # This calls for a Regex
-        rec=Regex.compile("^"  # Start at the beginning
-                          "(\d+)."  # Look for a number at least one digit long followed by a period and space
-                          "( [A-UW-Z]| [A-Z] [A-UW-Z]|)?"  # Look for a single capital letter or two separated by spaces or this could be missing
-                                                        # We skip the V as the final letter to avoid conflict with the next pattern
-                          "( V S R | V S )"  # Look for either ' V S ' or ' V S R '
-                          "(.*)"  # Look for a name
-                          "(\d+ [A-Za-z]{3,3} 2\d{3,3})"  # Look for a date in the 2000s of the form 'dd mmm yyyy'
-                          "(.*)$")  # Look for an optional comment
-
-        #TODO: Don't load earlier history pages unless we need to.
-        i=0
-        while i < len(historyElements):  # We do this kludge because we need to continually refresh historyElements. While it may become stale, at least it doesn't change size
-            # Regenerate the history list, as it may have become stale
-            # This while loop, et al, is to allow retries since sometimes it doesn't seem to load in time
-            historyElements=None
-            count=0
-            gps=None
-            while (historyElements==None or gps is None) and count<5:
-                try:
-                    historyElements=browser.find_element_by_xpath('//*[@id="revision-list"]/table/tbody').find_elements_by_xpath("tr")
-                    time.sleep(0.1)
-                    id=historyElements[i+1].get_attribute("id").replace("revision-row-", "")   # This code is here just to trigger an exception if not loaded fully
-                    t=historyElements[i+1].text   # This code is here just to trigger an exception if not loaded fully
-                    historyElements=historyElements[1:]  # The first row is column headers, so skip them.
-
-                    el=historyElements[i]
-                    id=el.get_attribute("id").replace("revision-row-", "")
-                    t=el.text
-                    # print("t='"+t+"'")
-                    m=rec.match(t)
-                    gps=m.groups()
-                    if gps == None:
-                        print("***gps is None")
-                    if len(gps) < 5:
-                        print("***gps is too short")
-                    user=gps[3]
-                except Exception as exception:
-                    # Wait and try again
-                    time.sleep(1)
-                    count=count+1
-                    print("... Retrying historyElements(2): "+type(exception).__name__+"  count="+str(count))
-            if historyElements==None and count>=5:
-                print("***Could not get historyElements(2) after five tries.")
-            if gps==None:
-                print("***gps is None (2)")
-
-            # Get the revision number.  Skip it if it's in the list of existing revisions
-            revNum=gps[0]
-            if int(revNum) not in existingVersions:
-
-                # The Regex greedy capture of the user name captures the 1st digit of 2-digit dates.  This shows up as the user name ending in a space followed by a single digit.
-                # Fix this if necessary
-                user=gps[3]
-                date=gps[4]
-                if user[-2:-1]==" " and user[-1:].isdigit():
-                    date=user[-1:]+gps[4]
-                    user=user[:-2]
-
-                # Click on the view source button for this row
-                el.find_elements_by_tag_name("td")[3].find_elements_by_tag_name("a")[1].click()
-                # This while loop, et al, is to allow retries since sometimes it doesn't seem to load in time
-                divRevList=None
-                count=0
-                while divRevList == None and count < 5:
-                    try:
-                        divRevList=browser.find_element_by_xpath('//*[@id="revision-list"]/table/tbody')
-                    except SeEx.NoSuchElementException:
-                        # Wait and try again
-                        time.sleep(1)
-                        count=count+1
-                if divRevList == None and count >= 5:
-                    print("***Could not get divRevList after five tries.")
-
-                source=None
-                count=0
-                while source == None and count < 5:
-                    try:
-                        source=divRevList.find_element_by_xpath('//*[@id="history-subarea"]/div').text
-                    except (SeEx.NoSuchElementException, SeEx.StaleElementReferenceException):
-                        # Wait and try again
-                        time.sleep(1)
-                        count=count+1
-                if source == None and count >= 5:
-                    print("***Could not get source after five tries.")
-                del divRevList
-
-                # Write out the xml data
-                root=ET.Element("data")
-                el=ET.SubElement(root, "number")
-                number=str(gps[0])
-                el.text=number
-                el=ET.SubElement(root, "ID")
-                el.text=str(id)
-                el=ET.SubElement(root, "type")
-                el.text=str(gps[1])
-                el=ET.SubElement(root, "name")
-                el.text=str(user)
-                el=ET.SubElement(root, "date")
-                el.text=str(date)
-                el=ET.SubElement(root, "comment")
-                el.text=str(gps[5])
-                # And write the xml out to file <localName>.xml.
-                tree=ET.ElementTree(root)
-
-                # OK, we have everything.  Start writing it out.
-
-                # Make sure the target directory exists
-                seq=("0000"+number)[-4:]    # Add leading zeroes
-                dir=os.path.join(pagePath, "V"+seq)
-                pathlib.Path(dir).mkdir(parents=True, exist_ok=True)
-
-                print("    Loaded V"+seq)
-
-                # Write the directory contents
-                tree.write(os.path.join(dir, "metadata.xml"))
-                with open(os.path.join(dir, "source.txt"), 'a') as file:
-                    file.write(unidecode.unidecode_expect_nonascii(source))
-
-            i=i+1
-
-        # The history pages are loaded recent (highest version number) first.
-        # Check to see if subsequent pages could *possibly* have a version we need.
-        # If not, end the loop over pages of history lists.
-        if int(revNum) < lowestVersionNeeded:
-            break;
-
-    # Download the files currently attached to this page
-    # Find the files button and press it
-    #TODO: Avoid downloading files which already have been downloaded.
-    elem=browser.find_element_by_id('files-button')
-    elem.send_keys(Keys.RETURN)
-    time.sleep(0.7)     # Just-in-case
-
-    # Wait until the history list has loaded
-    wait=WebDriverWait(browser, 10)
-    #wait.until(EC.presence_of_element_located((By.CLASS_NAME, 'page-files')))
-    try:
-        els=browser.find_element_by_class_name("page-files").find_elements_by_tag_name("tr")
-        for i in range(1, len(els)):
-            h=els[i].get_attribute("outerHTML")
-            url, linktext=Helpers.GetHrefAndTextFromString(h)
-            urllib.request.urlretrieve("http://fancyclopedia.org"+url, os.path.join(os.path.join(pagePath, linktext)))
-        print("      "+str(len(els)-1), " files downloaded.")
-    except:
-        k=0
 
-    # Update the donelist
+#--------------------------------------------------------
+# Record that a page's history has been completely downloaded
+def AppendToDonelist(historyRoot, pageName):
     with open(os.path.join(historyRoot, "donelist.txt"), 'a') as file:
         file.write(pageName+"\n")
+    Journal.MarkDone(historyRoot, pageName)
 
-    return
 
+#--------------------------------------------------------
+# Javascript which returns every row of the revision list in one call, rather than one WebDriver round trip per cell
+# Each row is returned as its revision ID, the text of each of its cells, and the Unix time of the edit (which the date cell carries in a class named time_nnnnnnnnnn)
+_extractRowsScript='''
+var rows=document.querySelectorAll('#revision-list table tr[id^="revision-row-"]');
+var out=[];
+for (var i=0; i<rows.length; i++) {
+    var tds=rows[i].getElementsByTagName('td');
+    var cells=[];
+    for (var j=0; j<tds.length; j++)
+        cells.push(tds[j].textContent);
+    var odate=rows[i].querySelector('span.odate');
+    var m=odate ? /time_(\\d+)/.exec(odate.className) : null;
+    out.push({id: rows[i].id.replace('revision-row-', ''), cells: cells, time: m ? m[1] : null});
+}
+return out;
+'''
+
+# Javascript to click the "view source" (S) button of the row of a revision ID, first emptying the area where the source will appear
+_clickViewSourceScript='''
+var area=document.getElementById('history-subarea');
+if (area)
+    area.innerHTML='';
+document.getElementById('revision-row-'+arguments[0]).getElementsByTagName('td')[3].getElementsByTagName('a')[1].click();
+'''
+
+# Javascript which returns the text of the source being viewed, or null if it hasn't appeared yet
+_sourceTextScript='''
+var div=document.querySelector('#history-subarea div');
+return div ? div.innerText : null;
+'''
+
+# Javascript to empty the action area, where both the history list and the file list appear
+_clearActionAreaScript='''
+var area=document.getElementById('action-area');
+if (area)
+    area.innerHTML='';
+'''
+
+# Javascript which returns the HTML of the file list, '' if the action area has loaded and there are no files, or null if it hasn't loaded yet
+_fileTableScript='''
+var table=document.querySelector('table.page-files');
+if (table)
+    return table.outerHTML;
+var area=document.getElementById('action-area');
+return (area && area.textContent.trim().length > 0) ? '' : null;
+'''
 
-def ExtractHistoryList(browser):
-    # This while loop, et al, is to allow retries since sometimes it doesn't seem to load in time
-    count=0
-    while count<5:
-        try:
-            historyElements=browser.find_element_by_xpath('//*[@id="revision-list"]/table/tbody').find_elements_by_xpath("tr")
-            id=historyElements[-1].get_attribute("id").replace("revision-row-", "")  # Just here to trigger an exception if not loaded completely
-            t=historyElements[-1].text  # Just here to trigger an exception if page was not loaded completely and the above data was stale
-
-            historyElements=historyElements[1:]  # The first row is column headers, so skip them.
-            return historyElements, id
-
-        except Exception as exception:
-            # Wait and try again
-            time.sleep(1)
-            count=count+1
-            print("... Retrying historyElements(2): "+type(exception).__name__+"  count="+str(count))
-    if historyElements==None and count>=5:
-        print("***Could not get historyElements after five tries.")
+#--------------------------------------------------------
+# Javascript to go towards page n of the revision list's pager
+# The pager only shows buttons for pages near the current one, so click the button for page n if it's showing and otherwise the showing page closest to it.
+# Returns the page number clicked, or null if there's nothing to click
+_clickPagerScript='''
+var want=arguments[0];
+var links=document.querySelectorAll('#revision-list div.pager span.target a');
+var best=null, bestNum=null;
+for (var i=0; i<links.length; i++) {
+    var n=parseInt(links[i].textContent.trim(), 10);
+    if (isNaN(n))
+        continue;
+    if (bestNum === null || Math.abs(n-want) < Math.abs(bestNum-want)) {
+        best=links[i];
+        bestNum=n;
+    }
+}
+if (best === null)
+    return null;
+best.click();
+return bestNum;
+'''
+
+# Javascript which returns the number of the revision list page currently showing
+_currentPagerPageScript='''
+var cur=document.querySelector('#revision-list div.pager span.current');
+return cur ? parseInt(cur.textContent.trim(), 10) : 1;
+'''
 
-    return None, 0
+#--------------------------------------------------------
+# Move the revision list to page pagerPage, jumping through the pager as few times as possible, each jump waiting its turn under limiter
+# Returns True if we got there
+def GoToPagerPage(browser, pagerPage, limiter):
+    for hop in range(50):    # Even a very long history shouldn't need this many jumps
+        if browser.execute_script(_currentPagerPageScript) == pagerPage:
+            return True
+        with limiter.Request() as request:
+            clicked=browser.execute_script(_clickPagerScript, pagerPage)
+            if clicked is None:
+                return False
+            if Waits.WaitFor("pager", lambda: True if browser.execute_script(_currentPagerPageScript) == clicked else None) is None:
+                request.Failed()
+                return False
+    return False
+
+
+#--------------------------------------------------------
+# Return the revision list currently displayed as a list of RevisionList.Revisions, newest first, or None if it can't be had
+# The rows arrive in a burst, so wait until there are some and their number has stopped changing
+def ExtractHistoryList(browser, pageName=None):
+    lastCount=[0]
+    def SettledRows():
+        rows=browser.execute_script(_extractRowsScript)
+        if len(rows) > 0 and len(rows) == lastCount[0]:
+            return rows
+        lastCount[0]=len(rows)
+        return None
+
+    with Timing.Stage("history list", pageName) as stage:
+        rows=Waits.WaitFor("history rows", SettledRows)
+        if rows is None:
+            stage.Fail()
+            return None
+    revisions=[]
+    for row in rows:
+        cells=row["cells"]
+        if row["time"] is not None:
+            cells[5]=RevisionList.FormatTimestamp(row["time"])
+        revisions.append(RevisionList.RevisionFromCells(row["id"], cells))
+    return revisions
 
 
 
@@ -340,9 +340,18 @@ def ExtractHistoryList(browser):
 # Read and save the history of one page.
 # Directory is root of all history
 def GetPageDate(browser, directory, pageName):
+    Timing.ForRoot(directory)
+    with Timing.Stage("page date", pageName) as stage:
+        date=_GetPageDate(browser, HistoryStore.SiteUrl(directory), pageName)
+        if date is None:
+            stage.Fail()
+    return date
+
+
+def _GetPageDate(browser, siteUrl, pageName):
 
-    # Open the Fancy 3 page in the browser
-    browser.get("http://fancyclopedia.org/"+pageName+"/noredirect/t")
+    # Open the page in the browser
+    browser.get(siteUrl+"/"+pageName+"/noredirect/t")
 
     # Page found?
     errortext="The page <em>"+pageName.replace("_", "-")+"</em> you want to access does not exist."
@@ -380,104 +389,256 @@ def GetPageDate(browser, directory, pageName):
 #===================================================================================
 #  Do it!
 
-# Settings
-historyDirectory="I:\Fancyclopedia History"
-ignorePages=[]      # Names of pages to be ignored
-ignorePagePrefixes=["system_", "index_", "forum_", "admin_", "search_"]     # Prefixes of names of pages to be ignored
-
-# Instantiate the web browser Selenium will use
-browser=webdriver.Firefox()
-
-# Get the magic URL for api access
-url=open("url.txt").read()
-
-# Now, get list of recently modified pages.  It will be ordered from least-recently-updated to most.
-# (We're using composition, here.)
-print("Get list of all pages from Wikidot, sorted from most- to least-recently-updated")
-listOfAllWikiPages=client.ServerProxy(url).pages.select({"site" : "fancyclopedia", "order": "updated_at"})
-listOfAllWikiPages=[name.replace(":", "_", 1) for name in listOfAllWikiPages]   # ':' is used for non-standard namespaces on wiki. Replace the first ":" with "_" in all page names because ':' is invalid in Windows file names
-listOfAllWikiPages=[name if name != "con" else "con-" for name in listOfAllWikiPages]   # Handle the "con" special case
-
-# Remove the skipped pages from the list of pages
-for prefix in ignorePagePrefixes:
-    listOfAllWikiPages=[p for p in listOfAllWikiPages if not p.startswith(prefix) ]
-listOfAllWikiPages=[p for p in listOfAllWikiPages if p not in ignorePages]
-
-# Get the list of individual pages to be skipped, one page name per line
-# If donelist.txt is empty or does not exist, no pages will be skipped
-skipPages=[]
-if os.path.exists(os.path.join(historyDirectory, "donelist.txt")):
-    with open(os.path.join(historyDirectory, "donelist.txt")) as f:
-        skipPages = f.readlines()
-skipPages = [x.strip() for x in skipPages]  # Remove trailing '\n'
-
-# The problem is how to skip looking at the 24,000+ pages which which have not been updated when doing an incremental update.
-# We have the time of last update.
-# We have a list of pages from Wikidot sorted by time of last update, but no dates associated.
-# At a substantial expense, we can check get the date of last update from the wiki for any page.
-# So the strategy is to start with the oldest page and do a binary search for the last page updated *before* the date of last update.
-
-# Load the date of last complete update
-dlcu=None
-if os.path.exists(os.path.join(historyDirectory, "dateLastCompleteUpdate.txt")):
-    with open(os.path.join(historyDirectory, "dateLastCompleteUpdate.txt")) as f:
-        dlcu = f.readline()
-if dlcu == None:
-    dlcu="1 Jan 1900"
-    print("*** No dateLastCompleteUpdate.txt file found in "+historyDirectory)
-dateLastCompleteUpdate=dateutil.parser.parse(dlcu, default=datetime(1, 1, 1))
-
-del dlcu
-
-print("   Date of last compete update is "+str(dateLastCompleteUpdate))
-
-# Find the name of the oldest file newer than this date.  This will be the first file that needs updating.
-# We do this using a binary search of the list of pages sorted by date gotten from Wikidot
-upperindex=len(listOfAllWikiPages)-1
-dateupperindex=GetPageDate(browser, historyDirectory, listOfAllWikiPages[upperindex])
-print("   "+listOfAllWikiPages[upperindex]+" at upperindex "+str(upperindex)+" was last updated "+str(dateupperindex))
-
-lowerindex=0
-datelowerindex=GetPageDate(browser, historyDirectory, listOfAllWikiPages[lowerindex])
-print("   "+listOfAllWikiPages[lowerindex]+" at index "+str(lowerindex)+" was last updated "+str(datelowerindex))
-
-# Do a binary search of the list looking for the last page which was fully downloaded.
-while True:
-    index=int((upperindex+lowerindex)/2)
-    pname=listOfAllWikiPages[index]
-    date=GetPageDate(browser, historyDirectory, pname)
-    print("   "+pname+" at index " + str(index)+" was last updated "+str(date))
-
-    if date < dateLastCompleteUpdate:
-        lowerindex=index
-        datelowerindex=date
-    else:
-        upperindex=index
-        dateupperindex=date
-
-    if upperindex-lowerindex == 1:
-        break
-
-print(str(len(listOfAllWikiPages)-index)+" pages' histories to be downloaded.")
-del lowerindex, datelowerindex, upperindex, dateupperindex, date, index
-
-count=0
-startPage=pname     # This lets us restart without going back to the beginning. (We can also override this to start at any desired page.)
-foundStarter=False
-for pageName in listOfAllWikiPages:
-    count=count+1
-    if pageName == startPage:
-        foundStarter=True
-    if not foundStarter:
-        continue
-
-    if pageName in skipPages:   # This lets us skip specific pages if we wish
-        continue
-
-    print("   Getting: "+pageName)
-    DownloadPageHistory(browser, historyDirectory, pageName, False)
-    if count > 0 and count%100 == 0:
-        print("*** "+str(count))
+if __name__ == "__main__":
+    # Settings
+    # The sites themselves -- their URLs, XML-RPC keys, history directories and pages to ignore -- are in sites.json (see Sites.py)
+    numBrowsers=1       # Number of browsers (each in its own process) to download page histories with
+    maxBrowsers=8       # Cap on numBrowsers, so a typo doesn't launch a hundred copies of Firefox
+    fetchEngine="selenium"      # How to fetch the histories: "selenium" drives Firefox through the history pages; "ajax" calls Wikidot's AJAX modules directly and needs no browser
+    useChangeFeed=True          # Once there's a dateLastCompleteUpdate.txt, get the exact pages and revisions to download from the site's recent changes
+    useMetadataSnapshot=True    # Otherwise, decide which pages need work from XML-RPC metadata rather than by a binary search using the browser
+    metadataMaxAgeHours=12      # How old a cached metadata snapshot may be before it is refetched
+    storageFormat="directories"     # How to store versions: "directories" (a Vnnnn directory for each) or "pack" (all of a page's versions delta-compressed in one file)
+    updateSearchIndex=True      # Keep a full-text index of every version (in the search directory) which SearchIndex.py can query
+    updateArchive=True          # Bring archive.db (the indexed archive which Archive.py queries) up to date at the end of the run
+    rebuildManifest=False       # Re-read the manifest of downloaded versions from the history tree before starting (needed only if the tree has been changed by hand)
+    headlessBrowser=True        # Run Firefox without a window
+    leanBrowser=True            # Stop Firefox loading images, stylesheets, fonts, media and trackers, none of which the history pages need
+    recycleBrowserPages=200     # Replace the browser with a fresh one after this many pages (0 for never)...
+    recycleBrowserMemoryMB=1500     # ...or once it uses more than this much memory (0 for never; needs psutil)
+    maxRequestsPerSecond=4.0    # The ceiling on requests to hosts other than the sites (such as the XML-RPC API), by all browsers and workers together.  The rate actually used adapts to how the host is coping.
+
+    sites=Sites.Load()
+    if sites is None:
+        print("***No usable site configuration, so there's nothing to do")
+        sys.exit(1)
+
+    # Every request, from whichever process, goes through its site's limiter, or for any other host, the default one
+    RateLimiter.Configure(maxRequestsPerSecond)
+    for site in sites:
+        RateLimiter.Configure(site.maxRequestsPerSecond, host=Sites.Host(site))
+
+    # The web browser Selenium will use.  It's only started if something needs it.
+    browser=None
+    firefoxFactory=Browser.Factory(headlessBrowser, leanBrowser, recycleBrowserPages, recycleBrowserMemoryMB)
+
+    # Work out what each site needs doing.  Nothing is downloaded until every site's work list is ready.
+    scheduler=CrawlScheduler.CrawlScheduler()
+    readTimes={}
+    for site in sites:
+        historyDirectory=site.historyRoot
+        print("Site "+site.name+" ("+site.baseUrl+"), kept in "+historyDirectory)
+
+        # The time this run started.  If the run completes every page it sets out to do, this becomes the new date of last complete update.
+        readTime=time.time()
+
+        # The magic URL for api access
+        server=RateLimiter.ServerProxy(site.xmlrpcUrl)
+
+        # Now, get list of recently modified pages.  It will be ordered from least-recently-updated to most.
+        # (We're using composition, here.)
+        print("Get list of all pages from Wikidot, sorted from most- to least-recently-updated")
+        wikiPageNames=server.pages.select({"site" : site.name, "order": "updated_at"})
+        listOfAllWikiPages=[HistoryStore.LocalPageName(name) for name in wikiPageNames]
+        wikiNameOf=dict(zip(listOfAllWikiPages, wikiPageNames))
+
+        HistoryStore.SetStorageFormat(historyDirectory, storageFormat)
+        HistoryStore.SetSiteUrl(historyDirectory, site.baseUrl)
+        Timing.ForRoot(historyDirectory)      # (The timings of the whole run go in the first site's directory)
+        manifest=Manifest.ForRoot(historyDirectory)
+        if rebuildManifest and not manifest.created:
+            manifest.Rebuild()
+
+        # Remove the skipped pages from the list of pages
+        for prefix in site.ignorePrefixes:
+            listOfAllWikiPages=[p for p in listOfAllWikiPages if not p.startswith(prefix) ]
+        listOfAllWikiPages=[p for p in listOfAllWikiPages if p not in site.ignorePages]
+
+        # The work list: a dictionary of the pages to download and, for each, the set of revisions wanted (None for all those we don't have)
+        journal=Journal.ForRoot(historyDirectory)
+        pagesToDownload=None
+
+        if useChangeFeed:
+            # Read the recent changes since the date of last complete update.  This gives exactly the new revisions of each page.
+            pagesToDownload=ChangeFeed.WorkListSince(WikidotAjax.AjaxSession(site.baseUrl), historyDirectory, listOfAllWikiPages)
+            if pagesToDownload is not None:
+                print(str(len(pagesToDownload))+" pages with "+str(sum(len(r) for r in pagesToDownload.values() if r is not None))+" new revisions to be downloaded.")
+
+        if pagesToDownload is None and useMetadataSnapshot:
+            # Get updated_at and the revision count for every page through the XML-RPC API and work out from that alone which pages need work
+            snapshot=PageMetadata.GetMetadataSnapshot(server, site.name, historyDirectory, [wikiNameOf[p] for p in listOfAllWikiPages], metadataMaxAgeHours)
+            pagesToDownload=dict.fromkeys(PageMetadata.PagesNeedingWork(snapshot, manifest, listOfAllWikiPages))
+            # A cached snapshot may be hours old, and edits made since it was fetched aren't in this work list, so the watermark mustn't pass them by
+            readTime=min(readTime, PageMetadata.SnapshotTime(historyDirectory) or readTime)
+            print(str(len(pagesToDownload))+" pages' histories to be downloaded.")
+        elif pagesToDownload is None:
+            # The problem is how to skip looking at the 24,000+ pages which which have not been updated when doing an incremental update.
+            # We have the time of last update.
+            # We have a list of pages from Wikidot sorted by time of last update, but no dates associated.
+            # At a substantial expense, we can check get the date of last update from the wiki for any page.
+            # So the strategy is to start with the oldest page and do a binary search for the last page updated *before* the date of last update.
+
+            # Load the date of last complete update
+            dlcu=None
+            if os.path.exists(os.path.join(historyDirectory, "dateLastCompleteUpdate.txt")):
+                with open(os.path.join(historyDirectory, "dateLastCompleteUpdate.txt")) as f:
+                    dlcu = f.readline()
+            if dlcu == None:
+                dlcu="1 Jan 1900"
+                print("*** No dateLastCompleteUpdate.txt file found in "+historyDirectory)
+            dateLastCompleteUpdate=dateutil.parser.parse(dlcu, default=datetime(1, 1, 1))
+
+            del dlcu
+
+            print("   Date of last compete update is "+str(dateLastCompleteUpdate))
+
+            # Instantiate the web browser Selenium will use, unless an earlier site has already
+            if browser is None:
+                browser=firefoxFactory()
+
+            # Find the name of the oldest file newer than this date.  This will be the first file that needs updating.
+            # We do this using a binary search of the list of pages sorted by date gotten from Wikidot
+            upperindex=len(listOfAllWikiPages)-1
+            dateupperindex=GetPageDate(browser, historyDirectory, listOfAllWikiPages[upperindex])
+            print("   "+listOfAllWikiPages[upperindex]+" at upperindex "+str(upperindex)+" was last updated "+str(dateupperindex))
+
+            lowerindex=0
+            datelowerindex=GetPageDate(browser, historyDirectory, listOfAllWikiPages[lowerindex])
+            print("   "+listOfAllWikiPages[lowerindex]+" at index "+str(lowerindex)+" was last updated "+str(datelowerindex))
+
+            # Do a binary search of the list looking for the last page which was fully downloaded.
+            while True:
+                index=int((upperindex+lowerindex)/2)
+                pname=listOfAllWikiPages[index]
+                date=GetPageDate(browser, historyDirectory, pname)
+                print("   "+pname+" at index " + str(index)+" was last updated "+str(date))
+
+                if date < dateLastCompleteUpdate:
+                    lowerindex=index
+                    datelowerindex=date
+                else:
+                    upperindex=index
+                    dateupperindex=date
+
+                if upperindex-lowerindex == 1:
+                    break
 
+            print(str(len(listOfAllWikiPages)-index)+" pages' histories to be downloaded.")
+            del lowerindex, datelowerindex, upperindex, dateupperindex, date, index
+
+            startPage=pname     # This lets us restart without going back to the beginning. (We can also override this to start at any desired page.)
+            foundStarter=False
+            pagesToDownload={}
+            for pageName in listOfAllWikiPages:
+                if pageName == startPage:
+                    foundStarter=True
+                if not foundStarter:
+                    continue
+                pagesToDownload[pageName]=None      # Even a page completed before is looked at, as it may have been edited since
+
+        # If the last run stopped before finishing, add the pages it didn't get to (those still on the site), and carry over the revisions it had listed
+        #   but not saved, so they're fetched directly by their IDs.  (Its work is added to what's found afresh rather than replacing it,
+        #   so a page which keeps failing can't stop new edits being found.  The watermark stays put until a run completes everything.)
+        unfinished=Journal.LoadUnfinished(historyDirectory)
+        pending={}
+        if unfinished is not None:
+            listed=set(listOfAllWikiPages)
+            carried=[p for p in unfinished.workList if p in listed]
+            for pageName in carried:
+                AddToWorkList(pagesToDownload, pageName, unfinished.workList[pageName])
+            pending=dict((p, revs) for p, revs in unfinished.pending.items() if p in listed)
+            print("Resuming the unfinished run: "+str(len(carried))+" of its pages' histories added.")
+
+        # Add the repairs found by IntegrityScanner.py, if it has been run since the last run
+        problems=IntegrityScanner.LoadRepairs(historyDirectory)
+        if problems is not None:
+            repairs=IntegrityScanner.PrepareRepairs(historyDirectory, problems)
+            for pageName, numbers in repairs.items():
+                AddToWorkList(pagesToDownload, pageName, numbers)
+            print(str(sum(len(n) for n in repairs.values()))+" versions of "+str(len(repairs))+" pages to be repaired.")
+
+        SearchIndex.SetEnabled(historyDirectory, updateSearchIndex)
+
+        # Write the work list to the journal before starting on it, so that if this run is interrupted the next can resume it
+        journal.StartRun(readTime, pagesToDownload, pending)
+        IntegrityScanner.RepairsTaken(historyDirectory)
+
+        # Hand the site's work to the scheduler, which interleaves the pages of all the sites
+        readTimes[historyDirectory]=readTime
+        scheduler.Add(historyDirectory, pagesToDownload)
+
+    # Pick the engine used to download the histories.  Both have the same signature, with an AjaxSession standing in for the browser in the ajax engine.
+    if fetchEngine == "ajax":
+        downloadFn=WikidotAjax.DownloadPageHistory
+        browserFactory=WikidotAjax.AjaxSession
+    else:
+        downloadFn=DownloadPageHistory
+        browserFactory=firefoxFactory
 
-browser.close()
\ No newline at end of file
+    # Download the pages of all the sites, in the order the scheduler hands them out
+    count=0
+    completed={}    # historyRoot: number of pages completed
+    if numBrowsers > 1:
+        # The local browser (if any) is no longer needed.  Each worker process starts its own.
+        if browser is not None:
+            browser.close()
+            browser=None
+        completed=WorkerPool.Crawl(scheduler, downloadFn, AppendToDonelist, browserFactory, numBrowsers, maxBrowsers)
+    else:
+        if fetchEngine == "ajax":
+            fetcher=WikidotAjax.AjaxSession()
+        else:
+            if browser is None:
+                browser=firefoxFactory()
+            fetcher=browser
+        while True:
+            task=scheduler.Next()
+            if task is None:
+                break
+            historyDirectory, pageName, wanted=task
+            count=count+1
+            print("   Getting: "+pageName)
+            with Timing.Stage("page", pageName) as stage:
+                # One page going wrong mustn't stop the run, and with it every site's
+                try:
+                    ok=downloadFn(fetcher, historyDirectory, pageName, False, wanted)
+                except Exception as exception:
+                    print("***"+type(exception).__name__+" while downloading "+pageName+": "+str(exception))
+                    ok=False
+                if ok:
+                    AppendToDonelist(historyDirectory, pageName)
+                    completed[historyDirectory]=completed.get(historyDirectory, 0)+1
+                else:
+                    stage.Fail()
+                    print("***Page not completed: "+pageName)
+            if count > 0 and count%100 == 0:
+                print("*** "+str(count))
+
+    if browser is not None:
+        browser.close()
+
+    for site in sites:
+        historyDirectory=site.historyRoot
+        print("Site "+site.name+": "+str(completed.get(historyDirectory, 0))+" of "+str(scheduler.Total(historyDirectory))+" pages completed")
+
+        # Move the date of last complete update forward only if everything was done; otherwise the next run must look again from the old one
+        if completed.get(historyDirectory, 0) == scheduler.Total(historyDirectory):
+            ChangeFeed.WriteWatermark(historyDirectory, readTimes[historyDirectory])
+            Journal.ForRoot(historyDirectory).EndRun()
+        else:
+            print("*** "+str(scheduler.Total(historyDirectory)-completed.get(historyDirectory, 0))+" pages not completed, so "+ChangeFeed.watermarkFileName+" is unchanged")
+
+        # Write out what this process has indexed, then index anything the workers didn't get to
+        if updateSearchIndex:
+            with Timing.Stage("search index"):
+                SearchIndex.ForRoot(historyDirectory).Flush()
+                print("   "+str(SearchIndex.Update(historyDirectory))+" more versions indexed")
+
+        # Add the versions downloaded to the archive
+        if updateArchive:
+            with Timing.Stage("archive"):
+                print("   "+str(Archive.Update(historyDirectory))+" versions added to "+Archive.archiveFileName)
+
+    Waits.Report()
+    RateLimiter.Report()
+    print("   Timings are in "+os.path.join(sites[0].historyRoot, Timing.logFileName)+".  Summarize them with: python Timing.py summary <file>")
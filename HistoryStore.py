@@ -0,0 +1,192 @@
+import os
+import pathlib
+import shutil
+import xml.etree.ElementTree as ET
+import PackStore
+
+# The layout of the local history tree, shared by all the ways we have of fetching a page's history.
+# The history of page xyz is kept in historyRoot/X/Y/xyz, and version n of it in historyRoot/X/Y/xyz/Vnnnn (see the comments at the top of HistoryDownloader.py)
+#   or, with pack storage, in historyRoot/X/Y/xyz/history.pack
+
+storageFileName="storage.txt"
+siteFileName="site.txt"
+
+#--------------------------------------------------------
+# Convert a page name as Wikidot knows it to the name used locally
+def LocalPageName(wikiName):
+    name=wikiName.replace(":", "_", 1)   # ':' is used for non-standard namespaces on wiki. Replace the first ":" with "_" in all page names because ':' is invalid in Windows file names
+    if name == "con":
+        name="con-"     # Handle the "con" special case
+    return name
+
+
+#--------------------------------------------------------
+# Return the directory holding the history of a page
+# The first two letters in the page's name are used to disperse the page directories among many directories so as to avoid having so many subdirectories that Windows Explorer breaks when viewing it
+def PagePath(historyRoot, pageName):
+    d1=pageName[0]
+    d2=d1
+    if len(pageName) > 1:
+        d2=pageName[1]
+    return os.path.join(historyRoot, d1, d2, pageName)
+
+
+#--------------------------------------------------------
+# Return the name of the directory holding version number of a page: Vnnnn
+def VersionDirName(number):
+    return "V"+("0000"+str(number))[-4:]    # Add leading zeroes
+
+
+#--------------------------------------------------------
+# Is this the name of a version directory?
+def IsVersionDirName(name):
+    return len(name) == 5 and name[0] == 'V' and name[1:].isdigit()
+
+
+#--------------------------------------------------------
+# Is this the name of one of the files pack storage keeps in a page directory (as opposed to an attached file)?
+def IsStoreFile(name):
+    return name in (PackStore.packFileName, PackStore.indexFileName)
+
+
+#--------------------------------------------------------
+# Versions can be stored either as Vnnnn directories ("directories") or in a pack file per page ("pack"; see PackStore.py)
+# The choice for new versions is a property of the history tree, recorded in historyRoot/storage.txt, so that every process writing the tree agrees
+# Pages can be in either format, or a mix, and are read correctly regardless
+def StorageFormat(historyRoot):
+    path=os.path.join(historyRoot, storageFileName)
+    if not os.path.exists(path):
+        return "directories"
+    with open(path) as f:
+        return f.readline().strip()
+
+
+def SetStorageFormat(historyRoot, storage):
+    os.makedirs(historyRoot, exist_ok=True)
+    with open(os.path.join(historyRoot, storageFileName), "w") as f:
+        f.write(storage+"\n")
+
+
+#--------------------------------------------------------
+# The base URL of the wiki whose history the tree holds (e.g., "http://fancyclopedia.org"), recorded in historyRoot/site.txt
+# Like the storage format, it's a property of the tree, so that a worker given a page of any site's tree knows where to fetch it from
+# A tree made before there was a site.txt is Fancyclopedia's
+def SiteUrl(historyRoot):
+    path=os.path.join(historyRoot, siteFileName)
+    if not os.path.exists(path):
+        return "http://fancyclopedia.org"
+    with open(path) as f:
+        return f.readline().strip().rstrip("/")
+
+
+def SetSiteUrl(historyRoot, baseUrl):
+    os.makedirs(historyRoot, exist_ok=True)
+    with open(os.path.join(historyRoot, siteFileName), "w") as f:
+        f.write(baseUrl.rstrip("/")+"\n")
+
+
+#--------------------------------------------------------
+# Return the set of version numbers already downloaded for the page stored in pagePath
+def ExistingVersions(pagePath):
+    if not os.path.exists(pagePath):
+        return set()
+    versions=set(int(entry.name[1:]) for entry in os.scandir(pagePath) if entry.is_dir() and IsVersionDirName(entry.name))
+    if os.path.exists(os.path.join(pagePath, PackStore.packFileName)):
+        versions=versions | PackStore.PackStore(pagePath).Versions()
+    return versions
+
+
+#--------------------------------------------------------
+# Return the metadata.xml (as bytes) and source of a version, wherever it is stored
+def ReadVersion(pagePath, number):
+    dir=os.path.join(pagePath, VersionDirName(number))
+    if os.path.isdir(dir):
+        with open(os.path.join(dir, "metadata.xml"), "rb") as f:
+            metadata=f.read()
+        with open(os.path.join(dir, "source.txt")) as f:
+            source=f.read()
+        return metadata, source
+    store=PackStore.PackStore(pagePath)
+    return store.ReadMetadata(number), store.ReadSource(number)
+
+
+#--------------------------------------------------------
+# Figure out what the lowest version still needed is.  (Knowing this may allow us to optimize page loads.)
+# Note that this will be max+1 if there are no gaps in the list
+def LowestVersionNeeded(existingVersions):
+    i=0
+    while i in existingVersions:
+        i=i+1
+    return i
+
+
+#--------------------------------------------------------
+# Build the metadata.xml of a version
+def MakeMetadata(number, id, type, user, date, comment):
+    root=ET.Element("data")
+    el=ET.SubElement(root, "number")
+    el.text=str(number)
+    el=ET.SubElement(root, "ID")
+    el.text=str(id)
+    el=ET.SubElement(root, "type")
+    el.text=str(type)
+    el=ET.SubElement(root, "name")
+    el.text=str(user)
+    el=ET.SubElement(root, "date")
+    el.text=str(date)
+    el=ET.SubElement(root, "comment")
+    el.text=str(comment)
+    return ET.tostring(root)
+
+
+#--------------------------------------------------------
+# fsync a directory, so that renames in it are durable.  (Windows can't do this, and doesn't need to.)
+def FsyncDirectory(path):
+    try:
+        fd=os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+#--------------------------------------------------------
+# A version directory must be complete if it exists, so versions are written in two steps:
+#   StageVersion writes the version's files into a temporary directory (pagePath/.tmp-Vnnnn) which nothing else will look at
+#   CommitVersion renames the temporary directory to Vnnnn
+# The rename is atomic, so a crash leaves either nothing or a complete version, never a partial one.
+# Returns the paths of the files written, for the caller to fsync before committing
+def StageVersion(pagePath, number, metadata, source):
+    temp=os.path.join(pagePath, ".tmp-"+VersionDirName(number))
+    if os.path.exists(temp):
+        shutil.rmtree(temp)     # Left over from a crash
+    pathlib.Path(temp).mkdir(parents=True)
+
+    files=[os.path.join(temp, "metadata.xml"), os.path.join(temp, "source.txt")]
+    with open(files[0], 'wb') as file:
+        file.write(metadata)
+    with open(files[1], 'w') as file:
+        file.write(source)
+    return files
+
+
+#--------------------------------------------------------
+# Returns False if the version turned out to exist already, in which case the staged copy is discarded
+def CommitVersion(pagePath, number):
+    temp=os.path.join(pagePath, ".tmp-"+VersionDirName(number))
+    dir=os.path.join(pagePath, VersionDirName(number))
+    if os.path.exists(dir):
+        shutil.rmtree(temp)
+        return False
+    os.rename(temp, dir)
+    return True
+
+
+#--------------------------------------------------------
+def FsyncFile(path):
+    with open(path, "rb") as file:
+        os.fsync(file.fileno())
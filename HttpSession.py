@@ -0,0 +1,89 @@
+import http.client
+import threading
+import urllib.parse
+import RateLimiter
+
+# A minimal keep-alive HTTP client.
+# urllib.request opens a new connection for every request, which costs a TCP (and maybe TLS) handshake each time.
+# This keeps one open connection per host per thread and reuses it, and carries a small cookie jar.
+# Every request goes through the rate limit for its host (see RateLimiter.py).
+
+class HttpSession:
+
+    def __init__(self, timeout=30):
+        self.timeout=timeout
+        self.cookies={}
+        self._local=threading.local()    # Each thread gets its own connections, so a session can be shared by a thread pool
+
+    #--------------------------------------------------------
+    # Return an open connection to the host of url, creating one if needed
+    def _Connection(self, scheme, host):
+        if not hasattr(self._local, "connections"):
+            self._local.connections={}
+        conn=self._local.connections.get((scheme, host))
+        if conn is None:
+            if scheme == "https":
+                conn=http.client.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                conn=http.client.HTTPConnection(host, timeout=self.timeout)
+            self._local.connections[(scheme, host)]=conn
+        return conn
+
+    #--------------------------------------------------------
+    # Make a request and return (status, headers, body)
+    # If the server has closed the kept-alive connection, reconnect and try once more
+    def Request(self, method, url, body=None, headers=None):
+        parts=urllib.parse.urlsplit(url)
+        path=parts.path or "/"
+        if parts.query:
+            path=path+"?"+parts.query
+        allHeaders={}
+        if self.cookies:
+            allHeaders["Cookie"]="; ".join(k+"="+v for k, v in self.cookies.items())
+        if headers is not None:
+            allHeaders.update(headers)
+
+        # Every request waits its turn under its host's rate limit, and reports back how it went
+        limiter=RateLimiter.ForUrl(url)
+        start=limiter.Acquire()
+        for attempt in range(2):
+            conn=self._Connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, body=body, headers=allHeaders)
+                response=conn.getresponse()
+                data=response.read()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, http.client.BadStatusLine, ConnectionError):
+                conn.close()
+                del self._local.connections[(parts.scheme, parts.netloc)]
+                if attempt == 1:
+                    limiter.Record(start, None)
+                    raise
+                continue
+            except (OSError, http.client.HTTPException):
+                limiter.Record(start, None)
+                raise
+            if response.getheader("Connection", "").lower() == "close":
+                conn.close()
+                del self._local.connections[(parts.scheme, parts.netloc)]
+            retryAfter=response.getheader("Retry-After")
+            limiter.Record(start, response.status, float(retryAfter) if retryAfter is not None and retryAfter.strip().isdigit() else None)
+            return response.status, response.headers, data
+
+    #--------------------------------------------------------
+    def Get(self, url, headers=None):
+        return self.Request("GET", url, headers=headers)
+
+    #--------------------------------------------------------
+    # POST a dictionary of form fields
+    def Post(self, url, fields, headers=None):
+        allHeaders={"Content-Type": "application/x-www-form-urlencoded; charset=UTF-8"}
+        if headers is not None:
+            allHeaders.update(headers)
+        return self.Request("POST", url, body=urllib.parse.urlencode(fields).encode("utf-8"), headers=allHeaders)
+
+    #--------------------------------------------------------
+    # Close the calling thread's connections
+    def Close(self):
+        for conn in getattr(self._local, "connections", {}).values():
+            conn.close()
+        self._local.connections={}
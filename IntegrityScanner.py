@@ -0,0 +1,216 @@
+import concurrent.futures
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+import Archive
+import HistoryStore
+import Manifest
+import PackStore
+import SearchIndex
+
+# An audit of the whole history tree, and a plan for repairing what it finds.
+# Each page directory is checked, with a pool of processes working through the X/Y directories:
+#   every version's metadata.xml must exist and parse, and give the version's own number
+#   every version's source.txt must exist and hold something other than nothing or "None" (what gets written when a source couldn't be read)
+#   the versions must run 0, 1, 2, ... with no gaps
+#   versions in a pack must be readable
+# An empty version directory is deliberate (it stops HistoryDownloader fetching that version), so it passes.
+# The problems found are saved in historyRoot/repairs.json as a dictionary of page name: {version number: problem}.
+# The downloader consumes that file directly: it sets the bad versions aside (renaming Vnnnn to .bad-Vnnnn) and fetches them, and the missing ones, again.
+# (A bad version in a pack can't be set aside, so it's reported but not repaired.)
+#
+# python IntegrityScanner.py scan <historyRoot> [processes]
+
+repairsFileName="repairs.json"
+missing="missing"       # The problem with a version in a gap
+
+
+#--------------------------------------------------------
+# Check one version directory.  Returns a description of what's wrong with it, or None if it's fine.
+def CheckVersionDir(dir, number):
+    if len(os.listdir(dir)) == 0:
+        return None     # A placeholder
+    metaPath=os.path.join(dir, "metadata.xml")
+    sourcePath=os.path.join(dir, "source.txt")
+    if not os.path.exists(metaPath):
+        return "no metadata.xml"
+    if not os.path.exists(sourcePath):
+        return "no source.txt"
+    try:
+        root=ET.parse(metaPath).getroot()
+    except ET.ParseError as exception:
+        return "metadata.xml doesn't parse: "+str(exception)
+    el=root.find("number")
+    if el is None or (el.text or "").strip() != str(number):
+        return "metadata.xml is for version "+str(el.text if el is not None else None)
+    with open(sourcePath, "rb") as f:
+        source=f.read(16)
+    if source.strip() in (b"", b"None"):
+        return "source.txt is "+("empty" if source.strip() == b"" else "None")
+    return None
+
+
+#--------------------------------------------------------
+# Check one version in a pack.  Returns a description of what's wrong with it, or None if it's fine.
+def CheckPackedVersion(store, number):
+    try:
+        ET.fromstring(store.ReadMetadata(number))
+        source=store.ReadSource(number)
+    except Exception as exception:
+        return "unreadable in "+PackStore.packFileName+": "+type(exception).__name__
+    if source.strip() in ("", "None"):
+        return "source is "+("empty" if source.strip() == "" else "None")+" in "+PackStore.packFileName
+    return None
+
+
+#--------------------------------------------------------
+# Check a page directory
+# Returns a dictionary of version number: problem (with the gaps in the versions as missing)
+def ScanPage(pagePath):
+    problems={}
+    numbers=set()
+    staged=set()
+    for entry in os.scandir(pagePath):
+        if entry.is_dir() and HistoryStore.IsVersionDirName(entry.name):
+            number=int(entry.name[1:])
+            numbers.add(number)
+            problem=CheckVersionDir(entry.path, number)
+            if problem is not None:
+                problems[number]=problem
+        elif entry.is_dir() and entry.name.startswith(".tmp-") and HistoryStore.IsVersionDirName(entry.name[5:]):
+            staged.add(int(entry.name[6:]))
+    if os.path.exists(os.path.join(pagePath, PackStore.packFileName)):
+        store=PackStore.PackStore(pagePath)
+        for number in store.Versions()-numbers:
+            numbers.add(number)
+            problem=CheckPackedVersion(store, number)
+            if problem is not None:
+                problems[number]=problem+" (can't be repaired in place)"
+    if len(numbers) > 0:
+        for number in range(0, max(numbers)):
+            if number not in numbers:
+                problems[number]=missing
+    # A version staged but never committed was interrupted by a crash
+    for number in staged-numbers:
+        problems[number]=missing+" (its write was interrupted)"
+    return problems
+
+
+#--------------------------------------------------------
+# Check all the page directories in one X/Y directory
+# Returns a list of (page name, problems, versions found)
+# (This is run in worker processes, so it must be a module-level function.)
+def _ScanDirectory(path):
+    results=[]
+    for page in os.scandir(path):
+        if page.is_dir():
+            try:
+                problems=ScanPage(page.path)
+                versions=HistoryStore.ExistingVersions(page.path)
+            except OSError as exception:
+                problems={-1: "unreadable: "+str(exception)}
+                versions=set()
+            results.append((page.name, problems, versions))
+    return results
+
+
+#--------------------------------------------------------
+# Check every page in historyRoot using processes processes
+# Returns a dictionary of page name: {version number: problem} of the pages with problems
+def Scan(historyRoot, processes=None):
+    directories=[]
+    for d1 in os.scandir(historyRoot):
+        if d1.is_dir():
+            directories.extend(d2.path for d2 in os.scandir(d1.path) if d2.is_dir())
+
+    problems={}
+    treeVersions=set()
+    pageCount=0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes or os.cpu_count() or 1) as pool:
+        for results in pool.map(_ScanDirectory, directories, chunksize=8):
+            for pageName, pageProblems, versions in results:
+                pageCount=pageCount+1
+                treeVersions.update((pageName, v) for v in versions)
+                if len(pageProblems) > 0:
+                    problems[pageName]=pageProblems
+
+    # Versions the manifest thinks we have but the tree doesn't are missing too
+    for pageName, number in Manifest.ForRoot(historyRoot).AllVersions()-treeVersions:
+        problems.setdefault(pageName, {}).setdefault(number, missing)
+
+    print("   Scanned "+str(pageCount)+" pages: "+str(len(problems))+" with problems, "+str(sum(len(p) for p in problems.values()))+" versions to repair")
+    return problems
+
+
+#--------------------------------------------------------
+# Save the problems found as historyRoot/repairs.json (through a temporary file, so it's never half-written)
+def SaveRepairs(historyRoot, problems):
+    path=os.path.join(historyRoot, repairsFileName)
+    with open(path+".tmp", "w") as f:
+        json.dump(dict((p, dict((str(n), why) for n, why in v.items())) for p, v in problems.items()), f, indent=1, sort_keys=True)
+    os.replace(path+".tmp", path)
+
+
+#--------------------------------------------------------
+# Load historyRoot/repairs.json, or return None if there isn't one
+def LoadRepairs(historyRoot):
+    path=os.path.join(historyRoot, repairsFileName)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return dict((p, dict((int(n), why) for n, why in v.items())) for p, v in json.load(f).items())
+
+
+#--------------------------------------------------------
+# Get ready to repair: set the bad version directories aside and take them (and any missing versions) out of the manifest
+# Returns the repair work list: a dictionary of page name: set of version numbers to fetch
+def PrepareRepairs(historyRoot, problems):
+    manifest=Manifest.ForRoot(historyRoot)
+    workList={}
+    for pageName, pageProblems in problems.items():
+        pagePath=HistoryStore.PagePath(historyRoot, pageName)
+        for number, problem in pageProblems.items():
+            if number < 0 or "can't be repaired" in problem:
+                continue
+            dir=os.path.join(pagePath, HistoryStore.VersionDirName(number))
+            if os.path.isdir(dir):
+                aside=os.path.join(pagePath, ".bad-"+HistoryStore.VersionDirName(number))
+                suffix=1
+                while os.path.exists(aside):
+                    aside=os.path.join(pagePath, ".bad-"+HistoryStore.VersionDirName(number)+"-"+str(suffix))
+                    suffix=suffix+1
+                os.rename(dir, aside)
+            manifest.RemoveVersion(pageName, number)
+            workList.setdefault(pageName, set()).add(number)
+    # The archive compiles only versions it doesn't have, so it must forget the bad ones too
+    if os.path.exists(os.path.join(historyRoot, Archive.archiveFileName)):
+        archive=Archive.Archive(historyRoot)
+        archive.RemoveVersions([(p, n) for p, numbers in workList.items() for n in numbers])
+        archive.Close()
+    # And the index must ignore what it has of them, or a search would still find the bad versions' words
+    for pageName, numbers in workList.items():
+        SearchIndex.RemoveVersions(historyRoot, pageName, numbers)
+    return workList
+
+
+#--------------------------------------------------------
+# The downloader has taken the repairs into its work list (and so its journal): set repairs.json aside so they aren't made twice
+def RepairsTaken(historyRoot):
+    path=os.path.join(historyRoot, repairsFileName)
+    if os.path.exists(path):
+        os.replace(path, path+".done")
+
+
+#--------------------------------------------------------
+# Usage: python IntegrityScanner.py scan <historyRoot> [processes]
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4] or sys.argv[1] != "scan":
+        print("Usage: python IntegrityScanner.py scan <historyRoot> [processes]")
+        sys.exit(1)
+    found=Scan(sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else None)
+    for pageName in sorted(found):
+        for number, problem in sorted(found[pageName].items()):
+            print("   "+pageName+" "+HistoryStore.VersionDirName(number)+": "+problem)
+    SaveRepairs(sys.argv[2], found)
+    print("The repairs have been saved in "+os.path.join(sys.argv[2], repairsFileName)+".  The next run of HistoryDownloader will make them.")
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+import HistoryStore
+import Manifest
+import RevisionList
+
+# A write-ahead journal of the work of a run, kept in historyRoot/journal.jsonl, so that a crash loses no progress.
+# Before anything is downloaded the run's whole work list is written to it, and as each page's revision list is read, the revisions to be fetched are written to it.
+# Each line is one JSON record:
+#       {"op": "run", "t": time the run started}
+#       {"op": "page", "page": name, "wanted": [revision numbers] or null for all those missing}    -- a page the run is to do
+#       {"op": "revisions", "page": name, "revisions": [[number, id, type, user, date, comment], ...]}   -- revisions of the page about to be fetched
+#       {"op": "revision done", "page": name, "number": n}    -- a revision is safely on disk
+#       {"op": "page done", "page": name, "watermark": n}     -- the page is complete up to and including revision n
+#       {"op": "end"}                                         -- the run completed every page
+# If the program stops before the "end", the next run resumes from the journal: it adds the pages not yet done to what it finds needs doing,
+#   and fetches the revisions already listed directly, by their IDs.
+# A page being done means it's complete up to its watermark revision, not that it's finished with: later edits make it work again.
+#
+# Records are appended with a single write each, so several worker processes can share the journal.
+
+journalFileName="journal.jsonl"
+
+
+class Journal:
+
+    def __init__(self, historyRoot):
+        self.path=os.path.join(historyRoot, journalFileName)
+        os.makedirs(historyRoot, exist_ok=True)
+        self.fd=os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.lock=threading.Lock()
+
+    #--------------------------------------------------------
+    # Append records.  If sync, don't return until they're on disk.
+    def _Append(self, records, sync=False):
+        data="".join(json.dumps(r)+"\n" for r in records).encode("utf-8")
+        with self.lock:
+            os.write(self.fd, data)
+            if sync:
+                os.fsync(self.fd)
+
+    #--------------------------------------------------------
+    # Start a new run: set aside the old journal and write the work list (a dictionary of page name: set of revision numbers wanted, or None)
+    # pending, if given, is the revisions an unfinished run had listed but not saved, as a dictionary of page name: {number: Revision}, which are carried over
+    def StartRun(self, readTime, workList, pending=None):
+        with self.lock:
+            os.close(self.fd)
+            if os.path.exists(self.path):
+                os.replace(self.path, self.path+".old")
+            self.fd=os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        records=[{"op": "run", "t": readTime}]
+        for pageName, wanted in workList.items():
+            records.append({"op": "page", "page": pageName, "wanted": None if wanted is None else sorted(wanted)})
+        for pageName, revisions in (pending or {}).items():
+            if pageName in workList and len(revisions) > 0:
+                records.append({"op": "revisions", "page": pageName, "revisions": [list(rev) for number, rev in sorted(revisions.items(), reverse=True)]})
+        self._Append(records, sync=True)
+
+    #--------------------------------------------------------
+    # Record that revisions (a list of RevisionList.Revisions) of a page are about to be fetched
+    def RevisionsPending(self, pageName, revisions):
+        if len(revisions) > 0:
+            self._Append([{"op": "revisions", "page": pageName, "revisions": [list(rev) for rev in revisions]}], sync=True)
+
+    #--------------------------------------------------------
+    # Record that a revision is on disk.  (The manifest has it too, so this needn't wait for the disk.)
+    def RevisionDone(self, pageName, number):
+        self._Append([{"op": "revision done", "page": pageName, "number": number}])
+
+    #--------------------------------------------------------
+    # A version has been committed: record it in the manifest and here.  (This is the onCommit the downloaders give the VersionWriter.)
+    def Committed(self, manifest, pageName, number, revisionId):
+        manifest.AddVersion(pageName, number, revisionId)
+        self.RevisionDone(pageName, number)
+
+    #--------------------------------------------------------
+    def PageDone(self, pageName, watermark):
+        self._Append([{"op": "page done", "page": pageName, "watermark": watermark}], sync=True)
+
+    #--------------------------------------------------------
+    def EndRun(self):
+        self._Append([{"op": "end", "t": time.time()}], sync=True)
+
+
+#--------------------------------------------------------
+# What an unfinished run still has to do, replayed from its journal
+class UnfinishedRun:
+
+    def __init__(self, readTime):
+        self.readTime=readTime
+        self.workList={}        # Page name: set of revision numbers wanted, or None.  Only the pages not yet done.
+        self.pending={}         # Page name: {number: Revision} of revisions listed but not yet on disk
+
+
+#--------------------------------------------------------
+# Read the journal in historyRoot.  Return an UnfinishedRun if it records a run which didn't end, and None otherwise.
+def LoadUnfinished(historyRoot):
+    path=os.path.join(historyRoot, journalFileName)
+    if not os.path.exists(path):
+        return None
+    run=None
+    with open(path) as f:
+        for line in f:
+            try:
+                r=json.loads(line)
+            except ValueError:
+                continue    # A line cut short by a crash
+            op=r.get("op")
+            if op == "run":
+                run=UnfinishedRun(r["t"])
+            elif run is None:
+                continue
+            elif op == "page":
+                run.workList[r["page"]]=None if r["wanted"] is None else set(r["wanted"])
+            elif op == "revisions":
+                pending=run.pending.setdefault(r["page"], {})
+                for rev in r["revisions"]:
+                    pending[rev[0]]=RevisionList.Revision(*rev)
+            elif op == "revision done":
+                run.pending.get(r["page"], {}).pop(r["number"], None)
+            elif op == "page done":
+                run.workList.pop(r["page"], None)
+                run.pending.pop(r["page"], None)
+            elif op == "end":
+                run=None
+    return run
+
+
+#--------------------------------------------------------
+# Record that a page is complete, up to the newest version we have with none missing before it, in the journal and the manifest
+# (So a page with a gap in its versions has a watermark below the gap, and is never taken to be complete past it.)
+def MarkDone(historyRoot, pageName):
+    manifest=Manifest.ForRoot(historyRoot)
+    watermark=HistoryStore.LowestVersionNeeded(manifest.Versions(pageName))-1
+    ForRoot(historyRoot).PageDone(pageName, watermark)
+    manifest.SetComplete(pageName, watermark=watermark)
+
+
+# One journal per history root per process
+_journals={}
+
+#--------------------------------------------------------
+# Return this process's journal for historyRoot, opening it if necessary
+def ForRoot(historyRoot):
+    key=(os.getpid(), historyRoot)
+    if key not in _journals:
+        _journals[key]=Journal(historyRoot)
+    return _journals[key]
+
+
+#--------------------------------------------------------
+# The revisions of a page left pending by an unfinished run, as a dictionary of number: Revision
+# A worker can't be handed them directly, so each process reads them from the journal the first time it's asked
+_pending={}
+
+def PendingRevisions(historyRoot, pageName):
+    key=(os.getpid(), historyRoot)
+    if key not in _pending:
+        run=LoadUnfinished(historyRoot)
+        _pending[key]=run.pending if run is not None else {}
+    return _pending[key].pop(pageName, {})
@@ -0,0 +1,225 @@
+import os
+import sqlite3
+import sys
+import threading
+import xml.etree.ElementTree as ET
+import HistoryStore
+
+# An indexed on-disk record of what is in the history tree, kept in historyRoot/manifest.db (an SQLite database)
+# It records, for each page, the versions we have (with their revision IDs), the files attached to it and whether the page is complete.
+# A complete page is complete only up to its watermark: the newest revision it had when it was completed.
+# It lets startup and per-page bookkeeping be lookups rather than reads of donelist.txt and walks of page directories.
+# Revision IDs are global to the site, so it can also tell us whether a revision is already stored under another page's name (the page having been renamed).
+# The tree remains the truth: if the two ever disagree (say, someone has created or deleted version directories by hand), rebuild the manifest from the tree.
+
+manifestFileName="manifest.db"
+
+_schema='''
+CREATE TABLE IF NOT EXISTS pages (name TEXT PRIMARY KEY, complete INTEGER NOT NULL DEFAULT 0, watermark INTEGER);
+CREATE TABLE IF NOT EXISTS versions (page TEXT NOT NULL, number INTEGER NOT NULL, revision_id TEXT, indexed INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (page, number));
+CREATE INDEX IF NOT EXISTS versions_by_revision ON versions (revision_id);
+CREATE TABLE IF NOT EXISTS files (page TEXT NOT NULL, name TEXT NOT NULL, size INTEGER, mtime REAL, PRIMARY KEY (page, name));
+'''
+
+class Manifest:
+
+    def __init__(self, historyRoot):
+        self.historyRoot=historyRoot
+        path=os.path.join(historyRoot, manifestFileName)
+        isNew=not os.path.exists(path)
+        os.makedirs(historyRoot, exist_ok=True)
+        # Several worker processes may each have the manifest open, so wait for locks rather than failing, and use WAL so readers don't block the writer
+        self.conn=sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock=threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_schema)
+        if "watermark" not in [row[1] for row in self.conn.execute("PRAGMA table_info(pages)")]:
+            self.conn.execute("ALTER TABLE pages ADD COLUMN watermark INTEGER")      # A manifest made before there were watermarks
+        if "indexed" not in [row[1] for row in self.conn.execute("PRAGMA table_info(versions)")]:
+            self.conn.execute("ALTER TABLE versions ADD COLUMN indexed INTEGER NOT NULL DEFAULT 0")     # ...or before it recorded what's in the search index
+        self.conn.execute("CREATE INDEX IF NOT EXISTS versions_unindexed ON versions (page, number) WHERE indexed=0")
+        self.created=isNew
+        if isNew:
+            print("   Creating "+manifestFileName+" from the history tree")
+            self.Rebuild()
+
+    #--------------------------------------------------------
+    def Close(self):
+        self.conn.close()
+
+    #--------------------------------------------------------
+    def IsComplete(self, pageName):
+        with self.lock:
+            row=self.conn.execute("SELECT complete FROM pages WHERE name=?", (pageName,)).fetchone()
+        return row is not None and row[0] == 1
+
+    #--------------------------------------------------------
+    # watermark, if given, is the newest revision the page had when it was completed
+    def SetComplete(self, pageName, complete=True, watermark=None):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO pages (name, complete, watermark) VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET complete=excluded.complete, watermark=excluded.watermark",
+                              (pageName, 1 if complete else 0, watermark))
+
+    #--------------------------------------------------------
+    # The newest revision of a page when it was last completed, or None
+    def Watermark(self, pageName):
+        with self.lock:
+            row=self.conn.execute("SELECT watermark FROM pages WHERE name=?", (pageName,)).fetchone()
+        return row[0] if row is not None else None
+
+    #--------------------------------------------------------
+    # The set of version numbers we have of a page
+    def Versions(self, pageName):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute("SELECT number FROM versions WHERE page=?", (pageName,)))
+
+    #--------------------------------------------------------
+    # Every version of every page we have, as a set of (page name, number)
+    def AllVersions(self):
+        with self.lock:
+            return set(self.conn.execute("SELECT page, number FROM versions"))
+
+    #--------------------------------------------------------
+    # Record that a version of a page has been written
+    def AddVersion(self, pageName, number, revisionId):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO pages (name) VALUES (?)", (pageName,))
+            self.conn.execute("INSERT OR REPLACE INTO versions (page, number, revision_id) VALUES (?, ?, ?)", (pageName, int(number), str(revisionId)))
+
+    #--------------------------------------------------------
+    # Find a revision (by its site-wide ID) stored under some page other than pageName
+    # Returns (page name, version number), or None if we don't have it elsewhere
+    def FindRevision(self, revisionId, pageName):
+        if revisionId is None or str(revisionId) == "None":
+            return None
+        with self.lock:
+            row=self.conn.execute("SELECT page, number FROM versions WHERE revision_id=? AND page<>? LIMIT 1", (str(revisionId), pageName)).fetchone()
+        return tuple(row) if row is not None else None
+
+    #--------------------------------------------------------
+    # The source of a revision if it's already stored under a page other than pageName (because the page has been renamed), or None
+    def SourceElsewhere(self, revisionId, pageName):
+        found=self.FindRevision(revisionId, pageName)
+        if found is None:
+            return None
+        try:
+            metadata, source=HistoryStore.ReadVersion(HistoryStore.PagePath(self.historyRoot, found[0]), found[1])
+        except (OSError, KeyError):
+            return None     # The manifest is out of date; fetch it after all
+        if source.strip() in ("", "None"):
+            return None
+        print("    Copying revision "+str(revisionId)+" from "+found[0]+" "+HistoryStore.VersionDirName(found[1]))
+        return source
+
+    #--------------------------------------------------------
+    # The versions not known to be in the search index (see SearchIndex.py), as a set of (page name, number)
+    def UnindexedVersions(self):
+        with self.lock:
+            return set(self.conn.execute("SELECT page, number FROM versions WHERE indexed=0"))
+
+    #--------------------------------------------------------
+    # Record that versions (an iterable of (page name, number)) are in a segment of the search index, or if indexed is False, that none is
+    def MarkIndexed(self, versions=None, indexed=True):
+        with self.lock, self.conn:
+            if versions is None:
+                self.conn.execute("UPDATE versions SET indexed=?", (1 if indexed else 0,))
+            else:
+                self.conn.executemany("UPDATE versions SET indexed=? WHERE page=? AND number=?", [(1 if indexed else 0, p, int(n)) for p, n in versions])
+
+    #--------------------------------------------------------
+    # Forget a version of a page (because it's to be fetched again), and so that the page is no longer complete
+    def RemoveVersion(self, pageName, number):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM versions WHERE page=? AND number=?", (pageName, int(number)))
+            self.conn.execute("UPDATE pages SET complete=0 WHERE name=?", (pageName,))
+
+    #--------------------------------------------------------
+    # The files attached to a page as a dictionary of name: (size, mtime)
+    def Files(self, pageName):
+        with self.lock:
+            return dict((row[0], (row[1], row[2])) for row in self.conn.execute("SELECT name, size, mtime FROM files WHERE page=?", (pageName,)))
+
+    #--------------------------------------------------------
+    # Record that a file attached to a page has been downloaded
+    def AddFile(self, pageName, name, size, mtime):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO pages (name) VALUES (?)", (pageName,))
+            self.conn.execute("INSERT OR REPLACE INTO files (page, name, size, mtime) VALUES (?, ?, ?, ?)", (pageName, name, size, mtime))
+
+    #--------------------------------------------------------
+    # Mark the pages listed in a donelist.txt complete
+    def ImportDonelist(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            names=[x.strip() for x in f.readlines()]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT INTO pages (name, complete) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET complete=1", [(n,) for n in names if n != ""])
+
+    #--------------------------------------------------------
+    # Throw away the recorded versions and files and re-read them from the history tree
+    # Completion state can't be seen in the tree, so it is kept, and donelist.txt is merged in
+    def Rebuild(self):
+        versions=[]
+        files=[]
+        pages=[]
+        for d1 in os.scandir(self.historyRoot):
+            if not d1.is_dir():
+                continue
+            for d2 in os.scandir(d1.path):
+                if not d2.is_dir():
+                    continue
+                for page in os.scandir(d2.path):
+                    if not page.is_dir():
+                        continue
+                    pages.append((page.name,))
+                    for number in HistoryStore.ExistingVersions(page.path):
+                        versions.append((page.name, number, _ReadRevisionId(page.path, number)))
+                    for entry in os.scandir(page.path):
+                        if entry.is_file() and not HistoryStore.IsStoreFile(entry.name):
+                            stat=entry.stat()
+                            files.append((page.name, entry.name, stat.st_size, stat.st_mtime))
+
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM versions")
+            self.conn.execute("DELETE FROM files")
+            self.conn.executemany("INSERT OR IGNORE INTO pages (name) VALUES (?)", pages)
+            self.conn.executemany("INSERT INTO versions (page, number, revision_id) VALUES (?, ?, ?)", versions)
+            self.conn.executemany("INSERT INTO files (page, name, size, mtime) VALUES (?, ?, ?, ?)", files)
+        self.ImportDonelist(os.path.join(self.historyRoot, "donelist.txt"))
+        print("   Manifest rebuilt: "+str(len(pages))+" pages, "+str(len(versions))+" versions, "+str(len(files))+" files")
+
+
+#--------------------------------------------------------
+# Get the revision ID out of a version's metadata.xml
+def _ReadRevisionId(pagePath, number):
+    try:
+        metadata, source=HistoryStore.ReadVersion(pagePath, number)
+        return ET.fromstring(metadata).findtext("ID")
+    except (OSError, ET.ParseError, KeyError):
+        return None
+
+
+# One open manifest per history root per process
+# (They're keyed by process ID as well because a forked worker inherits its parent's, and an SQLite connection mustn't be shared across a fork.)
+_manifests={}
+
+#--------------------------------------------------------
+# Return this process's manifest for historyRoot, opening it if necessary
+def ForRoot(historyRoot):
+    key=(os.getpid(), historyRoot)
+    if key not in _manifests:
+        _manifests[key]=Manifest(historyRoot)
+    return _manifests[key]
+
+
+#--------------------------------------------------------
+# Usage: python Manifest.py rebuild <historyRoot>
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "rebuild":
+        print("Usage: python Manifest.py rebuild <historyRoot>")
+        sys.exit(1)
+    m=Manifest(sys.argv[2])
+    if not m.created:   # A new manifest has just been built from the tree
+        m.Rebuild()
+    m.Close()
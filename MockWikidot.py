@@ -0,0 +1,421 @@
+import email.utils
+import html
+import http.cookies
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import xmlrpc.server
+from datetime import datetime, timezone
+
+# A stand-in for a Wikidot site, for measuring the downloader without touching fancyclopedia.org.
+# It serves a synthetic wiki, generated from a seed, with the parts of Wikidot the downloader depends on:
+#   /<page>/noredirect/t        -- the page, with page-info ("last edited: ..."), history-button, files-button and action-area
+#   /ajax-module-connector.php  -- the AJAX modules: the history (revision-list with its pager, and history-subarea), revision lists, sources, the page-files table and the site's recent changes
+#   /local--files/<page>/<file> -- attached files, honoring If-Modified-Since
+#   /xml-rpc-api.php            -- pages.select and pages.get_meta
+# The page's javascript calls the AJAX modules just as Wikidot's does, so a Selenium browser can be pointed at it too.
+# Latency (and a rate of 503 errors) can be injected into every request.
+#
+# python MockWikidot.py [port] [pages] runs a server on its own.
+
+_users=["Alice Anderson", "Bob Brown", "Carol Chen", "Dave Davis", "Erin Evans", "Frank Fisher", "Grace Green", "Heidi Hall"]
+_words="fan fanzine convention worldcon apa mimeo hoax filk sercon fannish trufan neofan gafia fiawol egoboo corflu zine club".split()
+
+class SyntheticWiki:
+
+    # numPages pages, each with on average meanRevisions revisions (but at most maxRevisions), and on average filesPerPage attached files
+    def __init__(self, numPages=100, meanRevisions=10, maxRevisions=1000, filesPerPage=1, seed=1):
+        self.numPages=numPages
+        self.meanRevisions=meanRevisions
+        self.maxRevisions=maxRevisions
+        self.filesPerPage=filesPerPage
+        self.seed=seed
+        self.baseTime=1104537600    # 1 Jan 2005
+        self._pages={}
+        self._changes=None
+        self._lock=threading.Lock()
+        self.names=["synthetic-page-"+str(i).zfill(5) for i in range(numPages)]
+        self._index=dict((name, i) for i, name in enumerate(self.names))
+
+    #--------------------------------------------------------
+    # Return the page record for a name, or None if there is no such page
+    # A page is {"name", "id", "times": [time of each revision], "users", "flags", "comments", "files": [(name, size, time)]}
+    def Page(self, name):
+        index=self._index.get(name)
+        if index is None:
+            return None
+        with self._lock:
+            if index not in self._pages:
+                self._pages[index]=self._Generate(index)
+            return self._pages[index]
+
+    def _Generate(self, index):
+        rng=random.Random(self.seed*1000003+index)
+        count=max(1, min(self.maxRevisions, int(rng.expovariate(1/self.meanRevisions))+1))
+        page={"name": self.names[index], "id": 1000+index, "times": [], "users": [], "flags": [], "comments": [], "files": []}
+        t=self.baseTime+rng.randint(0, 5*365*86400)
+        for n in range(count):
+            self._AddRevision(page, rng, t)
+            t=t+rng.randint(60, 30*86400)
+        for k in range(int(rng.expovariate(1/self.filesPerPage)) if self.filesPerPage > 0 else 0):
+            page["files"].append(("file-"+str(k)+".jpg", rng.randint(1000, 200000), page["times"][0]))
+        return page
+
+    def _AddRevision(self, page, rng, t):
+        n=len(page["times"])
+        page["times"].append(t)
+        page["users"].append(rng.choice(_users))
+        page["flags"].append("N" if n == 0 else rng.choice(["S", "S", "S", "S T", "A", "F"]))
+        page["comments"].append(rng.choice(["", "", "typo", "added links", "expanded "+rng.choice(_words)]))
+
+    #--------------------------------------------------------
+    # Add count new revisions to a page, as if it had just been edited
+    def AddRevisions(self, name, count=1):
+        page=self.Page(name)
+        rng=random.Random()
+        with self._lock:
+            for i in range(count):
+                self._AddRevision(page, rng, max(page["times"][-1]+60, int(time.time())))
+            self._changes=None
+
+    #--------------------------------------------------------
+    def RevisionId(self, page, n):
+        return page["id"]*100000+n
+
+    def PageForRevisionId(self, revisionId):
+        index=revisionId//100000-1000
+        if index < 0 or index >= self.numPages:
+            return None, None
+        page=self.Page(self.names[index])
+        n=revisionId%100000
+        if n >= len(page["times"]):
+            return None, None
+        return page, n
+
+    def PageForId(self, pageId):
+        index=int(pageId)-1000
+        if index < 0 or index >= self.numPages:
+            return None
+        return self.Page(self.names[index])
+
+    #--------------------------------------------------------
+    # The source of revision n of a page: each revision adds a line to what went before
+    def Source(self, page, n):
+        lines=["+ "+page["name"], ""]
+        for k in range(1, n+1):
+            rng=random.Random(page["id"]*7919+k)
+            lines.append("Revision "+str(k)+" by "+page["users"][k]+": "+" ".join(rng.choice(_words) for i in range(8))+" & <more>")
+        return "\n".join(lines)
+
+    #--------------------------------------------------------
+    # Every revision on the site as (time, page name, revision number), newest first
+    def Changes(self):
+        if self._changes is None:
+            changes=[]
+            for name in self.names:
+                page=self.Page(name)
+                changes.extend((t, name, n) for n, t in enumerate(page["times"]))
+            self._changes=sorted(changes, reverse=True)
+        return self._changes
+
+    #--------------------------------------------------------
+    # The page names sorted by time of last edit, oldest first (as pages.select orders them)
+    def NamesByUpdate(self):
+        return sorted(self.names, key=lambda name: self.Page(name)["times"][-1])
+
+
+#--------------------------------------------------------
+def _FormatDate(t):
+    dt=datetime.fromtimestamp(t, tz=timezone.utc)
+    return str(dt.day)+" "+dt.strftime("%b %Y %H:%M")
+
+
+def _IsoDate(t):
+    return datetime.fromtimestamp(t, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+
+# The javascript of each page, which (like Wikidot's) loads the history and file lists into the action area
+_pageScript='''
+function callModule(params, done) {
+    var token=(document.cookie.match(/wikidot_token7=([^;]+)/) || [null, ""])[1];
+    var body="wikidot_token7="+encodeURIComponent(token);
+    for (var k in params)
+        body+="&"+encodeURIComponent(k)+"="+encodeURIComponent(params[k]);
+    var xhr=new XMLHttpRequest();
+    xhr.open("POST", "/ajax-module-connector.php");
+    xhr.setRequestHeader("Content-Type", "application/x-www-form-urlencoded");
+    xhr.onload=function() { done(JSON.parse(xhr.responseText).body); };
+    xhr.send(body);
+}
+function showHistory() {
+    callModule({moduleName: "history/PageHistoryModule", page_id: WIKIREQUEST.info.pageId}, function(b) { document.getElementById("action-area").innerHTML=b; });
+}
+function updateRevisionList(n) {
+    callModule({moduleName: "history/PageRevisionListModule", page_id: WIKIREQUEST.info.pageId, page: n, perpage: 20}, function(b) { document.getElementById("revision-list").innerHTML=b; });
+}
+function showSource(id) {
+    callModule({moduleName: "history/PageSourceModule", revision_id: id}, function(b) { document.getElementById("history-subarea").innerHTML=b; });
+}
+function showFiles() {
+    callModule({moduleName: "files/PageFilesModule", page_id: WIKIREQUEST.info.pageId}, function(b) { document.getElementById("action-area").innerHTML=b; });
+}
+if (document.cookie.indexOf("wikidot_token7=") < 0)
+    document.cookie="wikidot_token7="+Math.random().toString(16).slice(2)+"; path=/";
+'''
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1"     # Keep connections alive, as Wikidot does
+    disable_nagle_algorithm=True    # Otherwise each response waits on a delayed ACK
+
+    def log_message(self, format, *args):
+        pass
+
+    #--------------------------------------------------------
+    def _Send(self, status, body, contentType="text/html; charset=utf-8", headers=None):
+        if isinstance(body, str):
+            body=body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    #--------------------------------------------------------
+    # Inject latency and errors.  Returns True if the request has been answered with an error.
+    def _Throttle(self):
+        server=self.server
+        with server.statsLock:
+            server.requests=server.requests+1
+        if server.latency > 0:
+            time.sleep(server.latency*random.uniform(0.5, 1.5))
+        if server.errorRate > 0 and random.random() < server.errorRate:
+            self._Send(503, "Service Unavailable")
+            return True
+        return False
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    #--------------------------------------------------------
+    def do_GET(self):
+        if self._Throttle():
+            return
+        wiki=self.server.wiki
+        path=urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+
+        if path.startswith("/local--files/"):
+            parts=path.split("/")
+            page=wiki.Page(parts[2]) if len(parts) == 4 else None
+            files=dict((f[0], f) for f in page["files"]) if page is not None else {}
+            if len(parts) != 4 or parts[3] not in files:
+                self._Send(404, "Not found")
+                return
+            name, size, t=files[parts[3]]
+            since=self.headers.get("If-Modified-Since")
+            if since is not None:
+                try:
+                    if email.utils.parsedate_to_datetime(since).timestamp() >= t:
+                        self._Send(304, b"")
+                        return
+                except (TypeError, ValueError):
+                    pass
+            data=(name.encode("utf-8")*(size//len(name)+1))[:size]
+            self._Send(200, data, "image/jpeg", {"Last-Modified": email.utils.formatdate(t, usegmt=True)})
+            return
+
+        name=path.strip("/").split("/")[0]
+        page=wiki.Page(name)
+        if page is None:
+            self._Send(404, "<html><body><div id='page-content'><p>The page <em>"+html.escape(name.replace("_", "-"))+"</em> you want to access does not exist.</p></div></body></html>")
+            return
+        top=len(page["times"])-1
+        self._Send(200, "<html><head><script>var WIKIREQUEST={info: {}}; WIKIREQUEST.info.pageId = "+str(page["id"])+";"+_pageScript+"</script></head><body>"
+                   "<div id='page-content'>"+html.escape(wiki.Source(page, top))+"</div>"
+                   "<div id='page-info'>page revision: "+str(top)+", last edited: "+_FormatDate(page["times"][-1])+", by "+html.escape(page["users"][-1])+"</div>"
+                   "<div id='page-options-bottom'><a id='history-button' href='javascript:;' onclick='showHistory()'>History</a> "
+                   "<a id='files-button' href='javascript:;' onclick='showFiles()'>Files</a></div>"
+                   "<div id='action-area'></div></body></html>")
+
+    #--------------------------------------------------------
+    def do_POST(self):
+        length=int(self.headers.get("Content-Length", 0))
+        data=self.rfile.read(length)
+        if self._Throttle():
+            return
+        path=urllib.parse.urlsplit(self.path).path
+        if path == "/xml-rpc-api.php":
+            self._Send(200, self.server.xmlrpc._marshaled_dispatch(data), "text/xml")
+        elif path == "/ajax-module-connector.php":
+            fields=dict((k, v[0]) for k, v in urllib.parse.parse_qs(data.decode("utf-8")).items())
+            cookies=http.cookies.SimpleCookie(self.headers.get("Cookie", ""))
+            if "wikidot_token7" not in cookies or cookies["wikidot_token7"].value != fields.get("wikidot_token7"):
+                self._Send(200, json.dumps({"status": "wrong_token7", "message": "Token mismatch"}), "application/json")
+                return
+            body=self.server.modules.Call(fields)
+            if body is None:
+                self._Send(200, json.dumps({"status": "not_ok", "message": "No such module or object"}), "application/json")
+            else:
+                self._Send(200, json.dumps({"status": "ok", "body": body}), "application/json")
+        else:
+            self._Send(404, "Not found")
+
+
+class _Modules:
+
+    def __init__(self, wiki):
+        self.wiki=wiki
+
+    #--------------------------------------------------------
+    # Return the body of a module's response, or None if it failed
+    def Call(self, fields):
+        name=fields.get("moduleName")
+        try:
+            if name == "history/PageHistoryModule":
+                page=self.wiki.PageForId(fields["page_id"])
+                return None if page is None else "<div id='revision-list'>"+self.RevisionList(page, 1, 20)+"</div><div id='history-subarea'></div>"
+            if name == "history/PageRevisionListModule":
+                page=self.wiki.PageForId(fields["page_id"])
+                return None if page is None else self.RevisionList(page, int(fields.get("page", 1)), int(fields.get("perpage", 20)))
+            if name == "history/PageSourceModule":
+                page, n=self.wiki.PageForRevisionId(int(fields["revision_id"]))
+                return None if page is None else self.SourceView(page, n)
+            if name == "changes/SiteChangesListModule":
+                return self.ChangesList(int(fields.get("page", 1)), int(fields.get("perpage", 20)))
+            if name == "files/PageFilesModule":
+                page=self.wiki.PageForId(fields["page_id"])
+                return None if page is None else self.FileList(page)
+        except (KeyError, ValueError):
+            return None
+        return None
+
+    #--------------------------------------------------------
+    def RevisionList(self, page, pagerPage, perPage):
+        top=len(page["times"])-1
+        pageCount=max(1, (top+perPage)//perPage)
+        out=""
+        if pageCount > 1:
+            # Like Wikidot, show buttons only for the pages near the current one, plus the first and last
+            out="<div class='pager'><span class='pager-no'>page "+str(pagerPage)+" of "+str(pageCount)+"</span>"
+            for p in range(1, pageCount+1):
+                if p == pagerPage:
+                    out=out+"<span class='current'>"+str(p)+"</span>"
+                elif p == 1 or p == pageCount or abs(p-pagerPage) <= 2:
+                    out=out+"<span class='target'><a href='javascript:;' onclick='updateRevisionList("+str(p)+")'>"+str(p)+"</a></span>"
+            out=out+"</div>"
+        out=out+"<table class='page-history'><tr><td>rev.</td><td>&nbsp;</td><td>flags</td><td>actions</td><td>by</td><td>date</td><td>comments</td></tr>"
+        for n in range(top-(pagerPage-1)*perPage, max(-1, top-pagerPage*perPage), -1):
+            id=str(self.wiki.RevisionId(page, n))
+            flags=" ".join("<span class='spantip'>"+f+"</span>" for f in page["flags"][n].split())
+            out=out+("<tr id='revision-row-"+id+"'><td>"+str(n)+".</td>"
+                     "<td><input type='radio' name='from'/><input type='radio' name='to'/></td>"
+                     "<td>"+flags+"</td>"
+                     "<td><a href='javascript:;' onclick='showVersion("+id+")'>V</a> <a href='javascript:;' onclick='showSource("+id+")'>S</a> <a href='javascript:;'>R</a></td>"
+                     "<td><span class='printuser'><a href='javascript:;'>"+html.escape(page["users"][n])+"</a></span></td>"
+                     "<td><span class='odate time_"+str(page["times"][n])+" format_%25e%20%25b%20%25Y'>"+_FormatDate(page["times"][n])+"</span></td>"
+                     "<td>"+html.escape(page["comments"][n])+"</td></tr>")
+        return out+"</table>"
+
+    #--------------------------------------------------------
+    def ChangesList(self, pagerPage, perPage):
+        changes=self.wiki.Changes()
+        pageCount=max(1, (len(changes)+perPage-1)//perPage)
+        out="<div class='changes-list'>"
+        for t, name, n in changes[(pagerPage-1)*perPage:pagerPage*perPage]:
+            page=self.wiki.Page(name)
+            out=out+("<div class='changes-list-item'><table><tr>"
+                     "<td class='title'><a href='/"+name+"'>"+name.replace("-", " ").title()+"</a></td>"
+                     "<td class='flags'><span class='spantip'>"+page["flags"][n]+"</span></td>"
+                     "<td class='mod-date'><span class='odate time_"+str(t)+" format_%25e%20%25b%20%25Y'>"+_FormatDate(t)+"</span></td>"
+                     "<td class='revision-no'>(rev. "+str(n)+")</td>"
+                     "<td class='mod-by'><span class='printuser'><a href='javascript:;'>"+html.escape(page["users"][n])+"</a></span></td>"
+                     "</tr></table><div class='comments'>"+html.escape(page["comments"][n])+"</div></div>")
+        out=out+"<div class='pager'><span class='pager-no'>page "+str(pagerPage)+" of "+str(pageCount)+"</span></div>"
+        return out+"</div>"
+
+    #--------------------------------------------------------
+    def SourceView(self, page, n):
+        source=html.escape(self.wiki.Source(page, n)).replace("\n", "<br />\n")
+        return "<h1>Page source</h1><div class=\"page-source\">"+source+"</div>"
+
+    #--------------------------------------------------------
+    def FileList(self, page):
+        if len(page["files"]) == 0:
+            return "<h1>Files</h1><p>No files attached to this page.</p>"
+        out="<h1>Files</h1><table class='page-files'><tr><td>file name</td><td>file type</td><td>size</td></tr>"
+        for name, size, t in page["files"]:
+            out=out+("<tr><td><a href='/local--files/"+page["name"]+"/"+name+"'>"+name+"</a></td><td>JPG image</td>"
+                     "<td>"+str(size//1024)+" kB</td><td><a href='javascript:;'>info</a></td></tr>")
+        return out+"</table>"
+
+
+#--------------------------------------------------------
+# Make the XML-RPC dispatcher for pages.select and pages.get_meta
+def _MakeXmlRpc(wiki):
+    dispatcher=xmlrpc.server.SimpleXMLRPCDispatcher(allow_none=True)
+
+    def Select(args):
+        return wiki.NamesByUpdate()
+
+    def GetMeta(args):
+        out={}
+        for name in args["pages"][:10]:
+            page=wiki.Page(name)
+            if page is not None:
+                out[name]={"fullname": name, "created_at": _IsoDate(page["times"][0]), "updated_at": _IsoDate(page["times"][-1]), "revisions": len(page["times"])-1}
+        return out
+
+    dispatcher.register_function(Select, "pages.select")
+    dispatcher.register_function(GetMeta, "pages.get_meta")
+    return dispatcher
+
+
+class MockWikidotServer(http.server.ThreadingHTTPServer):
+    daemon_threads=True
+
+    # Serve wiki (a SyntheticWiki) on port (0 picks a free one), adding latency seconds (on average) to each request and failing errorRate of them with a 503
+    def __init__(self, wiki, port=0, latency=0.0, errorRate=0.0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.wiki=wiki
+        self.latency=latency
+        self.errorRate=errorRate
+        self.requests=0
+        self.statsLock=threading.Lock()
+        self.modules=_Modules(wiki)
+        self.xmlrpc=_MakeXmlRpc(wiki)
+        self.thread=None
+
+    @property
+    def baseUrl(self):
+        return "http://127.0.0.1:"+str(self.server_address[1])
+
+    @property
+    def xmlrpcUrl(self):
+        return self.baseUrl+"/xml-rpc-api.php"
+
+    # Run the server in a background thread
+    def Start(self):
+        self.thread=threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+#--------------------------------------------------------
+# Usage: python MockWikidot.py [port] [pages]
+if __name__ == "__main__":
+    port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    pages=int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    server=MockWikidotServer(SyntheticWiki(pages), port)
+    print("Serving a synthetic wiki of "+str(pages)+" pages at "+server.baseUrl)
+    server.serve_forever()
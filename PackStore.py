@@ -0,0 +1,261 @@
+import difflib
+import json
+import os
+import shutil
+import struct
+import sys
+import zlib
+
+# Pack storage for the versions of a page: an alternative to one Vnnnn directory per version.
+# A page's whole history is kept in two files in its page directory:
+#   history.pack -- the versions, one record after another, each either a full snapshot of the source or a delta against another version
+#   history.idx  -- an index of the records: version number, the version it's a delta against (-1 for a snapshot), and where it is in the pack
+# Successive versions of a page are mostly the same text, so deltas are small, and a page is two files rather than hundreds.
+#
+# Versions usually arrive newest first, so a delta is made against the nearest version already stored rather than the predecessor.
+# To keep reads quick, no chain of deltas gets longer than snapshotInterval: after that a full snapshot is stored.
+#
+# Each record in the pack is a header followed by the zlib-compressed metadata.xml and the zlib-compressed source (or delta).
+# The index is written after the record, so after a crash the pack may have records the index lacks (or a partial last record).
+# Readers go by the index alone and ignore anything in the pack beyond it, since that may be a record still being written by the page's owner.
+# Only a writer brings the index up to date with the pack (rebuilding it, and truncating any partial record), just before it first adds to the pack.
+
+packFileName="history.pack"
+indexFileName="history.idx"
+snapshotInterval=16
+
+_recordHeader=struct.Struct(">4sIiII")      # magic, version, base (-1 for a snapshot), length of metadata, length of data
+_recordMagic=b"HDPK"
+_indexEntry=struct.Struct(">IiQI")          # version, base, offset of record, length of record
+
+
+#--------------------------------------------------------
+# Make a delta turning the lines of base into the lines of source
+# It's a list of ["c", i1, i2] (copy base lines i1 to i2) and ["i", [lines]] (insert lines)
+def MakeDelta(base, source):
+    baseLines=base.splitlines(keepends=True)
+    lines=source.splitlines(keepends=True)
+    delta=[]
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, baseLines, lines, autojunk=False).get_opcodes():
+        if tag == "equal":
+            delta.append(["c", i1, i2])
+        elif j2 > j1:
+            delta.append(["i", lines[j1:j2]])
+    return delta
+
+
+#--------------------------------------------------------
+# Apply a delta made by MakeDelta to base
+def ApplyDelta(base, delta):
+    baseLines=base.splitlines(keepends=True)
+    out=[]
+    for op in delta:
+        if op[0] == "c":
+            out.extend(baseLines[op[1]:op[2]])
+        else:
+            out.extend(op[1])
+    return "".join(out)
+
+
+class PackStore:
+
+    def __init__(self, pagePath):
+        self.pagePath=pagePath
+        self.packPath=os.path.join(pagePath, packFileName)
+        self.indexPath=os.path.join(pagePath, indexFileName)
+        self.index={}       # version: (base, offset, length)
+        self.repaired=False
+        self._LoadIndex()
+
+    #--------------------------------------------------------
+    # Read the index (ignoring any entry cut short, or describing more than is in the pack)
+    def _LoadIndex(self):
+        self.index={}
+        self.end=0
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath, "rb") as f:
+                data=f.read()
+            for i in range(0, len(data)-_indexEntry.size+1, _indexEntry.size):
+                version, base, offset, length=_indexEntry.unpack_from(data, i)
+                self.index[version]=(base, offset, length)
+                self.end=max(self.end, offset+length)
+        packSize=os.path.getsize(self.packPath) if os.path.exists(self.packPath) else 0
+        if packSize < self.end:
+            self.index=dict((v, e) for v, e in self.index.items() if e[1]+e[2] <= packSize)
+
+    #--------------------------------------------------------
+    # Bring the index up to date with the pack if they disagree.  (Only the page's writer may do this.)
+    def _Repair(self):
+        self.repaired=True
+        self._LoadIndex()
+        packSize=os.path.getsize(self.packPath) if os.path.exists(self.packPath) else 0
+        if packSize < self.end:
+            # The index describes more than is in the pack, so it can't be trusted at all
+            self.index={}
+            self._Rescan(0, packSize)
+        elif packSize > self.end:
+            self._Rescan(self.end, packSize)
+
+    #--------------------------------------------------------
+    # Scan the pack from offset start, adding what's found to the index, and truncating any partial record at the end
+    def _Rescan(self, start, packSize):
+        print("   Re-indexing "+self.packPath)
+        offset=start
+        with open(self.packPath, "rb") as f:
+            while offset+_recordHeader.size <= packSize:
+                f.seek(offset)
+                magic, version, base, metaLen, dataLen=_recordHeader.unpack(f.read(_recordHeader.size))
+                length=_recordHeader.size+metaLen+dataLen
+                if magic != _recordMagic or offset+length > packSize:
+                    break
+                self.index[version]=(base, offset, length)
+                offset=offset+length
+        if offset < packSize:
+            with open(self.packPath, "r+b") as f:
+                f.truncate(offset)
+        self._WriteIndex()
+
+    #--------------------------------------------------------
+    def _WriteIndex(self):
+        with open(self.indexPath+".tmp", "wb") as f:
+            for version, (base, offset, length) in sorted(self.index.items(), key=lambda x: x[1][1]):
+                f.write(_indexEntry.pack(version, base, offset, length))
+        os.replace(self.indexPath+".tmp", self.indexPath)
+
+    #--------------------------------------------------------
+    # The set of version numbers stored
+    def Versions(self):
+        return set(self.index.keys())
+
+    #--------------------------------------------------------
+    def Has(self, number):
+        return int(number) in self.index
+
+    #--------------------------------------------------------
+    def _ReadRecord(self, number):
+        base, offset, length=self.index[number]
+        with open(self.packPath, "rb") as f:
+            f.seek(offset)
+            record=f.read(length)
+        magic, version, base, metaLen, dataLen=_recordHeader.unpack_from(record)
+        meta=record[_recordHeader.size:_recordHeader.size+metaLen]
+        data=record[_recordHeader.size+metaLen:]
+        return base, zlib.decompress(meta), zlib.decompress(data)
+
+    #--------------------------------------------------------
+    # How many deltas have to be applied to get the given version
+    def _ChainLength(self, number):
+        length=0
+        while self.index[number][0] != -1:
+            number=self.index[number][0]
+            length=length+1
+        return length
+
+    #--------------------------------------------------------
+    # Return the metadata.xml of a version (as bytes)
+    def ReadMetadata(self, number):
+        base, meta, data=self._ReadRecord(int(number))
+        return meta
+
+    #--------------------------------------------------------
+    # Return the source of a version (as a string)
+    def ReadSource(self, number):
+        base, meta, data=self._ReadRecord(int(number))
+        if base == -1:
+            return data.decode("utf-8")
+        return ApplyDelta(self.ReadSource(base), json.loads(data.decode("utf-8")))
+
+    #--------------------------------------------------------
+    # Add a version: metadata is the bytes of its metadata.xml, source its text
+    def Add(self, number, metadata, source):
+        if not self.repaired:
+            self._Repair()
+        number=int(number)
+        if number in self.index:
+            return
+
+        # Find the nearest version stored to make a delta against
+        base=-1
+        if len(self.index) > 0:
+            nearest=min(self.index.keys(), key=lambda v: (abs(v-number), v > number))
+            if self._ChainLength(nearest) < snapshotInterval-1:
+                base=nearest
+        if base == -1:
+            data=source.encode("utf-8")
+        else:
+            data=json.dumps(MakeDelta(self.ReadSource(base), source)).encode("utf-8")
+
+        meta=zlib.compress(metadata)
+        data=zlib.compress(data)
+        os.makedirs(self.pagePath, exist_ok=True)
+        with open(self.packPath, "ab") as f:
+            offset=f.tell()
+            f.write(_recordHeader.pack(_recordMagic, number, base, len(meta), len(data)))
+            f.write(meta)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        length=_recordHeader.size+len(meta)+len(data)
+        self.index[number]=(base, offset, length)
+        with open(self.indexPath, "ab") as f:
+            f.write(_indexEntry.pack(number, base, offset, length))
+
+    #--------------------------------------------------------
+    # The compatibility view: write version number out as directory/Vnnnn/metadata.xml and directory/Vnnnn/source.txt
+    def ExportVersion(self, number, directory):
+        dir=os.path.join(directory, "V"+("0000"+str(number))[-4:])
+        os.makedirs(dir, exist_ok=True)
+        with open(os.path.join(dir, "metadata.xml"), "wb") as f:
+            f.write(self.ReadMetadata(number))
+        with open(os.path.join(dir, "source.txt"), "w") as f:
+            f.write(self.ReadSource(number))
+        return dir
+
+
+#--------------------------------------------------------
+# Move the Vnnnn directories of the page in pagePath into its pack, removing each directory once its version is safely in the pack
+def PackPage(pagePath):
+    store=PackStore(pagePath)
+    names=sorted(e.name for e in os.scandir(pagePath) if e.is_dir() and len(e.name) == 5 and e.name[0] == "V" and e.name[1:].isdigit())
+    for name in names:
+        dir=os.path.join(pagePath, name)
+        metaPath=os.path.join(dir, "metadata.xml")
+        sourcePath=os.path.join(dir, "source.txt")
+        if not os.path.exists(metaPath) or not os.path.exists(sourcePath):
+            continue    # Leave incomplete or placeholder directories alone
+        with open(metaPath, "rb") as f:
+            metadata=f.read()
+        with open(sourcePath) as f:
+            source=f.read()
+        store.Add(int(name[1:]), metadata, source)
+        if store.ReadSource(int(name[1:])) == source:
+            shutil.rmtree(dir)
+    return store
+
+
+#--------------------------------------------------------
+# Usage:
+#   python PackStore.py pack <historyRoot>                  -- convert every page in the tree to pack storage
+#   python PackStore.py export <pagePath> <directory>       -- write out all the versions in a page's pack as Vnnnn directories
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "pack":
+        count=0
+        for d1 in os.scandir(sys.argv[2]):
+            if not d1.is_dir():
+                continue
+            for d2 in os.scandir(d1.path):
+                if not d2.is_dir():
+                    continue
+                for page in os.scandir(d2.path):
+                    if page.is_dir():
+                        PackPage(page.path)
+                        count=count+1
+                        if count%100 == 0:
+                            print("*** "+str(count))
+    elif len(sys.argv) == 4 and sys.argv[1] == "export":
+        store=PackStore(sys.argv[2])
+        for number in sorted(store.Versions()):
+            store.ExportVersion(number, sys.argv[3])
+    else:
+        print("Usage: python PackStore.py pack <historyRoot>  or  python PackStore.py export <pagePath> <directory>")
+        sys.exit(1)
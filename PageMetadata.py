@@ -0,0 +1,105 @@
+import json
+import os
+import time
+import HistoryStore
+
+# A snapshot of every page's metadata, fetched through Wikidot's XML-RPC API and cached locally.
+# pages.get_meta returns, among other things, updated_at and the number of revisions for up to 10 pages per call.
+# That is enough to decide which pages need work without loading any of them in a browser:
+#   a page completed up to a watermark revision (see Manifest.py) is up to date unless the site has had revisions of it since
+#   otherwise, a page whose highest local version already equals its remote revision count (and which has no gaps) is up to date.
+
+snapshotFileName="metadata.json"
+batchSize=10        # The most pages Wikidot's pages.get_meta will take in one call
+
+
+#--------------------------------------------------------
+# Fetch metadata for the pages in wikiNames (the names as Wikidot knows them) using server, an xmlrpc ServerProxy
+# Returns a dictionary keyed by local page name of {"wikiName", "updated_at", "revisions"}
+def FetchMetadata(server, site, wikiNames):
+    snapshot={}
+    for i in range(0, len(wikiNames), batchSize):
+        batch=wikiNames[i:i+batchSize]
+        try:
+            metas=server.pages.get_meta({"site": site, "pages": batch})
+        except Exception as exception:
+            print("***Oops. "+type(exception).__name__+" while getting metadata for "+batch[0]+"...: "+str(exception))
+            continue
+        for wikiName, meta in metas.items():
+            snapshot[HistoryStore.LocalPageName(wikiName)]={"wikiName": wikiName, "updated_at": meta.get("updated_at"), "revisions": meta.get("revisions")}
+        if (i//batchSize)%100 == 0:
+            print("   Metadata fetched for "+str(min(i+batchSize, len(wikiNames)))+" of "+str(len(wikiNames))+" pages")
+    return snapshot
+
+
+#--------------------------------------------------------
+# Load the cached snapshot from historyRoot, if there is one no older than maxAgeHours
+def LoadMetadataSnapshot(historyRoot, maxAgeHours):
+    path=os.path.join(historyRoot, snapshotFileName)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        data=json.load(f)
+    if time.time()-data.get("fetched", 0) > maxAgeHours*3600:
+        return None
+    return data["pages"]
+
+
+#--------------------------------------------------------
+# The time (as a Unix time) the cached snapshot in historyRoot was fetched, or None if there isn't one
+# A snapshot shows the site as it was then, so a run which works from it has seen no edits made since
+def SnapshotTime(historyRoot):
+    path=os.path.join(historyRoot, snapshotFileName)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get("fetched")
+
+
+#--------------------------------------------------------
+# Save the snapshot to historyRoot, recording fetched as the time it was fetched
+# It's written to a temporary file and then renamed so that a crash can't leave a half-written cache
+def SaveMetadataSnapshot(historyRoot, snapshot, fetched):
+    path=os.path.join(historyRoot, snapshotFileName)
+    with open(path+".tmp", "w") as f:
+        json.dump({"fetched": fetched, "pages": snapshot}, f)
+    os.replace(path+".tmp", path)
+
+
+#--------------------------------------------------------
+# Return the snapshot for wikiNames, using the cached one if it's fresh enough and fetching (and caching) a new one otherwise
+def GetMetadataSnapshot(server, site, historyRoot, wikiNames, maxAgeHours):
+    snapshot=LoadMetadataSnapshot(historyRoot, maxAgeHours)
+    if snapshot is not None:
+        print("   Using cached metadata for "+str(len(snapshot))+" pages")
+        return snapshot
+    print("   Fetching metadata for "+str(len(wikiNames))+" pages")
+    fetched=time.time()     # When the fetch started, since the first pages' metadata is as of then
+    snapshot=FetchMetadata(server, site, wikiNames)
+    SaveMetadataSnapshot(historyRoot, snapshot, fetched)
+    return snapshot
+
+
+#--------------------------------------------------------
+# Does the local copy of pageName (as recorded in the manifest) need work to match the snapshot?
+def PageNeedsWork(snapshot, manifest, pageName):
+    meta=snapshot.get(pageName)
+    if meta is None or meta["revisions"] is None:
+        return True     # We know nothing, so look
+    watermark=manifest.Watermark(pageName)
+    if watermark is not None:
+        return not manifest.IsComplete(pageName) or watermark < meta["revisions"]
+    # A page never completed, or completed before there were watermarks: judge by the versions we have
+    existingVersions=manifest.Versions(pageName)
+    if len(existingVersions) == 0:
+        return True
+    highest=max(existingVersions)
+    if HistoryStore.LowestVersionNeeded(existingVersions) < highest:
+        return True     # There's a gap to fill
+    return highest < meta["revisions"]
+
+
+#--------------------------------------------------------
+# Return the pages in pageNames (keeping their order) which need work
+def PagesNeedingWork(snapshot, manifest, pageNames):
+    return [p for p in pageNames if PageNeedsWork(snapshot, manifest, p)]
@@ -0,0 +1,237 @@
+import multiprocessing
+import time
+import urllib.parse
+import xmlrpc.client
+
+# One rate limit for every request we make of the site, whichever process, thread or path makes it:
+#   page loads, history pager clicks and source views in the browser, AJAX module calls, attachment downloads and XML-RPC calls.
+# It's a token bucket: requests are let through at a steady rate (with a burst of up to a second's worth), and a request which finds the bucket empty waits.
+# The rate tunes itself to how the site is coping (additive increase, multiplicative decrease):
+#   each success raises it a little, so that it climbs by about increasePerSecond requests/second every second (by default, from nothing to the ceiling in 40 seconds)
+#   a 503 or 429 (the site asking us to slow down) halves it, and nothing is sent until the site's Retry-After (or backoffSeconds) has passed
+#   any other failure (a 5xx, a network error, a page which never appeared) cuts it by a quarter
+#   responses becoming much slower than the fastest seen also cut it, by a tenth, since that's the site starting to struggle
+# A burst of failures from requests which were all in flight together cuts the rate only once.
+#
+# The limiter's state lives in shared memory, so the worker processes (see WorkerPool.py) share one limit rather than each having their own.
+# Configure() makes the limiters in the main process before any workers start; they're handed them, and Install() them.
+# Each site (see Sites.py) can have a limiter of its own, found from a request's URL by ForUrl(); requests to any other host share the default one.
+
+_rate=0             # Indexes into the shared state
+_tokens=1
+_lastRefill=2
+_latency=3          # Moving average of the response time
+_fastest=4          # Fastest response time seen
+_lastCut=5          # When the rate was last cut
+_pausedUntil=6
+_requests=7
+_failures=8
+_throttled=9
+_peak=10            # Highest rate reached
+_stateSize=11
+
+
+class RateLimiter:
+
+    # ceiling is the most requests per second ever sent; floor the fewest we'll drop to; rate the rate to start at (a quarter of the ceiling by default)
+    def __init__(self, ceiling=4.0, floor=0.2, rate=None, increasePerSecond=None, backoffSeconds=30, slowFactor=4.0):
+        self.ceiling=ceiling
+        self.floor=floor
+        self.increasePerSecond=increasePerSecond if increasePerSecond is not None else ceiling/40
+        self.backoffSeconds=backoffSeconds
+        self.slowFactor=slowFactor
+        self.state=multiprocessing.Array("d", _stateSize)     # Comes with a lock shared by all processes (and threads)
+        rate=min(ceiling, max(floor, rate if rate is not None else ceiling/4))
+        self.state[_rate]=rate
+        self.state[_peak]=rate
+        self.state[_tokens]=1
+        self.state[_lastRefill]=time.monotonic()
+        self.host=None
+
+    #--------------------------------------------------------
+    # Wait until a request may be sent.  Returns the time it was let through, to be handed to Record() when the response is in.
+    def Acquire(self):
+        while True:
+            with self.state.get_lock():
+                now=time.monotonic()
+                s=self.state
+                if now >= s[_pausedUntil]:
+                    s[_tokens]=min(max(1.0, s[_rate]), s[_tokens]+(now-s[_lastRefill])*s[_rate])
+                    s[_lastRefill]=now
+                    if s[_tokens] >= 1:
+                        s[_tokens]=s[_tokens]-1
+                        return now
+                    wait=(1-s[_tokens])/s[_rate]
+                else:
+                    wait=s[_pausedUntil]-now
+                    s[_lastRefill]=s[_pausedUntil]      # Nothing accrues while we're paused
+            time.sleep(min(wait, 1.0))
+
+    #--------------------------------------------------------
+    # Record the outcome of a request let through at start
+    # status is its HTTP status, or None if it failed without one; retryAfter is the seconds the server asked us to wait, if it said
+    def Record(self, start, status, retryAfter=None):
+        with self.state.get_lock():
+            now=time.monotonic()
+            s=self.state
+            s[_requests]=s[_requests]+1
+            if status in (429, 503):
+                s[_throttled]=s[_throttled]+1
+                if self._Cut(now, 0.5):
+                    s[_pausedUntil]=now+(retryAfter if retryAfter is not None else self.backoffSeconds)
+                    s[_tokens]=0
+                    print("   The site asked us to slow down (HTTP "+str(status)+"): now at most "+str(round(s[_rate], 2))+" requests a second")
+            elif status is None or status >= 500:
+                s[_failures]=s[_failures]+1
+                self._Cut(now, 0.75)
+            else:
+                latency=now-start
+                s[_latency]=latency if s[_latency] == 0 else 0.8*s[_latency]+0.2*latency
+                s[_fastest]=latency if s[_fastest] == 0 else min(s[_fastest], latency)
+                if s[_latency] > self.slowFactor*s[_fastest] and s[_latency] > s[_fastest]+0.5:
+                    self._Cut(now, 0.9)
+                else:
+                    s[_rate]=min(self.ceiling, s[_rate]+self.increasePerSecond/s[_rate])
+                    s[_peak]=max(s[_peak], s[_rate])
+
+    # Cut the rate by factor, unless it was cut less than a second ago (in which case this is the same trouble).  Returns True if it was cut.
+    # (Called with the lock held.)
+    def _Cut(self, now, factor):
+        s=self.state
+        if now-s[_lastCut] < 1.0:
+            return False
+        s[_lastCut]=now
+        s[_rate]=max(self.floor, s[_rate]*factor)
+        s[_tokens]=min(s[_tokens], 1.0)
+        return True
+
+    #--------------------------------------------------------
+    # A request made other than through HttpSession (a page load or click in the browser, say) which has no HTTP status to report:
+    #       with limiter.Request() as request:
+    #           ...
+    #           if it didn't work:
+    #               request.Failed()
+    # An exception out of the block counts as a failure too
+    def Request(self):
+        return _Request(self)
+
+    #--------------------------------------------------------
+    def Rate(self):
+        return self.state[_rate]
+
+    #--------------------------------------------------------
+    # How long (in seconds) a request made now would have to wait
+    def Delay(self):
+        with self.state.get_lock():
+            now=time.monotonic()
+            s=self.state
+            if now < s[_pausedUntil]:
+                return s[_pausedUntil]-now
+            tokens=s[_tokens]+(now-s[_lastRefill])*s[_rate]
+            return 0.0 if tokens >= 1 else (1-tokens)/s[_rate]
+
+    #--------------------------------------------------------
+    # Print a summary of the requests made so far
+    def Report(self):
+        with self.state.get_lock():
+            s=list(self.state)
+        if s[_requests] == 0:
+            return
+        print("   Requests"+(" to "+self.host if self.host is not None else "")+": "+str(int(s[_requests]))+", "+str(int(s[_failures]))+" failed, "+str(int(s[_throttled]))+" throttled; "+
+              "rate now "+str(round(s[_rate], 2))+"/second (peak "+str(round(s[_peak], 2))+", ceiling "+str(self.ceiling)+"); "+
+              "mean response "+str(round(s[_latency], 2))+" seconds (fastest "+str(round(s[_fastest], 2))+")")
+
+
+class _Request:
+
+    def __init__(self, limiter):
+        self.limiter=limiter
+        self.failed=False
+
+    def __enter__(self):
+        self.start=self.limiter.Acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.limiter.Record(self.start, None if self.failed or excType is not None else 200)
+        return False
+
+    def Failed(self):
+        self.failed=True
+
+
+#--------------------------------------------------------
+# An xmlrpc.client transport which sends every call through the limiter
+class _Transport(xmlrpc.client.Transport):
+
+    def request(self, host, handler, request_body, verbose=False):
+        limiter=ForUrl("http://"+host)
+        start=limiter.Acquire()
+        try:
+            result=super().request(host, handler, request_body, verbose)
+        except xmlrpc.client.ProtocolError as exception:
+            limiter.Record(start, exception.errcode)
+            raise
+        except (OSError, xmlrpc.client.Error):
+            limiter.Record(start, None)
+            raise
+        limiter.Record(start, 200)
+        return result
+
+class _SafeTransport(_Transport, xmlrpc.client.SafeTransport):
+    pass
+
+
+#--------------------------------------------------------
+# An xmlrpc.client.ServerProxy whose calls are rate limited
+def ServerProxy(url):
+    return xmlrpc.client.ServerProxy(url, transport=_SafeTransport() if url.startswith("https") else _Transport())
+
+
+# This process's limiters: one for each host given its own limit, and one (under None) for every other host
+_limiters={}
+
+#--------------------------------------------------------
+# Make the limiter for requests to host (or, if host is None, the default one) with these settings
+# Do this in the main process before any workers start, so that they're handed it
+def Configure(ceiling=4.0, host=None, **settings):
+    limiter=RateLimiter(ceiling, **settings)
+    limiter.host=host.lower() if host is not None else None
+    _limiters[limiter.host]=limiter
+    return limiter
+
+
+#--------------------------------------------------------
+# All this process's limiters, to be handed to a worker process
+def Limiters():
+    Shared()
+    return dict(_limiters)
+
+
+#--------------------------------------------------------
+# Use the limiters made in another process
+def Install(limiters):
+    _limiters.clear()
+    _limiters.update(limiters)
+
+
+#--------------------------------------------------------
+# Return this process's default limiter, making one with the default settings if it hasn't been configured
+def Shared():
+    if None not in _limiters:
+        Configure()
+    return _limiters[None]
+
+
+#--------------------------------------------------------
+# Return the limiter for requests to url's host
+def ForUrl(url):
+    limiter=_limiters.get(urllib.parse.urlsplit(url).netloc.lower())
+    return limiter if limiter is not None else Shared()
+
+
+#--------------------------------------------------------
+# Print a summary of each limiter's requests
+def Report():
+    for host, limiter in sorted(_limiters.items(), key=lambda x: x[0] or ""):
+        limiter.Report()
@@ -0,0 +1,127 @@
+import collections
+import html
+import html.parser
+import re as Regex
+from datetime import datetime, timezone
+
+# Parsing of Wikidot's revision list (the table with id "revision-list" which the history button shows)
+# Each row of the table looks like
+#       <tr id="revision-row-nnnnnn">
+#           <td>number.</td>
+#           <td>(the radio buttons used to pick versions to compare)</td>
+#           <td>the flags: a series of single letters (N=new, S=source changed, T=title changed, F=file change, A=tags changed, ...)</td>
+#           <td>the V S R buttons</td>
+#           <td>the user who made the change</td>
+#           <td>the date</td>
+#           <td>the comment, if any</td>
+#       </tr>
+
+# One row of the revision list
+# number is an int; id is the revision's global ID (the nnnnnn in revision-row-nnnnnn); the rest are strings
+Revision=collections.namedtuple("Revision", ["number", "id", "type", "user", "date", "comment"])
+
+
+#--------------------------------------------------------
+# The flags are saved in metadata.xml as they appear in the text of the row: each letter preceded by a space
+def FormatFlags(flags):
+    return "".join(" "+f for f in flags.split())
+
+
+#--------------------------------------------------------
+# Wikidot shows dates as 'dd mmm yyyy'.  Raw HTML carries the date as a Unix timestamp (a class of the form time_nnnnnnnnnn) which javascript formats.
+def FormatTimestamp(timestamp):
+    dt=datetime.fromtimestamp(int(timestamp), tz=timezone.utc)
+    return str(dt.day)+" "+dt.strftime("%b %Y")
+
+
+#--------------------------------------------------------
+# Work out which pages of the revision list hold versions we don't have
+# The list is newest first, perPage rows to a page, so with a newest revision number of top, version v is on page (top-v)//perPage+1
+# If wanted is given, only the versions in it are looked for; otherwise every version from 0 to top is
+# Returns the list of pages (counting from 1) in ascending order
+def PagerPagesNeeded(top, perPage, existingVersions, wanted=None):
+    if perPage <= 0:
+        return []
+    versions=range(0, top+1) if wanted is None else [v for v in wanted if 0 <= v <= top]
+    return sorted(set((top-v)//perPage+1 for v in versions if v not in existingVersions))
+
+
+#--------------------------------------------------------
+# Turn a list of the text of a row's cells into a Revision
+def RevisionFromCells(id, cells):
+    number=int(cells[0].strip().rstrip("."))
+    return Revision(number, id, FormatFlags(cells[2]), cells[4].strip(), cells[5].strip(), cells[6].strip())
+
+
+#--------------------------------------------------------
+# An HTML parser which picks the revision rows out of the body of the revision list
+class _RevisionListParser(html.parser.HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.revisions=[]
+        self.pageCount=1
+        self._rowId=None
+        self._cells=None
+        self._inCell=False
+        self._inPagerNo=False
+        self._pagerNo=""
+
+    def handle_starttag(self, tag, attrs):
+        attrs=dict(attrs)
+        if tag == "tr" and (attrs.get("id") or "").startswith("revision-row-"):
+            self._rowId=attrs["id"].replace("revision-row-", "")
+            self._cells=[]
+        elif tag == "td" and self._cells is not None:
+            self._cells.append("")
+            self._inCell=True
+        elif tag == "span" and self._cells is not None and self._inCell:
+            # The date is in a span whose classes include time_nnnnnnnnnn
+            m=Regex.search(r"\btime_(\d+)", attrs.get("class") or "")
+            if m is not None:
+                self._cells[-1]=FormatTimestamp(m.group(1))
+                self._inCell=False      # Ignore the span's (differently formatted) text
+        elif tag == "span" and "pager-no" in (attrs.get("class") or ""):
+            self._inPagerNo=True
+
+    def handle_endtag(self, tag):
+        if tag == "td":
+            self._inCell=False
+        elif tag == "tr" and self._cells is not None:
+            if len(self._cells) >= 7:
+                self.revisions.append(RevisionFromCells(self._rowId, self._cells))
+            self._rowId=None
+            self._cells=None
+        elif tag == "span" and self._inPagerNo:
+            self._inPagerNo=False
+            m=Regex.search(r"of\s+(\d+)", self._pagerNo)
+            if m is not None:
+                self.pageCount=int(m.group(1))
+
+    def handle_data(self, data):
+        if self._inCell:
+            self._cells[-1]=self._cells[-1]+data
+        if self._inPagerNo:
+            self._pagerNo=self._pagerNo+data
+
+
+#--------------------------------------------------------
+# Parse the HTML of a revision list
+# Return a list of Revisions (newest first, as Wikidot lists them) and the number of pages in the list's pager
+def ParseRevisionList(body):
+    parser=_RevisionListParser()
+    parser.feed(body)
+    parser.close()
+    return parser.revisions, parser.pageCount
+
+
+#--------------------------------------------------------
+# Extract the text of a page's source from the HTML returned when viewing a revision's source
+# The source is in <div class="page-source">, with line breaks as <br/>
+def ParseSource(body):
+    m=Regex.search(r'<div class="page-source">(.*)</div>', body, Regex.DOTALL)
+    if m is not None:
+        body=m.group(1)
+    body=Regex.sub(r"<br\s*/?>\n?", "\n", body)
+    body=Regex.sub(r"<[^>]+>", "", body)
+    return html.unescape(body).replace("\xa0", " ")
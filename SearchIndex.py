@@ -0,0 +1,598 @@
+import concurrent.futures
+import heapq
+import json
+import math
+import mmap
+import os
+import re as Regex
+import struct
+import sys
+import threading
+import time
+import zlib
+import HistoryStore
+import Manifest
+
+# A full-text index of every downloaded version, so that "when did this word appear on (or vanish from) a page?" is a lookup rather than a grep of the whole tree.
+# It's an inverted index: each term maps to the pages containing it and, for each page, the versions which contain it.
+# A term usually stays on a page for a run of consecutive versions, so the versions are kept as ranges ([first, last] pairs), which also makes the first and last version free.
+#
+# The index lives in historyRoot/search as a set of segment files (seg-*.hdsx).  Each is written once, to a temporary file renamed into place, and never changed.
+# New versions are indexed as they're committed: each process collects postings in memory and writes them out as a new segment every so often.
+# Segments are merged (a streaming merge, one term at a time) a tier at a time: once there are mergeFactor segments of about the same size, they become one of the next size up.
+#   So each version is rewritten only about once per tier, rather than on every merge.
+# Each version written out in a segment is marked indexed in the manifest.  Anything committed but not indexed (say, by a worker which exited with postings still in memory)
+#   is picked up by Update(), which indexes the versions the manifest doesn't have marked -- usually none, so it's cheap.
+# Versions are only indexed as they're downloaded if the tree's indexing is switched on (SetEnabled()), which HistoryDownloader does, or not, each run.
+# A version thrown away to be fetched again (see IntegrityScanner.py) is given a tombstone in search/tombstones.jsonl: {"t": time in ns, "page": name, "number": n}.
+#   Its postings in segments written before then are ignored, and dropped for good when the segments are merged.
+#
+# A segment file is
+#       magic
+#       the postings blocks, one per term, each a flag byte (1 if zlib-compressed) and then
+#           varint count of pages, and for each: varint page number (as a delta from the previous one), varint count of ranges, and for each range: varint start (as a delta from the previous end), varint length
+#       the pages table: varint count, and for each page: varint length, name (utf-8), varint count of ranges of versions indexed, and the ranges as above
+#       the terms table: varint count, and for each term (in sorted order): varint length, term (utf-8), varint length of its block
+#       the footer: offsets (8 bytes each) of the pages table and the terms table, and the magic again
+#
+# python SearchIndex.py search <historyRoot> <words...>
+# python SearchIndex.py update <historyRoot>
+# python SearchIndex.py rebuild <historyRoot> [processes]
+# python SearchIndex.py merge <historyRoot>
+
+indexDirName="search"
+enabledFileName="enabled"               # Present in the search directory if versions are to be indexed as they're downloaded
+tombstonesFileName="tombstones.jsonl"
+maxPostings=500000      # Write out a segment once this many postings are held in memory
+mergeFactor=4           # Merge segments once there are this many of about the same size
+smallestTier=1<<16      # Segments smaller than this (in bytes) all count as the same size
+maxTermLength=40
+
+_magic=b"HDSX1\n"
+_footer=struct.Struct(">QQ")
+_wordPattern=Regex.compile(r"\w+", Regex.UNICODE)
+
+
+#--------------------------------------------------------
+# The set of terms in a text: its words, lower-cased, of two characters or more
+def Terms(text):
+    return set(w for w in (m.lower() for m in _wordPattern.findall(text)) if 2 <= len(w) <= maxTermLength)
+
+
+#--------------------------------------------------------
+def _PutVarint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n=n >> 7
+    out.append(n)
+
+
+def _GetVarint(data, pos):
+    n=0
+    shift=0
+    while True:
+        b=data[pos]
+        pos=pos+1
+        n=n | ((b & 0x7f) << shift)
+        if b < 0x80:
+            return n, pos
+        shift=shift+7
+
+
+#--------------------------------------------------------
+# Turn a collection of version numbers into a sorted list of [first, last] ranges
+def ToRanges(versions):
+    ranges=[]
+    for v in sorted(versions):
+        if len(ranges) > 0 and v <= ranges[-1][1]+1:
+            ranges[-1][1]=max(ranges[-1][1], v)
+        else:
+            ranges.append([v, v])
+    return ranges
+
+
+#--------------------------------------------------------
+# Combine lists of ranges into one
+def _UnionRanges(*rangeLists):
+    merged=[]
+    for start, end in sorted(r for ranges in rangeLists for r in ranges):
+        if len(merged) > 0 and start <= merged[-1][1]+1:
+            merged[-1][1]=max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _PutRanges(out, ranges):
+    _PutVarint(out, len(ranges))
+    previous=0
+    for start, end in ranges:
+        _PutVarint(out, start-previous)
+        _PutVarint(out, end-start)
+        previous=end
+
+
+def _GetRanges(data, pos):
+    count, pos=_GetVarint(data, pos)
+    ranges=[]
+    previous=0
+    for i in range(count):
+        delta, pos=_GetVarint(data, pos)
+        length, pos=_GetVarint(data, pos)
+        ranges.append([previous+delta, previous+delta+length])
+        previous=previous+delta+length
+    return ranges, pos
+
+
+#--------------------------------------------------------
+# Take the version numbers in numbers out of a list of ranges
+def _RemoveFromRanges(ranges, numbers):
+    out=[]
+    for start, end in ranges:
+        for n in sorted(x for x in numbers if start <= x <= end):
+            if n > start:
+                out.append([start, n-1])
+            start=n+1
+        if start <= end:
+            out.append([start, end])
+    return out
+
+
+#--------------------------------------------------------
+# Encode the postings of one term, {page index: ranges}, as a block
+def _EncodeBlock(postings):
+    out=bytearray()
+    _PutVarint(out, len(postings))
+    previous=0
+    for pageIndex in sorted(postings):
+        _PutVarint(out, pageIndex-previous)
+        _PutRanges(out, postings[pageIndex])
+        previous=pageIndex
+    if len(out) > 64:
+        return b"\x01"+zlib.compress(bytes(out))
+    return b"\x00"+bytes(out)
+
+
+def _DecodeBlock(block):
+    data=zlib.decompress(block[1:]) if block[0] == 1 else block[1:]
+    count, pos=_GetVarint(data, 0)
+    postings={}
+    pageIndex=0
+    for i in range(count):
+        delta, pos=_GetVarint(data, pos)
+        pageIndex=pageIndex+delta
+        postings[pageIndex], pos=_GetRanges(data, pos)
+    return postings
+
+
+#--------------------------------------------------------
+# Write a segment into directory
+# docs is {page name: ranges of versions indexed}; terms is an iterable of (term, {page name: ranges}) in sorted order of term
+def _WriteSegment(directory, docs, terms):
+    pageNames=sorted(docs)
+    pageIndex=dict((name, i) for i, name in enumerate(pageNames))
+    name="seg-"+str(time.time_ns())+"-"+str(os.getpid())+".hdsx"
+    path=os.path.join(directory, name)
+    termTable=bytearray()
+    termCount=0
+    with open(path+".tmp", "wb") as f:
+        f.write(_magic)
+        for term, postings in terms:
+            block=_EncodeBlock(dict((pageIndex[p], ranges) for p, ranges in postings.items()))
+            f.write(block)
+            encoded=term.encode("utf-8")
+            _PutVarint(termTable, len(encoded))
+            termTable.extend(encoded)
+            _PutVarint(termTable, len(block))
+            termCount=termCount+1
+
+        pagesOffset=f.tell()
+        pageTable=bytearray()
+        _PutVarint(pageTable, len(pageNames))
+        for p in pageNames:
+            encoded=p.encode("utf-8")
+            _PutVarint(pageTable, len(encoded))
+            pageTable.extend(encoded)
+            _PutRanges(pageTable, docs[p])
+        f.write(pageTable)
+
+        termsOffset=f.tell()
+        count=bytearray()
+        _PutVarint(count, termCount)
+        f.write(count)
+        f.write(termTable)
+        f.write(_footer.pack(pagesOffset, termsOffset))
+        f.write(_magic)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path+".tmp", path)
+    return path
+
+
+class Segment:
+
+    # Read a segment's pages table and terms table.  The file is mapped into memory, so the postings are read from it only as they're needed.
+    # tombstones is a dictionary of (page name, number): time of the tombstone (see LoadTombstones); those laid after the segment was written hide its postings of that version.
+    def __init__(self, path, tombstones=None):
+        self.path=path
+        self.time=int(os.path.basename(path).split("-")[1])
+        with open(path, "rb") as f:
+            data=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(_magic)] != _magic or data[-len(_magic):] != _magic:
+            data.close()
+            raise ValueError(path+" is not a complete index segment")
+        pagesOffset, termsOffset=_footer.unpack_from(data, len(data)-len(_magic)-_footer.size)
+
+        self.pages=[]
+        self.docs={}
+        count, pos=_GetVarint(data, pagesOffset)
+        for i in range(count):
+            length, pos=_GetVarint(data, pos)
+            name=data[pos:pos+length].decode("utf-8")
+            self.docs[name], pos=_GetRanges(data, pos+length)
+            self.pages.append(name)
+
+        self.terms={}       # term: (offset, length) of its block
+        offset=len(_magic)
+        count, pos=_GetVarint(data, termsOffset)
+        for i in range(count):
+            length, pos=_GetVarint(data, pos)
+            term=data[pos:pos+length].decode("utf-8")
+            blockLength, pos=_GetVarint(data, pos+length)
+            self.terms[term]=(offset, blockLength)
+            offset=offset+blockLength
+        self._data=data
+
+        self.removed={}     # page name: set of versions whose postings here are dead
+        for (pageName, number), t in (tombstones or {}).items():
+            if t > self.time and pageName in self.docs:
+                self.removed.setdefault(pageName, set()).add(number)
+        for pageName, numbers in self.removed.items():
+            self.docs[pageName]=_RemoveFromRanges(self.docs[pageName], numbers)
+
+    #--------------------------------------------------------
+    def Close(self):
+        self._data.close()
+
+    #--------------------------------------------------------
+    # The postings of a term as {page name: ranges of versions}
+    def Postings(self, term):
+        if term not in self.terms:
+            return {}
+        offset, length=self.terms[term]
+        postings=dict((self.pages[i], ranges) for i, ranges in _DecodeBlock(self._data[offset:offset+length]).items())
+        for pageName in self.removed.keys() & postings.keys():
+            postings[pageName]=_RemoveFromRanges(postings[pageName], self.removed[pageName])
+            if len(postings[pageName]) == 0:
+                del postings[pageName]
+        return postings
+
+    #--------------------------------------------------------
+    # All the terms with their postings, in sorted order
+    def Items(self):
+        for term in sorted(self.terms):
+            yield term, self.Postings(term)
+
+
+#--------------------------------------------------------
+def _IndexDir(historyRoot):
+    return os.path.join(historyRoot, indexDirName)
+
+
+def SegmentPaths(historyRoot):
+    directory=_IndexDir(historyRoot)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, e.name) for e in os.scandir(directory) if e.name.startswith("seg-") and e.name.endswith(".hdsx"))
+
+
+# Load the segments in paths (by default all the segments of historyRoot's index)
+def _LoadSegments(historyRoot, paths=None):
+    tombstones=LoadTombstones(historyRoot)
+    segments=[]
+    for path in paths if paths is not None else SegmentPaths(historyRoot):
+        try:
+            segments.append(Segment(path, tombstones))
+        except (OSError, ValueError, IndexError, struct.error) as exception:
+            print("***Skipping index segment "+path+": "+type(exception).__name__+": "+str(exception))
+    return segments
+
+
+class IndexWriter:
+
+    # Collects the postings of versions as they're added and writes them out as segments of the index of historyRoot
+    def __init__(self, historyRoot):
+        self.historyRoot=historyRoot
+        self.directory=_IndexDir(historyRoot)
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock=threading.Lock()
+        self.postings={}        # term: {page name: set of versions}
+        self.docs={}            # page name: set of versions
+        self.count=0
+
+    #--------------------------------------------------------
+    def Add(self, pageName, number, source):
+        with self.lock:
+            for term in Terms(source):
+                self.postings.setdefault(term, {}).setdefault(pageName, set()).add(int(number))
+                self.count=self.count+1
+            self.docs.setdefault(pageName, set()).add(int(number))
+        if self.count >= maxPostings:
+            self.Flush()
+
+    #--------------------------------------------------------
+    # An onCommit for the VersionWriter: do then() (the usual onCommit), then index the version now that it's safely on disk
+    def Committed(self, then, pageName, number, source):
+        then()
+        self.Add(pageName, number, source)
+
+    #--------------------------------------------------------
+    # Write out what's been collected as a new segment, and mark its versions indexed in the manifest
+    def Flush(self):
+        with self.lock:
+            if len(self.docs) == 0:
+                return None
+            postings, docs=self.postings, self.docs
+            self.postings={}
+            self.docs={}
+            self.count=0
+        terms=((term, dict((p, ToRanges(v)) for p, v in postings[term].items())) for term in sorted(postings))
+        path=_WriteSegment(self.directory, dict((p, ToRanges(v)) for p, v in docs.items()), terms)
+        Manifest.ForRoot(self.historyRoot).MarkIndexed((p, n) for p, numbers in docs.items() for n in numbers)
+        return path
+
+
+# One writer per history root per process
+_writers={}
+
+#--------------------------------------------------------
+# Return this process's index writer for historyRoot, or None if historyRoot isn't being indexed
+def ForRoot(historyRoot):
+    key=(os.getpid(), historyRoot)
+    if key not in _writers:
+        _writers[key]=IndexWriter(historyRoot) if IsEnabled(historyRoot) else None
+    return _writers[key]
+
+
+#--------------------------------------------------------
+# Switch indexing versions of historyRoot as they're downloaded on or off
+# (It's recorded in the tree rather than in this process, so that the worker processes see it too.)
+def SetEnabled(historyRoot, enabled):
+    path=os.path.join(_IndexDir(historyRoot), enabledFileName)
+    if enabled:
+        os.makedirs(_IndexDir(historyRoot), exist_ok=True)
+        with open(path, "w"):
+            pass
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+#--------------------------------------------------------
+def IsEnabled(historyRoot):
+    return os.path.exists(os.path.join(_IndexDir(historyRoot), enabledFileName))
+
+
+#--------------------------------------------------------
+# Lay tombstones over versions of a page (a collection of numbers) which have been thrown away, so that what the index has of them is ignored
+def RemoveVersions(historyRoot, pageName, numbers):
+    if not os.path.isdir(_IndexDir(historyRoot)) or len(numbers) == 0:
+        return
+    t=time.time_ns()
+    data="".join(json.dumps({"t": t, "page": pageName, "number": int(n)})+"\n" for n in sorted(numbers)).encode("utf-8")
+    fd=os.open(os.path.join(_IndexDir(historyRoot), tombstonesFileName), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+#--------------------------------------------------------
+# The tombstones of historyRoot's index as a dictionary of (page name, number): time (in ns) of the latest tombstone laid on it
+def LoadTombstones(historyRoot):
+    path=os.path.join(_IndexDir(historyRoot), tombstonesFileName)
+    tombstones={}
+    if not os.path.exists(path):
+        return tombstones
+    with open(path) as f:
+        for line in f:
+            try:
+                r=json.loads(line)
+            except ValueError:
+                continue    # A line cut short by a crash
+            key=(r["page"], r["number"])
+            tombstones[key]=max(tombstones.get(key, 0), r["t"])
+    return tombstones
+
+
+#--------------------------------------------------------
+# Merge segments into one, a term at a time: those in paths, or by default all of them
+def Merge(historyRoot, paths=None):
+    segments=_LoadSegments(historyRoot, paths)
+    if len(segments) == 0 or (len(segments) == 1 and len(segments[0].removed) == 0):     # (A lone segment is rewritten if that drops dead postings)
+        for s in segments:
+            s.Close()
+        return
+    print("   Merging "+str(len(segments))+" index segments")
+    docs={}
+    for s in segments:
+        for p, ranges in s.docs.items():
+            docs[p]=_UnionRanges(docs.get(p, []), ranges)
+
+    def MergedTerms():
+        term=None
+        postings={}
+        for t, p in heapq.merge(*[s.Items() for s in segments], key=lambda x: x[0]):
+            if t != term:
+                if term is not None:
+                    yield term, postings
+                term=t
+                postings={}
+            for page, ranges in p.items():
+                postings[page]=_UnionRanges(postings.get(page, []), ranges)
+        if term is not None:
+            yield term, postings
+
+    _WriteSegment(_IndexDir(historyRoot), docs, MergedTerms())
+    for s in segments:
+        s.Close()
+        os.remove(s.path)
+    # Once every segment has been merged, none has any dead postings left, so the tombstones have done their job
+    # (After merging just some, the tombstones are still needed for the others.  The merged segment is newer than all of them, so they don't touch it.)
+    path=os.path.join(_IndexDir(historyRoot), tombstonesFileName)
+    if paths is None and os.path.exists(path):
+        os.remove(path)
+
+
+#--------------------------------------------------------
+# The size tier of a segment file: segments in the same tier are within a factor of mergeFactor of each other's size
+def _Tier(size):
+    return int(math.log(max(size, smallestTier)/smallestTier, mergeFactor))
+
+
+#--------------------------------------------------------
+# Merge any tier which has mergeFactor segments in it (which may fill the tier above, and so on)
+def MergeIfNeeded(historyRoot):
+    while True:
+        tiers={}
+        for path in SegmentPaths(historyRoot):
+            tiers.setdefault(_Tier(os.path.getsize(path)), []).append(path)
+        full=[paths for tier, paths in sorted(tiers.items()) if len(paths) >= mergeFactor]
+        if len(full) == 0:
+            return
+        Merge(historyRoot, full[0])
+        if any(os.path.exists(path) for path in full[0]):
+            return      # A segment which couldn't be read is left alone, rather than tried again forever
+
+
+#--------------------------------------------------------
+# The set of (page name, version) already indexed, of the pages in pageNames (by default all pages)
+def IndexedVersions(historyRoot, pageNames=None):
+    indexed=set()
+    for s in _LoadSegments(historyRoot):
+        for p in (s.docs.keys() if pageNames is None else s.docs.keys() & pageNames):
+            for start, end in s.docs[p]:
+                indexed.update((p, v) for v in range(start, end+1))
+        s.Close()
+    return indexed
+
+
+#--------------------------------------------------------
+# Index some versions of historyRoot, reading them from the tree, into a segment of their own
+# (This is run in worker processes by Update, so it must be a module-level function.)
+def _IndexVersions(historyRoot, versions):
+    writer=IndexWriter(historyRoot)
+    for pageName, number in versions:
+        try:
+            metadata, source=HistoryStore.ReadVersion(HistoryStore.PagePath(historyRoot, pageName), number)
+        except (OSError, KeyError) as exception:
+            print("***Can't index "+pageName+" V"+str(number)+": "+type(exception).__name__+": "+str(exception))
+            continue
+        writer.Add(pageName, number, source)
+    writer.Flush()
+    return len(versions)
+
+
+#--------------------------------------------------------
+# Index the versions the manifest has and the index doesn't, using up to processes processes, then merge whatever segments are due a merge
+# Returns the number of versions indexed
+def Update(historyRoot, processes=1):
+    os.makedirs(_IndexDir(historyRoot), exist_ok=True)
+    manifest=Manifest.ForRoot(historyRoot)
+    unmarked=manifest.UnindexedVersions()
+    if len(unmarked) == 0:
+        MergeIfNeeded(historyRoot)
+        return 0
+    # Versions can be in the index without being marked (the manifest may have been rebuilt, or made before it recorded this), so look in the index for those pages
+    indexed=unmarked & IndexedVersions(historyRoot, set(p for p, n in unmarked))
+    manifest.MarkIndexed(indexed)
+    missing=sorted(unmarked-indexed)
+    if len(missing) == 0:
+        MergeIfNeeded(historyRoot)
+        return 0
+    print("   Indexing "+str(len(missing))+" versions")
+    if processes <= 1 or len(missing) < 1000:
+        _IndexVersions(historyRoot, missing)
+    else:
+        # Give each process a share of the pages (keeping each page's versions together, so its ranges stay whole)
+        chunks=[[] for i in range(processes)]
+        for pageName, number in missing:
+            chunks[hash(pageName)%processes].append((pageName, number))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            for future in [pool.submit(_IndexVersions, historyRoot, chunk) for chunk in chunks if len(chunk) > 0]:
+                future.result()
+    MergeIfNeeded(historyRoot)
+    return len(missing)
+
+
+#--------------------------------------------------------
+# Throw the index away and build it again from the tree
+def Rebuild(historyRoot, processes=None):
+    for path in SegmentPaths(historyRoot)+[os.path.join(_IndexDir(historyRoot), tombstonesFileName)]:
+        if os.path.exists(path):
+            os.remove(path)
+    Manifest.ForRoot(historyRoot).MarkIndexed(indexed=False)
+    count=Update(historyRoot, processes or os.cpu_count() or 1)
+    Merge(historyRoot)
+    return count
+
+
+#--------------------------------------------------------
+# Find the pages containing all the words of query
+# Returns a list of (page name, first version, last version, number of versions) of the versions containing them all, sorted by page name
+def Search(historyRoot, query):
+    terms=Terms(query)
+    if len(terms) == 0:
+        return []
+    segments=_LoadSegments(historyRoot)
+    result=None
+    for term in terms:
+        postings={}
+        for s in segments:
+            for p, ranges in s.Postings(term).items():
+                postings[p]=_UnionRanges(postings.get(p, []), ranges)
+        if result is None:
+            result=postings
+        else:
+            result=dict((p, _IntersectRanges(result[p], postings[p])) for p in result if p in postings)
+            result=dict((p, r) for p, r in result.items() if len(r) > 0)
+    for s in segments:
+        s.Close()
+    return [(p, r[0][0], r[-1][1], sum(end-start+1 for start, end in r)) for p, r in sorted(result.items())]
+
+
+#--------------------------------------------------------
+# The ranges common to two sorted lists of ranges
+def _IntersectRanges(a, b):
+    out=[]
+    i=j=0
+    while i < len(a) and j < len(b):
+        start=max(a[i][0], b[j][0])
+        end=min(a[i][1], b[j][1])
+        if start <= end:
+            out.append([start, end])
+        if a[i][1] < b[j][1]:
+            i=i+1
+        else:
+            j=j+1
+    return out
+
+
+#--------------------------------------------------------
+if __name__ == "__main__":
+    args=sys.argv[1:]
+    if len(args) >= 3 and args[0] == "search":
+        for pageName, first, last, count in Search(args[1], " ".join(args[2:])):
+            print(pageName+": "+HistoryStore.VersionDirName(first)+" to "+HistoryStore.VersionDirName(last)+" ("+str(count)+" versions)")
+    elif len(args) == 2 and args[0] == "update":
+        print(str(Update(args[1], os.cpu_count() or 1))+" versions indexed")
+    elif len(args) in [2, 3] and args[0] == "rebuild":
+        print(str(Rebuild(args[1], int(args[2]) if len(args) == 3 else None))+" versions indexed")
+    elif len(args) == 2 and args[0] == "merge":
+        Merge(args[1])
+    else:
+        print("Usage: python SearchIndex.py search <historyRoot> <words...>")
+        print("       python SearchIndex.py update <historyRoot>")
+        print("       python SearchIndex.py rebuild <historyRoot> [processes]")
+        print("       python SearchIndex.py merge <historyRoot>")
+        sys.exit(1)
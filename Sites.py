@@ -0,0 +1,87 @@
+import collections
+import json
+import os
+import urllib.parse
+
+# The wikis whose histories we keep, read from sites.json:
+#   {"sites": [
+#       {"name": "fancyclopedia",                   -- the site's Wikidot name, as XML-RPC knows it
+#        "baseUrl": "http://fancyclopedia.org",
+#        "xmlrpcUrlFile": "url.txt",                -- a file holding the XML-RPC URL (which includes the API key)...
+#        "xmlrpcUrl": "https://...",                --   ...or the URL itself
+#        "historyRoot": "I:\\Fancyclopedia History",
+#        "ignorePrefixes": ["system_", "index_", "forum_", "admin_", "search_"],   -- optional
+#        "ignorePages": [],                         -- optional
+#        "maxRequestsPerSecond": 4.0},              -- optional: the ceiling on requests to this site (see RateLimiter.py)
+#       ...]}
+# Without a sites.json there is just Fancyclopedia, set up as HistoryDownloader always was.
+
+sitesFileName="sites.json"
+
+Site=collections.namedtuple("Site", "name baseUrl xmlrpcUrl historyRoot ignorePrefixes ignorePages maxRequestsPerSecond")
+
+_defaultIgnorePrefixes=["system_", "index_", "forum_", "admin_", "search_"]
+
+
+#--------------------------------------------------------
+# The site HistoryDownloader was written for
+def Fancyclopedia():
+    return Site("fancyclopedia", "http://fancyclopedia.org", _ReadUrlFile("url.txt"), "I:\\Fancyclopedia History", _defaultIgnorePrefixes, [], 4.0)
+
+
+#--------------------------------------------------------
+def _ReadUrlFile(path):
+    if not os.path.exists(path):
+        print("***Can't find "+path+", which should hold the XML-RPC URL")
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+#--------------------------------------------------------
+# Make a Site from one entry of sites.json.  Returns None (having said why) if the entry is unusable.
+def _SiteFromJson(entry):
+    for key in ["name", "baseUrl", "historyRoot"]:
+        if not entry.get(key):
+            print("***A site in "+sitesFileName+" has no "+key+": "+json.dumps(entry))
+            return None
+    if entry.get("xmlrpcUrl"):
+        xmlrpcUrl=entry["xmlrpcUrl"]
+    elif entry.get("xmlrpcUrlFile"):
+        xmlrpcUrl=_ReadUrlFile(entry["xmlrpcUrlFile"])
+    else:
+        print("***Site "+entry["name"]+" in "+sitesFileName+" has neither an xmlrpcUrl nor an xmlrpcUrlFile")
+        return None
+    if xmlrpcUrl is None:
+        return None
+    return Site(entry["name"], entry["baseUrl"].rstrip("/"), xmlrpcUrl, entry["historyRoot"], entry.get("ignorePrefixes", _defaultIgnorePrefixes),
+                entry.get("ignorePages", []), float(entry.get("maxRequestsPerSecond", 4.0)))
+
+
+#--------------------------------------------------------
+# Read the list of Sites from path
+# Returns None if the configuration is unusable, so that nothing is crawled on the strength of a mistake
+def Load(path=sitesFileName):
+    if not os.path.exists(path):
+        site=Fancyclopedia()
+        return [site] if site.xmlrpcUrl is not None else None
+    try:
+        with open(path) as f:
+            entries=json.load(f).get("sites", [])
+    except ValueError as exception:
+        print("***"+path+" isn't valid JSON: "+str(exception))
+        return None
+    sites=[_SiteFromJson(entry) for entry in entries]
+    if len(sites) == 0 or None in sites:
+        return None
+    roots=[os.path.normcase(os.path.abspath(site.historyRoot)) for site in sites]
+    if len(set(roots)) != len(roots):
+        print("***Two sites in "+path+" share a historyRoot")
+        return None
+    return sites
+
+
+#--------------------------------------------------------
+# The host a site's pages are fetched from (which is what its rate limit is keyed by)
+def Host(site):
+    return urllib.parse.urlsplit(site.baseUrl).netloc.lower()
@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+import threading
+import time
+import Waits
+
+# Timing of each stage of the download (navigating to a page, pressing the history button, reading the history list, fetching each source, ...)
+# Each timed stage is appended as one line of JSON to historyRoot/timing.jsonl:
+#       {"t": start time, "stage": name, "page": page name, "seconds": duration, "retries": retries during the stage, "ok": succeeded?, "pid": process}
+# Retries are counted from the waits (see Waits.py) done while the stage is running.
+# Several worker processes may share the log: each record is written with a single append, so lines don't interleave.
+#
+# python Timing.py summary <timing.jsonl> reports throughput, the p50/p95/p99 time of each stage, and the slowest pages.
+
+logFileName="timing.jsonl"
+
+_logFd=None
+_logLock=threading.Lock()
+_local=threading.local()        # The stack of stages open in each thread
+
+
+#--------------------------------------------------------
+# Open historyRoot/timing.jsonl for this process's records, if it isn't already
+def ForRoot(historyRoot):
+    global _logFd
+    if _logFd is None:
+        os.makedirs(historyRoot, exist_ok=True)
+        _logFd=os.open(os.path.join(historyRoot, logFileName), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+#--------------------------------------------------------
+# Write one record to the log
+def Record(stage, page, start, seconds, retries=0, ok=True, **extra):
+    if _logFd is None:
+        return
+    record={"t": round(start, 3), "stage": stage, "page": page, "seconds": round(seconds, 4), "retries": retries, "ok": ok, "pid": os.getpid()}
+    record.update(extra)
+    with _logLock:
+        os.write(_logFd, (json.dumps(record)+"\n").encode("utf-8"))
+
+
+#--------------------------------------------------------
+# Time a stage:
+#       with Timing.Stage("source", pageName):
+#           ...
+# The stage is recorded as failed if it ends with an exception, or if the code inside calls Fail() on it
+class Stage:
+
+    def __init__(self, stage, page=None):
+        self.stage=stage
+        self.page=page
+        self.retries=0
+        self.ok=True
+
+    def __enter__(self):
+        if not hasattr(_local, "stack"):
+            _local.stack=[]
+        _local.stack.append(self)
+        self.start=time.time()
+        self.clock=time.monotonic()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        _local.stack.pop()
+        Record(self.stage, self.page, self.start, time.monotonic()-self.clock, self.retries, self.ok and excType is None)
+        return False
+
+    def Fail(self):
+        self.ok=False
+
+
+#--------------------------------------------------------
+# Attribute the retries in each wait to the innermost stage open in this thread
+def _OnWait(operation, seconds, attempts, succeeded):
+    stack=getattr(_local, "stack", None)
+    if stack:
+        stack[-1].retries=stack[-1].retries+attempts-1
+
+Waits.AddListener(_OnWait)
+
+
+#--------------------------------------------------------
+# The p-th percentile of a sorted list
+def _Percentile(values, p):
+    if len(values) == 0:
+        return 0
+    return values[min(len(values)-1, int(round(p/100*(len(values)-1))))]
+
+
+#--------------------------------------------------------
+# Print a summary of a timing log
+def Summarize(path, slowest=10):
+    records=[]
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass    # A line cut short by a crash
+    if len(records) == 0:
+        print("No timing records in "+path)
+        return
+
+    start=min(r["t"] for r in records)
+    end=max(r["t"]+r["seconds"] for r in records)
+    hours=max(end-start, 1)/3600
+    pages=[r for r in records if r["stage"] == "page"]
+    sources=[r for r in records if r["stage"] == "source" and r["ok"]]
+    print("Run of "+str(round(hours, 2))+" hours")
+    print("   "+str(len(pages))+" pages: "+str(round(len(pages)/hours, 1))+" pages per hour")
+    print("   "+str(len(sources))+" revisions: "+str(round(len(sources)/hours, 1))+" revisions per hour")
+
+    print()
+    print("   stage: count, failures, retries, total seconds, p50, p95, p99")
+    stages={}
+    for r in records:
+        stages.setdefault(r["stage"], []).append(r)
+    for stage, rs in sorted(stages.items(), key=lambda x: -sum(r["seconds"] for r in x[1])):
+        times=sorted(r["seconds"] for r in rs)
+        print("      "+stage+": "+str(len(rs))+", "+str(sum(1 for r in rs if not r["ok"]))+", "+str(sum(r.get("retries", 0) for r in rs))+", "+
+              str(round(sum(times), 1))+", "+str(round(_Percentile(times, 50), 3))+", "+str(round(_Percentile(times, 95), 3))+", "+str(round(_Percentile(times, 99), 3)))
+
+    if len(pages) > 0:
+        print()
+        print("   Slowest pages:")
+        for r in sorted(pages, key=lambda r: -r["seconds"])[:slowest]:
+            print("      "+str(r["page"])+": "+str(round(r["seconds"], 1))+" seconds")
+
+
+#--------------------------------------------------------
+# Usage: python Timing.py summary <timing.jsonl>
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "summary":
+        print("Usage: python Timing.py summary <timing.jsonl>")
+        sys.exit(1)
+    Summarize(sys.argv[2])
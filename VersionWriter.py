@@ -0,0 +1,117 @@
+import os
+import queue
+import threading
+import unidecode
+import HistoryStore
+import PackStore
+import Timing
+
+# A background writer for downloaded versions, so that fetching the next revision doesn't wait on the disk.
+# The fetch loop hands each finished revision to Submit() and carries on.  The writer thread takes them off the queue in batches and, for each batch,
+#   stages every version into its temporary directory, fsyncs all the files, renames every version into place, and finally fsyncs each page directory once.
+# So each version directory appears complete or not at all, and the cost of fsync is shared across the batch.
+# Flush() waits until everything submitted is on disk.  A page must be flushed before it is reported complete.
+
+class VersionWriter:
+
+    def __init__(self, batchSize=20, maxQueued=100):
+        self.batchSize=batchSize
+        self.queue=queue.Queue(maxsize=maxQueued)     # Bounded, so a slow disk holds back fetching rather than filling memory
+        self.error=None
+        self.thread=threading.Thread(target=self._Run, name="VersionWriter", daemon=True)
+        self.thread.start()
+
+    #--------------------------------------------------------
+    # Queue a version to be written
+    # onCommit, if given, is called (in the writer thread) once the version is safely on disk
+    def Submit(self, pagePath, number, id, type, user, date, comment, source, storage="directories", onCommit=None):
+        self._RaiseIfFailed()
+        metadata=HistoryStore.MakeMetadata(number, id, type, user, date, comment)
+        self.queue.put((pagePath, number, metadata, unidecode.unidecode_expect_nonascii(source), storage, onCommit))
+
+    #--------------------------------------------------------
+    # Wait until everything submitted so far has been written
+    def Flush(self):
+        self.queue.join()
+        self._RaiseIfFailed()
+
+    #--------------------------------------------------------
+    # Write everything outstanding and stop the writer thread
+    def Close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._RaiseIfFailed()
+
+    #--------------------------------------------------------
+    def _RaiseIfFailed(self):
+        if self.error is not None:
+            error=self.error
+            self.error=None
+            raise error
+
+    #--------------------------------------------------------
+    def _Run(self):
+        stop=False
+        while not stop:
+            # Wait for something to do, then take whatever else is waiting, up to a batch
+            batch=[self.queue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stop=True
+            items=[item for item in batch if item is not None]
+            try:
+                with Timing.Stage("write"):
+                    self._WriteBatch(items)
+            except Exception as exception:
+                print("***Version writer: "+type(exception).__name__+": "+str(exception))
+                self.error=exception
+            for i in range(len(batch)):
+                self.queue.task_done()
+
+    #--------------------------------------------------------
+    def _WriteBatch(self, items):
+        staged=[]
+        for pagePath, number, metadata, source, storage, onCommit in items:
+            if storage == "pack":
+                # A pack record is appended and fsynced on its own, and isn't visible until its index entry is written
+                PackStore.PackStore(pagePath).Add(number, metadata, source)
+                print("    Packed "+HistoryStore.VersionDirName(number))
+                if onCommit is not None:
+                    onCommit()
+                continue
+            staged.append((pagePath, number, onCommit, HistoryStore.StageVersion(pagePath, number, metadata, source)))
+
+        for pagePath, number, onCommit, files in staged:
+            for path in files:
+                HistoryStore.FsyncFile(path)
+
+        pagePaths=set()
+        for pagePath, number, onCommit, files in staged:
+            HistoryStore.CommitVersion(pagePath, number)
+            pagePaths.add(pagePath)
+            print("    Loaded "+HistoryStore.VersionDirName(number))
+        for pagePath in pagePaths:
+            HistoryStore.FsyncDirectory(pagePath)
+
+        for pagePath, number, onCommit, files in staged:
+            if onCommit is not None:
+                onCommit()
+
+
+# One writer per process
+# (A forked worker inherits its parent's writer, but not the writer's thread, so it's remembered along with the process it belongs to.)
+_writer=None
+_writerPid=None
+
+#--------------------------------------------------------
+# Return this process's writer, starting it if necessary
+def Shared():
+    global _writer, _writerPid
+    if _writer is None or _writerPid != os.getpid():
+        _writer=VersionWriter()
+        _writerPid=os.getpid()
+    return _writer
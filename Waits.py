@@ -0,0 +1,72 @@
+import threading
+import time
+
+# Waiting for things to happen: pages to load, lists to settle, sources to appear, servers to answer.
+# Rather than sleeping a fixed time and hoping, WaitFor polls a condition: quickly at first, then backing off exponentially, until it's met or a deadline passes.
+# So on a fast day we wait only as long as the page needs, and on a slow day we keep trying for the whole deadline rather than giving up after a fixed number of tries.
+# Every wait is recorded by operation name, so Report() can show how long each kind of wait takes and how often it fails.
+
+_stats={}       # operation: [count, failures, attempts, total seconds, max seconds]
+_statsLock=threading.Lock()
+
+
+#--------------------------------------------------------
+# Poll condition() until it returns something other than None, and return that
+# Exceptions of the types in ignored are treated as "not yet"
+# Returns None if the deadline (in seconds) passes first
+def WaitFor(operation, condition, deadline=10, initialDelay=0.05, maxDelay=1.0, ignored=(Exception,)):
+    start=time.monotonic()
+    delay=initialDelay
+    attempts=0
+    lastException=None
+    while True:
+        attempts=attempts+1
+        try:
+            result=condition()
+        except ignored as exception:
+            result=None
+            lastException=exception
+        elapsed=time.monotonic()-start
+        if result is not None:
+            _Record(operation, elapsed, attempts, True)
+            return result
+        if elapsed+delay > deadline:
+            _Record(operation, elapsed, attempts, False)
+            print("***Gave up waiting for "+operation+" after "+str(round(elapsed, 1))+" seconds and "+str(attempts)+" tries"+
+                  (" ("+type(lastException).__name__+")" if lastException is not None else ""))
+            return None
+        time.sleep(delay)
+        delay=min(delay*2, maxDelay)
+
+
+#--------------------------------------------------------
+def _Record(operation, seconds, attempts, succeeded):
+    with _statsLock:
+        s=_stats.setdefault(operation, [0, 0, 0, 0.0, 0.0])
+        s[0]=s[0]+1
+        if not succeeded:
+            s[1]=s[1]+1
+        s[2]=s[2]+attempts
+        s[3]=s[3]+seconds
+        s[4]=max(s[4], seconds)
+    for listener in _listeners:
+        listener(operation, seconds, attempts, succeeded)
+
+
+# Functions called as listener(operation, seconds, attempts, succeeded) after every wait
+_listeners=[]
+
+def AddListener(listener):
+    _listeners.append(listener)
+
+
+#--------------------------------------------------------
+# Print a table of the waits done so far
+def Report():
+    with _statsLock:
+        items=sorted(_stats.items())
+    if len(items) == 0:
+        return
+    print("   Waits:  operation: count, failures, mean tries, mean seconds, max seconds")
+    for operation, (count, failures, attempts, total, longest) in items:
+        print("      "+operation+": "+str(count)+", "+str(failures)+", "+str(round(attempts/count, 1))+", "+str(round(total/count, 2))+", "+str(round(longest, 2)))
@@ -0,0 +1,242 @@
+import copy
+import functools
+import http.client
+import json
+import random
+import re as Regex
+import Attachments
+import HistoryStore
+import Journal
+import Manifest
+import RevisionList
+import SearchIndex
+import Timing
+import VersionWriter
+import Waits
+from HttpSession import HttpSession
+
+# A browser-free way of downloading page histories.
+# The history pages are built by javascript calling Wikidot's ajax-module-connector.php, so instead of driving Firefox through them we make those calls ourselves.
+# Each call is a POST of a module name plus its parameters and returns JSON of the form {"status": "ok", "body": "<html>"}.
+# Wikidot's only protection is that the wikidot_token7 field must match the wikidot_token7 cookie, so we make up a token and send it both ways.
+# The output is the same Vnnnn/metadata.xml and Vnnnn/source.txt as the Selenium downloader in HistoryDownloader.py produces.
+
+class AjaxSession:
+
+    # baseUrl is the site to call; it can be left None if the session will only be handed to DownloadPageHistory, which points it at the site of the tree it's given
+    def __init__(self, baseUrl=None, timeout=30):
+        self.baseUrl=baseUrl.rstrip("/") if baseUrl is not None else None
+        self.http=HttpSession(timeout=timeout)
+        self.token="".join(random.choice("0123456789abcdef") for i in range(32))
+        self.http.cookies["wikidot_token7"]=self.token
+
+    #--------------------------------------------------------
+    # Call a Wikidot module and return the body of its response, or None if it failed
+    # Network errors and server errors (5xx) are retried with backoff; anything else is a failure
+    def CallModule(self, moduleName, params):
+        result=Waits.WaitFor(moduleName, lambda: self._CallModuleOnce(moduleName, params), deadline=60, initialDelay=0.5, maxDelay=10, ignored=(OSError, http.client.HTTPException))
+        if result is None:
+            return None
+        return result[0]
+
+    #--------------------------------------------------------
+    # Make one call of a module
+    # Returns (body,) or (None,) if the call failed, and None if it's worth trying again
+    def _CallModuleOnce(self, moduleName, params):
+        fields={"moduleName": moduleName, "wikidot_token7": self.token}
+        fields.update(params)
+        status, headers, data=self.http.Post(self.baseUrl+"/ajax-module-connector.php", fields)
+        if status >= 500:
+            return None
+        if status != 200:
+            print("***"+moduleName+" returned HTTP status "+str(status))
+            return (None,)
+        try:
+            response=json.loads(data.decode("utf-8"))
+        except ValueError:
+            print("***"+moduleName+" returned something which isn't JSON")
+            return (None,)
+        if response.get("status") != "ok":
+            print("***"+moduleName+" failed: "+str(response.get("status"))+" "+str(response.get("message")))
+            return (None,)
+        return (response.get("body"),)
+
+    #--------------------------------------------------------
+    # Return the page's internal Wikidot ID, or None if the page does not exist (or couldn't be had)
+    # Like CallModule, network errors and server errors (5xx) are retried with backoff
+    def GetPageId(self, pageName):
+        result=Waits.WaitFor("page id", lambda: self._GetPageIdOnce(pageName), deadline=60, initialDelay=0.5, maxDelay=10, ignored=(OSError, http.client.HTTPException))
+        if result is None:
+            return None
+        return result[0]
+
+    #--------------------------------------------------------
+    # Load the page once
+    # Returns (page ID,) or (None,) if the page does not exist, and None if it's worth trying again
+    def _GetPageIdOnce(self, pageName):
+        status, headers, data=self.http.Get(self.baseUrl+"/"+pageName+"/noredirect/t")
+        if status >= 500 or status == 429:
+            return None
+        if status != 200:
+            if status != 404:
+                print("***"+pageName+" returned HTTP status "+str(status))
+            return (None,)
+        m=Regex.search(r"WIKIREQUEST\.info\.pageId\s*=\s*(\d+);", data.decode("utf-8", "replace"))
+        if m is None:
+            return (None,)
+        return (m.group(1),)
+
+    #--------------------------------------------------------
+    # Return one pager page of the revision list (newest first) and the number of pager pages
+    def GetRevisionList(self, pageId, pagerPage=1, perPage=20):
+        body=self.CallModule("history/PageRevisionListModule", {"page_id": pageId, "page": pagerPage, "perpage": perPage, "options": '{"all":true}'})
+        if body is None:
+            return None, 0
+        return RevisionList.ParseRevisionList(body)
+
+    #--------------------------------------------------------
+    # Return the source text of one revision, or None if it couldn't be had
+    def GetRevisionSource(self, revisionId):
+        body=self.CallModule("history/PageSourceModule", {"revision_id": revisionId})
+        if body is None:
+            return None
+        return RevisionList.ParseSource(body)
+
+    #--------------------------------------------------------
+    # Return one pager page of the site's recent changes (newest first), as HTML
+    def GetSiteChanges(self, pagerPage=1, perPage=100):
+        return self.CallModule("changes/SiteChangesListModule", {"options": '{"all":true}', "page": pagerPage, "perpage": perPage})
+
+    #--------------------------------------------------------
+    # Return the HTML of the page's file list
+    def GetFileList(self, pageId):
+        return self.CallModule("files/PageFilesModule", {"page_id": pageId})
+
+    #--------------------------------------------------------
+    # Return a session for the site at baseUrl, sharing this one's connections and token
+    # (So one session, like one browser, can serve the pages of every site.)
+    def OnSite(self, baseUrl):
+        baseUrl=baseUrl.rstrip("/")
+        if baseUrl == self.baseUrl:
+            return self
+        session=copy.copy(self)
+        session.baseUrl=baseUrl
+        return session
+
+    #--------------------------------------------------------
+    # AjaxSession stands in for a Selenium browser in the worker pool, which calls quit() when done
+    def quit(self):
+        self.http.Close()
+
+
+#--------------------------------------------------------
+# Fetch the source of one revision (or copy it, if we have it under another page) and hand it to the writer
+# Returns False if the source couldn't be had
+def _FetchRevision(session, historyRoot, pageName, rev, writer, storage, manifest, journal, index):
+    # If the page has been renamed, we may have the revision already under its old name
+    source=manifest.SourceElsewhere(rev.id, pageName)
+    if source is None:
+        with Timing.Stage("source", pageName) as stage:
+            source=session.GetRevisionSource(rev.id)
+            if source is None:
+                stage.Fail()
+                print("***Could not get source of "+pageName+" V"+str(rev.number))
+                return False
+    # The writer records the version in the manifest and the journal (and indexes it, if the tree is indexed) once it is safely on disk
+    onCommit=functools.partial(journal.Committed, manifest, pageName, rev.number, rev.id)
+    if index is not None:
+        onCommit=functools.partial(index.Committed, onCommit, pageName, rev.number, source)
+    writer.Submit(HistoryStore.PagePath(historyRoot, pageName), rev.number, rev.id, rev.type, rev.user, rev.date, rev.comment, source, storage, onCommit)
+    return True
+
+
+#--------------------------------------------------------
+# If an earlier run stopped part way through this page, the revisions it had listed but not saved are in the journal: fetch those straight away by their IDs
+# (The Selenium engine uses this too, since a browser can only show a revision's source from its row in the revision list.)
+# Returns the set of version numbers fetched, or None if one of them couldn't be had
+def ResumePendingRevisions(session, historyRoot, pageName, existingVersions, wanted, writer, storage, manifest, journal, index):
+    pending=Journal.PendingRevisions(historyRoot, pageName)
+    resumed=[rev for number, rev in sorted(pending.items(), reverse=True) if number not in existingVersions and (wanted is None or number in wanted)]
+    if len(resumed) > 0:
+        print("   Resuming at V"+str(resumed[0].number))
+    for rev in resumed:
+        if not _FetchRevision(session, historyRoot, pageName, rev, writer, storage, manifest, journal, index):
+            return None
+    return set(rev.number for rev in resumed)
+
+
+#--------------------------------------------------------
+# Read and save the history of one page, the same as HistoryDownloader.DownloadPageHistory but using an AjaxSession instead of a browser
+# wanted, if given, is the set of revision numbers to fetch; otherwise every version not yet downloaded is fetched
+# Returns True if the page's history is now complete and the page can be added to the donelist
+def DownloadPageHistory(session, historyRoot, pageName, justUpdate, wanted=None, perPage=100):
+
+    session=session.OnSite(HistoryStore.SiteUrl(historyRoot))
+    pagePath=HistoryStore.PagePath(historyRoot, pageName)
+    manifest=Manifest.ForRoot(historyRoot)
+    journal=Journal.ForRoot(historyRoot)
+    index=SearchIndex.ForRoot(historyRoot)
+    existingVersions=manifest.Versions(pageName)
+    storage=HistoryStore.StorageFormat(historyRoot)
+    writer=VersionWriter.Shared()
+    lowestVersionNeeded=HistoryStore.LowestVersionNeeded(existingVersions)
+    print("   First version needed: "+str(lowestVersionNeeded))
+
+    Timing.ForRoot(historyRoot)
+    with Timing.Stage("navigate", pageName) as stage:
+        pageId=session.GetPageId(pageName)
+        if pageId is None:
+            stage.Fail()
+            print("*** Page does not exist: "+pageName)
+            return False
+
+    # Fetch any revisions an interrupted run left pending.  If they're all that was wanted, there's no need to read the revision list at all.
+    resumed=ResumePendingRevisions(session, historyRoot, pageName, existingVersions, wanted, writer, storage, manifest, journal, index)
+    if resumed is None:
+        return False
+    existingVersions=existingVersions | resumed
+
+    pagerPages=[]
+    if wanted is None or not wanted <= existingVersions:
+        # The revision list comes a page at a time, newest first.  The first page tells us the newest revision number,
+        # from which we can work out which pages hold the versions we're missing and ask for just those.
+        with Timing.Stage("history list", pageName) as stage:
+            revisions, pageCount=session.GetRevisionList(pageId, 1, perPage)
+            if revisions is None:
+                stage.Fail()
+                print("***Could not get the revision list of "+pageName)
+                return False
+        if len(revisions) > 0:
+            pagerPages=RevisionList.PagerPagesNeeded(revisions[0].number, perPage, existingVersions, wanted)
+
+    for pagerPage in pagerPages:
+        if pagerPage != 1:
+            with Timing.Stage("history list", pageName) as stage:
+                revisions, pageCount=session.GetRevisionList(pageId, pagerPage, perPage)
+                if revisions is None:
+                    stage.Fail()
+                    print("***Could not get page "+str(pagerPage)+" of the revision list of "+pageName)
+                    return False
+
+        revisions=[rev for rev in revisions if rev.number not in existingVersions and (wanted is None or rev.number in wanted)]
+        journal.RevisionsPending(pageName, revisions)
+        for rev in revisions:
+            if not _FetchRevision(session, historyRoot, pageName, rev, writer, storage, manifest, journal, index):
+                return False
+
+    # Download the files currently attached to this page (or at least those which are new or changed)
+    with Timing.Stage("attachments", pageName) as stage:
+        body=session.GetFileList(pageId)
+        if body is None:
+            stage.Fail()
+            print("***Could not get the file list of "+pageName)
+            return False
+        if not Attachments.SyncAttachments(session.http, session.baseUrl, pagePath, pageName, Attachments.ParseFileTable(body), manifest):
+            stage.Fail()
+            print("***Could not download all the files attached to "+pageName)
+            return False
+
+    # The page isn't complete until all its versions are on disk
+    with Timing.Stage("flush", pageName):
+        writer.Flush()
+    return True
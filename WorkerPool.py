@@ -0,0 +1,138 @@
+import multiprocessing
+import queue
+import CrawlScheduler
+import RateLimiter
+import SearchIndex
+import Timing
+
+# Download the histories of many pages at once using several browsers, each running in its own process.
+# Almost all of a crawl's time is spent waiting for Wikidot to serve pages, so N browsers give nearly N times the throughput.
+# (Up to the sites' rate limits, which the workers share: see RateLimiter.py.)
+
+# The pages are handed out one at a time from a shared queue, so each page (and therefore each page's directory) is owned by exactly one worker.
+# The queue is kept short and topped up from a CrawlScheduler as pages are finished, so that pages of several sites are interleaved according to their rate limits.
+# The workers never write donelist.txt themselves.  They report back to the parent process, which is the only writer.
+
+#--------------------------------------------------------
+# The body of one worker process
+# Pull (historyRoot, page name, revisions wanted) tasks off the task queue until a None arrives, downloading each page and reporting the outcome on the result queue
+def _Worker(workerNum, browserFactory, downloadFn, taskQueue, resultQueue, limiters):
+    browser=None
+    RateLimiter.Install(limiters)
+    roots=set()
+    try:
+        with Timing.Stage("browser start"):
+            browser=browserFactory()
+        while True:
+            task=taskQueue.get()
+            if task is None:
+                break
+            historyRoot, pageName, wanted=task
+            roots.add(historyRoot)
+            Timing.ForRoot(historyRoot)
+            print("   Worker "+str(workerNum)+" getting: "+pageName)
+            with Timing.Stage("page", pageName) as stage:
+                try:
+                    ok=downloadFn(browser, historyRoot, pageName, False, wanted)
+                except Exception as exception:
+                    print("***Worker "+str(workerNum)+": "+type(exception).__name__+" while downloading "+pageName+": "+str(exception))
+                    ok=False
+                if not ok:
+                    stage.Fail()
+            resultQueue.put((historyRoot, pageName, ok))
+    except Exception as exception:
+        print("***Worker "+str(workerNum)+" stopped: "+type(exception).__name__+": "+str(exception))
+    finally:
+        # Write out the index of whatever this worker downloaded since its last segment
+        for historyRoot in roots:
+            index=SearchIndex.ForRoot(historyRoot)
+            if index is not None:
+                index.Flush()
+        if browser is not None:
+            try:
+                browser.quit()
+            except Exception:
+                pass
+        resultQueue.put((None, None, workerNum))     # Tell the parent this worker is gone
+
+
+#--------------------------------------------------------
+# Download the pages a CrawlScheduler hands out using numBrowsers browsers (but never more than maxBrowsers)
+# downloadFn has the signature of DownloadPageHistory and returns True when a page is complete
+# doneFn(historyRoot, pageName) is called in this process for each completed page
+# browserFactory is called (with no arguments) in each worker to create its browser. It, like downloadFn, must be a module-level function so it can be sent to another process.
+# Returns a dictionary of historyRoot: number of pages completed
+def Crawl(scheduler, downloadFn, doneFn, browserFactory, numBrowsers, maxBrowsers):
+    total=len(scheduler)
+    numWorkers=max(1, min(numBrowsers, maxBrowsers, total))
+    print("   Downloading "+str(total)+" pages using "+str(numWorkers)+" browsers")
+
+    taskQueue=multiprocessing.Queue()
+    resultQueue=multiprocessing.Queue()
+
+    # Give each worker a couple of pages to be going on with, then one more each time a page is finished
+    stopped=[False]
+    def Feed(count):
+        for i in range(count):
+            task=scheduler.Next()
+            if task is None:
+                if not stopped[0]:
+                    for j in range(numWorkers):
+                        taskQueue.put(None)     # One stop signal per worker
+                    stopped[0]=True
+                return
+            taskQueue.put(task)
+    Feed(2*numWorkers)
+
+    workers=[]
+    for i in range(numWorkers):
+        p=multiprocessing.Process(target=_Worker, args=(i, browserFactory, downloadFn, taskQueue, resultQueue, RateLimiter.Limiters()), daemon=True)
+        p.start()
+        workers.append(p)
+
+    # Collect results until every worker has signed off
+    # If a worker dies without signing off (e.g., it was killed), notice that rather than waiting forever
+    count=0
+    completed={}
+    running=numWorkers
+    while running > 0:
+        try:
+            historyRoot, pageName, result=resultQueue.get(timeout=30)
+        except queue.Empty:
+            if not any(p.is_alive() for p in workers):
+                print("***All workers have exited unexpectedly")
+                break
+            continue
+
+        if historyRoot is None:
+            running=running-1
+            continue
+
+        Feed(1)
+        count=count+1
+        if result:
+            doneFn(historyRoot, pageName)
+            completed[historyRoot]=completed.get(historyRoot, 0)+1
+        else:
+            print("***Page not completed: "+pageName)
+        if count%100 == 0:
+            print("*** "+str(count))
+
+    taskQueue.cancel_join_thread()     # If the workers died, pages may be left in the queue; don't hang at exit trying to flush them
+    for p in workers:
+        p.join()
+
+    print("   "+str(sum(completed.values()))+" of "+str(total)+" pages completed")
+    return completed
+
+
+#--------------------------------------------------------
+# Download the histories of pageNames, all pages of the site in historyRoot, in parallel (see Crawl())
+# pageNames is a list of page names, or a work list: a dictionary of page name: the set of revision numbers wanted (None for all those missing)
+# Returns the number of pages completed
+def DownloadPagesInParallel(pageNames, historyRoot, downloadFn, doneFn, browserFactory, numBrowsers, maxBrowsers):
+    if not isinstance(pageNames, dict):
+        pageNames=dict.fromkeys(pageNames)
+    scheduler=CrawlScheduler.CrawlScheduler()
+    scheduler.Add(historyRoot, pageNames)
+    return Crawl(scheduler, downloadFn, doneFn, browserFactory, numBrowsers, maxBrowsers).get(historyRoot, 0)